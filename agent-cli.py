@@ -1,3 +1,4 @@
+import asyncio
 import sys
 
 from prompt_toolkit import PromptSession
@@ -5,19 +6,13 @@ from prompt_toolkit.completion import WordCompleter
 from prompt_toolkit.lexers import PygmentsLexer
 from prompt_toolkit.styles import Style
 
-from langchain.agents.openai_functions_agent.agent_token_buffer_memory import (
-    AgentTokenBufferMemory,
-)
-
-from langchain.callbacks.base import AsyncCallbackHandler
-from langchain.schema import LLMResult
+from langchain_core.callbacks import AsyncCallbackHandler
+from langchain_core.outputs import LLMResult
 from langchain_core.messages import BaseMessage
 from uuid import UUID
 from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence, TypeVar, Union
 
-from core.costs import TokenCostProcess, CostCalcAsyncHandler
-
-from core.agent import agent_executor, agent_llm
+from conf.constants import require, VECTOR_STORE_SETTINGS
 
 import argparse
 
@@ -83,66 +78,101 @@ class CLIAsyncHandler(AsyncCallbackHandler):
         print("Thinking ...")
 
 
-def main(args):
-    
-    memory = AgentTokenBufferMemory(llm=agent_llm)
-    
-    session = PromptSession(
-        lexer=None, completer=None, style=style
-    )
+async def main(args):
 
-    if(args.filename == None):
-        
-        # enter QA loop
-
-        print("How can I help you?")
-
-        while True:
-            try:            
-                prompt_text = session.prompt("> ")
-            except KeyboardInterrupt:
-                continue  # Control-C pressed. Try again.
-            except EOFError:
-                break  # Control-D pressed.
-
-            # request chat completion
-            try:
-                response_handle = agent_executor(
-                    {"input": prompt_text, "history": memory.buffer},
-                    callbacks=[CLIAsyncHandler()],
-                    include_run_info=True,
-                )
+    # the agent is only built once the arguments are valid
+    require(*VECTOR_STORE_SETTINGS)
 
-                memory.save_context({"input": prompt_text}, response_handle)
+    from core.memory import AgentMemory
+    from core.agent import get_agent_executor, get_agent_llm
+    from core.clients import aclose_clients
+    from core.costs import CostCalcAsyncHandler, TokenCostProcess
+    from core.tracing import TracingCallbackHandler
 
-                print(f"\n{response_handle['output']}")
+    agent_executor = get_agent_executor()
+    memory = AgentMemory(llm=get_agent_llm())
 
-            except Exception as e:
-                print("Failed to call Openai API: ", str(e))                
+    try:
+        if(args.batch != None):
 
-        print("GoodBye!")
+            # answer all prompts of a directory or JSONL file in this process
 
-    else:
+            from core.batch import load_prompts, print_summary, run_batch
 
-        # enter one-shot prompting from file
+            if args.no_cache:
+                agent_executor = agent_executor.copy(update={"use_answer_cache": False})
 
-        with open(args.filename) as f:
-            prompt = f.read()        
-        prompt_text = prompt.replace('\n', ' ').replace('\r', '')        
+            prompts = load_prompts(args.batch)
+            print("Answering ", len(prompts), " prompts, concurrency ", args.concurrency)
+            summary = await run_batch(agent_executor, prompts, args.output, concurrency=args.concurrency)
+            print_summary(summary)
+            print("Results written to ", args.output)
 
-        response_handle = agent_executor(
-                {"input": prompt_text, "history": []},
-                callbacks=[CLIAsyncHandler()],
-                include_run_info=True,
+        elif(args.filename == None):
+            
+            # enter QA loop
+
+            session = PromptSession(
+                lexer=None, completer=None, style=style
             )
 
-        print(f"\n{response_handle['output']}")
+            session_costs = TokenCostProcess()
+
+            print("How can I help you?")
+
+            while True:
+                try:            
+                    prompt_text = await session.prompt_async("> ")
+                except KeyboardInterrupt:
+                    continue  # Control-C pressed. Try again.
+                except EOFError:
+                    break  # Control-D pressed.
+
+                # request chat completion
+                try:
+                    response_handle = await agent_executor.ainvoke(
+                        {"input": prompt_text, "history": memory.buffer},
+                        {"callbacks": [CLIAsyncHandler(), CostCalcAsyncHandler(session_costs), TracingCallbackHandler("agent-cli")]},
+                        include_run_info=True,
+                    )
+
+                    memory.save_context({"input": prompt_text}, response_handle)
+
+                    print(f"\n{response_handle['output']}")
+
+                except Exception as e:
+                    print("Failed to call Openai API: ", str(e))                
+
+            print(session_costs.get_cost_summary())
+            print("GoodBye!")
+
+        else:
+
+            # enter one-shot prompting from file
+
+            with open(args.filename) as f:
+                prompt = f.read()        
+            prompt_text = prompt.replace('\n', ' ').replace('\r', '')        
+
+            response_handle = await agent_executor.ainvoke(
+                    {"input": prompt_text, "history": []},
+                    {"callbacks": [CLIAsyncHandler(), TracingCallbackHandler("agent-cli")]},
+                    include_run_info=True,
+                )
+
+            print(f"\n{response_handle['output']}")
+    finally:
+        await aclose_clients()
 
 
 
 if __name__ == "__main__":    
     parser = argparse.ArgumentParser(description='Camel Quickstart Assistant')
     parser.add_argument('-f', '--filename', help='The input file that will be taken as a prompt', required=False)
+    parser.add_argument('-b', '--batch', help='A directory of prompt files or a JSONL file of prompts to answer in batch', required=False)
+    parser.add_argument('-c', '--concurrency', type=int, default=4, help='Prompts answered concurrently in batch mode')
+    parser.add_argument('-o', '--output', default="./data/batch/results.jsonl", help='The JSONL file batch results are written to')
+    parser.add_argument('--no-cache', action='store_true', help='Do not answer batch prompts from the answer cache')
     args = parser.parse_args()
 
-    main(args)
\ No newline at end of file
+    asyncio.run(main(args))
\ No newline at end of file
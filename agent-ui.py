@@ -1,3 +1,5 @@
+import asyncio
+
 import streamlit as st
 import psycopg2
 
@@ -5,16 +7,18 @@ from core.MyStreamlitCallbackHandler import MyStreamlitCallbackHandler
 
 from langchain.schema import AIMessage, HumanMessage
 
-from langchain.agents.openai_functions_agent.agent_token_buffer_memory import (
-    AgentTokenBufferMemory,
-)
+from core.memory import AgentMemory
 
+from core.clients import get_event_loop
 from core.costs import TokenCostProcess, CostCalcAsyncHandler
+from core.tracing import TracingCallbackHandler
 
 
-from core.agent import agent_executor, agent_llm
+from conf.constants import PG_URL, require, VECTOR_STORE_SETTINGS
+require('PG_URL', *VECTOR_STORE_SETTINGS)
 
-from conf.constants import PG_URL
+# built once per server process, reruns of this script reuse them
+from core.agent import get_agent_executor, get_agent_llm
 
 # --
 
@@ -29,7 +33,11 @@ st.set_page_config(
 
 starter_message = "How can I help you?"
 if "messages" not in st.session_state or st.button("Clear Thread"):
-    st.session_state["messages"] = [AIMessage(content=starter_message)]
+    # kept across reruns, so the token counts of the thread are only computed once
+    agent_memory = AgentMemory(llm=get_agent_llm())
+    agent_memory.chat_memory.add_ai_message(starter_message)
+    st.session_state["agent_memory"] = agent_memory
+    st.session_state["messages"] = agent_memory.buffer
 
 def replay_package():
     package = []
@@ -72,7 +80,19 @@ def send_feedback(run_id, score, prompt, response):
         if conn is not None:
             conn.close()    
 
-agent_memory = AgentTokenBufferMemory(llm=agent_llm)
+def answer(prompt, history, callbacks):
+    # all sessions run their turns on the shared agent loop, which keeps its pooled clients
+    future = asyncio.run_coroutine_threadsafe(
+        get_agent_executor().ainvoke(
+            {"input": prompt, "history": history},
+            {"callbacks": callbacks},
+            include_run_info=True,
+        ),
+        get_event_loop()
+    )
+    return future.result()
+
+agent_memory = st.session_state["agent_memory"]
 for msg in st.session_state.messages:
     
     # [hb] don't know how, but empty message sneak in an occupy the UI
@@ -83,8 +103,6 @@ for msg in st.session_state.messages:
         st.chat_message("assistant").write(msg.content)
     elif isinstance(msg, HumanMessage):
         st.chat_message("user").write(msg.content)
-    
-    agent_memory.chat_memory.add_message(msg)
 
 if prompt := st.chat_input(placeholder=starter_message):
     st.chat_message("user").write(prompt)
@@ -97,19 +115,19 @@ if prompt := st.chat_input(placeholder=starter_message):
             )
 
         token_cost_process = TokenCostProcess()
-        response = agent_executor(
-            {"input": prompt, "history": st.session_state.messages},
-            callbacks=[st_callback, CostCalcAsyncHandler( token_cost_process )],
-            include_run_info=True,
+        response = answer(
+            prompt,
+            st.session_state.messages,
+            [st_callback, CostCalcAsyncHandler( token_cost_process ), TracingCallbackHandler("agent-ui")]
         )
         print(token_cost_process.get_cost_summary())
 
-        st.session_state.messages.append(AIMessage(content=response["output"]))
         st.write(response["output"])
+        if response.get("cached"):
+            st.caption("Answered from cache")
         st.caption("Total Tokens: " + str(token_cost_process.get_total_tokens()))
         st.caption("Costs USD: " + format(token_cost_process.get_total_costs(), '.5f'))
         agent_memory.save_context({"input": prompt}, response)
-        st.session_state["messages"] = agent_memory.buffer
         run_id = response["__run"].run_id
 
         col_blank, col_text, col1, col2 = st.columns([10, 2, 1, 1])
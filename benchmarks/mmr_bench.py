@@ -0,0 +1,67 @@
+import argparse
+import timeit
+
+import numpy as np
+
+from langchain_community.vectorstores.utils import maximal_marginal_relevance as langchain_mmr
+
+from core.mmr import maximal_marginal_relevance, maximal_marginal_relevance_batch
+
+"""
+Micro-benchmark of the in-project MMR engine (core/mmr.py) against
+langchain's maximal_marginal_relevance, using the same inputs that
+fetch_and_rerank() passes: one query and a list of candidate vectors
+(python lists, as returned by qdrant).
+
+Usage:
+    python -m benchmarks.mmr_bench
+    python -m benchmarks.mmr_bench --sizes 15 30 500 -k 5 --lambda-mult 0.85
+"""
+
+def random_vectors(rng, n, dim):
+    return rng.standard_normal((n, dim)).astype(np.float32)
+
+
+def best_of(fn, repeat, number):
+    return min(timeit.repeat(fn, repeat=repeat, number=number)) / number
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='MMR micro-benchmark')
+    parser.add_argument('--sizes', help='Candidate fetch sizes', nargs='+', type=int, default=[15, 30, 60, 120, 250, 500])
+    parser.add_argument('--dim', help='Embedding dimension', type=int, default=1536)
+    parser.add_argument('-k', help='Number of selected candidates', type=int, default=5)
+    parser.add_argument('--lambda-mult', help='MMR diversity factor', type=float, default=0.85)
+    parser.add_argument('--queries', help='Queries per batched run', type=int, default=8)
+    parser.add_argument('--repeat', help='Timing repetitions', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+
+    print(f"dim={args.dim} k={args.k} lambda={args.lambda_mult}")
+    print(f"{'fetch':>6} {'langchain ms':>13} {'numpy ms':>9} {'speedup':>8} {'batch/query ms':>15} {'same':>5}")
+
+    for size in args.sizes:
+        query = random_vectors(rng, 1, args.dim)[0]
+        candidates = random_vectors(rng, size, args.dim).tolist()
+        queries = random_vectors(rng, args.queries, args.dim)
+
+        # same selection as the reference implementation?
+        expected = langchain_mmr(query, candidates, k=args.k, lambda_mult=args.lambda_mult)
+        actual = maximal_marginal_relevance(query, candidates, k=args.k, lambda_mult=args.lambda_mult)
+
+        number = max(1, 2000 // size)
+        reference = best_of(
+            lambda: langchain_mmr(query, candidates, k=args.k, lambda_mult=args.lambda_mult),
+            args.repeat, number)
+        vectorized = best_of(
+            lambda: maximal_marginal_relevance(query, candidates, k=args.k, lambda_mult=args.lambda_mult),
+            args.repeat, number)
+        batched = best_of(
+            lambda: maximal_marginal_relevance_batch(queries, candidates, k=args.k, lambda_mult=args.lambda_mult),
+            args.repeat, number) / args.queries
+
+        print(
+            f"{size:>6} {reference*1000:>13.3f} {vectorized*1000:>9.3f} "
+            f"{reference/vectorized:>7.1f}x {batched*1000:>15.3f} {str(list(expected) == actual):>5}"
+        )
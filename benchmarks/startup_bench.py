@@ -0,0 +1,97 @@
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+"""
+Cold start benchmark of the entry points.
+
+Every target runs in a fresh interpreter with `-X importtime`. The report
+shows the wall time until the process exits (`--help` exits right after
+argument parsing, so it measures import and setup cost only), the total
+import time and the most expensive top-level imports.
+
+Usage:
+    python -m benchmarks.startup_bench
+    python -m benchmarks.startup_bench --runs 5 --top 15
+    python -m benchmarks.startup_bench --tree /path/to/other/checkout   # compare with another revision
+"""
+
+# (label, python arguments)
+TARGETS = [
+    ("import core.agent", ["-c", "import core.agent"]),
+    ("import core.slack", ["-c", "import core.slack"]),
+    ("agent-cli.py --help", ["agent-cli.py", "--help"]),
+    ("query_qdrant.py --help", ["query_qdrant.py", "--help"]),
+    ("upsert_pdf.py --help", ["upsert_pdf.py", "--help"]),
+]
+
+# placeholder settings, so that config validation does not stop the run early
+DUMMY_ENV = {
+    "QDRANT_KEY": "benchmark",
+    "QDRANT_URL": "http://localhost:6333",
+    "PG_URL": "postgresql://localhost/benchmark",
+    "OPENAI_API_KEY": "benchmark",
+    "TRACING_ENABLED": "false",
+}
+
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def run_target(tree, arguments):
+    env = {**os.environ, **{key: os.environ.get(key, value) for key, value in DUMMY_ENV.items()}}
+    env["PYTHONPATH"] = tree
+
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", *arguments],
+        cwd=tree, env=env, capture_output=True, text=True, stdin=subprocess.DEVNULL,
+    )
+    wall = time.perf_counter() - start
+
+    # (cumulative us, nesting depth, module), nested modules are included in their parent's time
+    imports = []
+    errors = []
+    for line in process.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            imports.append((int(match[2]), (len(match[3]) - 1) // 2, match[4]))
+        elif line.strip() and not line.startswith("import time:"):
+            errors.append(line.strip())
+
+    return wall, imports, process.returncode, errors[-1:]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Entry point cold start benchmark')
+    parser.add_argument('--tree', help='Source tree to benchmark', default=os.getcwd())
+    parser.add_argument('--runs', help='Runs per target', type=int, default=3)
+    parser.add_argument('--top', help='Number of imports to list', type=int, default=10)
+    parser.add_argument('--depth', help='Max. import nesting depth to list', type=int, default=2)
+    parser.add_argument('--targets', help='Only run targets whose label contains one of these', nargs='*')
+    args = parser.parse_args()
+
+    tree = os.path.abspath(args.tree)
+    print(f"tree={tree} python={sys.version.split()[0]} runs={args.runs}")
+
+    for label, arguments in TARGETS:
+        if args.targets and not any(name in label for name in args.targets):
+            continue
+
+        walls = []
+        for _ in range(args.runs):
+            wall, imports, returncode, errors = run_target(tree, arguments)
+            walls.append(wall)
+
+        total = sum(cumulative for cumulative, depth, _ in imports if depth == 0)
+        print(f"\n{label}: wall median {statistics.median(walls)*1000:.0f} ms, "
+              f"imports {total/1000:.0f} ms, exit code {returncode}")
+        if returncode not in (0, None) and errors:
+            print("  " + errors[0])
+
+        listed = [entry for entry in imports if entry[1] <= args.depth]
+        for cumulative, depth, module in sorted(listed, reverse=True)[:args.top]:
+            print(f"  {cumulative/1000:>8.1f} ms  {'  ' * depth}{module}")
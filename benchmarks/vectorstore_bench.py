@@ -0,0 +1,67 @@
+import argparse
+import random
+import time
+
+import numpy as np
+
+from core.vectorstores import LanceDBBackend, QdrantBackend, copy_collection
+
+"""
+Compare retrieval latency of the Qdrant and the embedded LanceDB backend
+with the query shape of a tool call: one vector searched against each
+collection, top 15. Query vectors are sampled from the stored points so
+no OpenAI calls are needed.
+
+Usage:
+    # copy the collections from qdrant into the local lancedb first
+    python -m benchmarks.vectorstore_bench -c quarkus_reference_2 rhaetor.github.io_components_2 --sync
+
+    python -m benchmarks.vectorstore_bench -c quarkus_reference_2 rhaetor.github.io_components_2 -n 100
+"""
+
+def sample_vectors(backend, collections, n):
+    vectors = []
+    for name in collections:
+        for point in backend.iter_points(name, with_payload=False):
+            vectors.append(point.vector)
+    random.seed(42)
+    return random.sample(vectors, min(n, len(vectors)))
+
+
+def measure(backend, collections, vectors, top_k):
+    # warm up connections / memory maps
+    backend.search_many([(name, vectors[0], top_k) for name in collections], with_payload=False)
+
+    latencies = []
+    for vector in vectors:
+        start = time.perf_counter()
+        backend.search_many([(name, vector, top_k) for name in collections], with_payload=False)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return np.array(latencies)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Vector store backend benchmark')
+    parser.add_argument('-c', '--collections', help='Collections searched per query', nargs='+', required=True)
+    parser.add_argument('-n', '--queries', help='Number of sampled queries', type=int, default=50)
+    parser.add_argument('-k', '--topk', help='Results per collection', type=int, default=15)
+    parser.add_argument('--sync', help='Copy the collections from qdrant to lancedb first', action='store_true')
+    args = parser.parse_args()
+
+    qdrant = QdrantBackend()
+    lance = LanceDBBackend()
+
+    if args.sync:
+        for name in args.collections:
+            print(f"Copied {copy_collection(qdrant, lance, name)} points of {name} to lancedb")
+
+    vectors = sample_vectors(qdrant, args.collections, args.queries)
+    print(f"{len(vectors)} queries x {len(args.collections)} collections, top {args.topk}")
+    print(f"{'backend':>8} {'mean ms':>8} {'p50 ms':>7} {'p95 ms':>7}")
+
+    for label, backend in [("qdrant", qdrant), ("lancedb", lance)]:
+        latencies = measure(backend, args.collections, vectors, args.topk)
+        print(
+            f"{label:>8} {latencies.mean():>8.2f} "
+            f"{np.percentile(latencies, 50):>7.2f} {np.percentile(latencies, 95):>7.2f}"
+        )
@@ -5,24 +5,104 @@ load_dotenv()
 
 TEXT_DIR = "./data/text/"
 PROCESSED_DIR = "./data/processed/"
+CACHE_DIR = "./data/cache/"
 
-QDRANT_KEY = None
-try:
-    QDRANT_KEY = os.environ['QDRANT_KEY']
-except KeyError:
-    print('QDRANT_KEY is missing!')
-    sys.exit()
-
-QDRANT_URL = None
-try:
-    QDRANT_URL = os.environ['QDRANT_URL']
-except KeyError:
-    print('QDRANT_URL is missing!')
-    sys.exit()
-
-PG_URL = None
-try:
-    PG_URL = os.environ['PG_URL']
-except KeyError:
-    print('PG_URL is missing!')
-    sys.exit()
+QDRANT_KEY = os.environ.get('QDRANT_KEY')
+QDRANT_URL = os.environ.get('QDRANT_URL')
+PG_URL = os.environ.get('PG_URL')
+
+def require(*names):
+    """
+        Exit if any of the given settings is missing. Each entry point validates
+        only the settings it actually uses.
+    """
+    missing = [name for name in names if not os.environ.get(name)]
+    for name in missing:
+        print(name + ' is missing!')
+    if missing:
+        sys.exit()
+
+# connection pooling
+QDRANT_PREFER_GRPC = os.environ.get('QDRANT_PREFER_GRPC', 'false').lower() in ('1', 'true', 'yes')
+QDRANT_POOL_SIZE = int(os.environ.get('QDRANT_POOL_SIZE', 10))
+OPENAI_POOL_SIZE = int(os.environ.get('OPENAI_POOL_SIZE', 10))
+CLIENT_KEEPALIVE_EXPIRY = float(os.environ.get('CLIENT_KEEPALIVE_EXPIRY', 30))
+
+# retrieval
+SEARCH_CONCURRENCY = int(os.environ.get('SEARCH_CONCURRENCY', 8))
+VECTOR_BACKEND = os.environ.get('VECTOR_BACKEND', 'qdrant')
+LANCEDB_URI = os.environ.get('LANCEDB_URI', "./data/lancedb")
+
+# settings needed to reach the configured vector store
+VECTOR_STORE_SETTINGS = ('QDRANT_URL', 'QDRANT_KEY') if VECTOR_BACKEND == 'qdrant' else ()
+
+# agent: parallel function calling, the tool calls of a step run concurrently
+PARALLEL_TOOL_CALLS = os.environ.get('PARALLEL_TOOL_CALLS', 'true').lower() in ('1', 'true', 'yes')
+TOOL_CONCURRENCY = int(os.environ.get('TOOL_CONCURRENCY', 4))
+
+# speculative retrieval for the question while the agent picks a tool
+PREFETCH_ENABLED = os.environ.get('PREFETCH_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+PREFETCH_FETCH_K = int(os.environ.get('PREFETCH_FETCH_K', 15))
+PREFETCH_SIMILARITY = float(os.environ.get('PREFETCH_SIMILARITY', 0.88))
+
+# semantic cache of first-turn answers, invalidated through the collection generations
+ANSWER_CACHE_ENABLED = os.environ.get('ANSWER_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+ANSWER_CACHE_PATH = os.environ.get('ANSWER_CACHE_PATH', CACHE_DIR+"answers.sqlite")
+ANSWER_CACHE_SIMILARITY = float(os.environ.get('ANSWER_CACHE_SIMILARITY', 0.96))
+ANSWER_CACHE_TTL = float(os.environ.get('ANSWER_CACHE_TTL', 7*24*60*60))
+ANSWER_CACHE_SIZE = int(os.environ.get('ANSWER_CACHE_SIZE', 5000))
+
+# embedding router: picks the tools of the first step without an LLM call when confident
+ROUTER_ENABLED = os.environ.get('ROUTER_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+ROUTER_PATH = os.environ.get('ROUTER_PATH', CACHE_DIR+"router.npz")
+ROUTER_PROTOTYPES = int(os.environ.get('ROUTER_PROTOTYPES', 8))
+ROUTER_SAMPLE_SIZE = int(os.environ.get('ROUTER_SAMPLE_SIZE', 2000))
+ROUTER_MIN_SCORE = float(os.environ.get('ROUTER_MIN_SCORE', 0.8))
+ROUTER_MARGIN = float(os.environ.get('ROUTER_MARGIN', 0.03))
+ROUTER_RETRY_INTERVAL = float(os.environ.get('ROUTER_RETRY_INTERVAL', 600))
+
+# slack: the answer is streamed into one message, the updates of all streams share the
+# chat.update rate limit (tier 3, ~50 per minute per workspace and app)
+SLACK_STREAMING = os.environ.get('SLACK_STREAMING', 'true').lower() in ('1', 'true', 'yes')
+SLACK_UPDATE_RATE = float(os.environ.get('SLACK_UPDATE_RATE', 45))
+SLACK_STREAM_INTERVAL = float(os.environ.get('SLACK_STREAM_INTERVAL', 60 / SLACK_UPDATE_RATE))
+
+# retrieval tool output: token budget of the packed context and the chunk overlap used by the ingester;
+# chunks are at most 2500 characters (~600 tokens), the budget fits the 5 documents selected by MMR
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', 3500))
+CHUNK_OVERLAP = 100
+
+# embedding cache (an empty EMBEDDING_CACHE_PATH disables the on-disk tier)
+EMBEDDING_CACHE_SIZE = int(os.environ.get('EMBEDDING_CACHE_SIZE', 10000))
+EMBEDDING_CACHE_TTL = float(os.environ.get('EMBEDDING_CACHE_TTL', 24*60*60))
+EMBEDDING_CACHE_PATH = os.environ.get('EMBEDDING_CACHE_PATH', CACHE_DIR+"embeddings.sqlite")
+EMBEDDING_CACHE_DISK_SIZE = int(os.environ.get('EMBEDDING_CACHE_DISK_SIZE', 200000))
+
+# ingestion: embedding requests are batched, bounded by texts and by tokens per request
+EMBEDDING_BATCH_SIZE = int(os.environ.get('EMBEDDING_BATCH_SIZE', 64))
+EMBEDDING_BATCH_TOKENS = int(os.environ.get('EMBEDDING_BATCH_TOKENS', 50000))
+# attempts per embedding request on rate limits and transient errors
+EMBEDDING_RETRY_ATTEMPTS = int(os.environ.get('EMBEDDING_RETRY_ATTEMPTS', 5))
+
+# ingestion: points are upserted in batches, flushed by size or by age (seconds)
+UPSERT_BATCH_SIZE = int(os.environ.get('UPSERT_BATCH_SIZE', 64))
+UPSERT_MAX_DELAY = float(os.environ.get('UPSERT_MAX_DELAY', 5))
+
+# ingestion pipeline: bounded queues between the stages, concurrency per stage
+INGEST_QUEUE_SIZE = int(os.environ.get('INGEST_QUEUE_SIZE', 32))
+INGEST_EXTRACT_CONCURRENCY = int(os.environ.get('INGEST_EXTRACT_CONCURRENCY', 8))
+INGEST_EMBED_CONCURRENCY = int(os.environ.get('INGEST_EMBED_CONCURRENCY', 2))
+INGEST_REPORT_INTERVAL = float(os.environ.get('INGEST_REPORT_INTERVAL', 10))
+
+# entities extracted at ingest time, keyed by (prompt template, model, chunk hash); empty path disables it
+EXTRACTION_CACHE_PATH = os.environ.get('EXTRACTION_CACHE_PATH', CACHE_DIR+"extractions.sqlite")
+
+# retrieval result cache, invalidated through per-collection generations
+RETRIEVAL_CACHE_SIZE = int(os.environ.get('RETRIEVAL_CACHE_SIZE', 1000))
+RETRIEVAL_CACHE_TTL = float(os.environ.get('RETRIEVAL_CACHE_TTL', 60*60))
+GENERATIONS_PATH = os.environ.get('GENERATIONS_PATH', CACHE_DIR+"generations.sqlite")
+
+# per-turn latency tracing (chrome trace events, one JSON object per line)
+TRACING_ENABLED = os.environ.get('TRACING_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+TRACE_DIR = os.environ.get('TRACE_DIR', "./data/traces/")
+TRACE_CHROME = os.environ.get('TRACE_CHROME', 'false').lower() in ('1', 'true', 'yes')
@@ -1,110 +1,167 @@
-from typing import Optional, Type, Any
+import logging
+from typing import Optional, Any, List
 
 from langchain.callbacks.manager import (
+    AsyncCallbackManagerForRetrieverRun,
     AsyncCallbackManagerForToolRun,
+    CallbackManagerForRetrieverRun,
     CallbackManagerForToolRun,
 )
 
-from qdrant_client import QdrantClient
-
 from langchain.tools import BaseTool
-from langchain.docstore.document import Document
-from openai import OpenAI
-
-import httpx
-import time
+from langchain_core.retrievers import BaseRetriever
 
 from conf.constants import *
-    
+from core.context_packer import pack_documents
+from core.embeddings import aembed, embed
+from core.prefetch import current_prefetch
+from core.retrieval_cache import retrieval_cache
+from core.tracing import span
+from core.vectorstores import get_vector_store
+
 import numpy as np
 
-from langchain_community.vectorstores.utils import maximal_marginal_relevance
+from core.mmr import maximal_marginal_relevance
 from langchain_core.documents import Document
-from langchain_core.embeddings import Embeddings
-from langchain_core.vectorstores import VectorStore
+
+logger = logging.getLogger(__name__)
 
 # ---
 
-def document_from_scored_point(        
-        scored_point: Any,
+def document_from_payload(        
+        payload: Any,
         content_payload_key: str,
         metadata_payload_key: str,
     ) -> Document:
         return Document(
-            page_content=scored_point.payload.get(content_payload_key),
-            metadata=scored_point.payload.get(metadata_payload_key) or {},
+            page_content=payload.get(content_payload_key),
+            metadata=payload.get(metadata_payload_key) or {},
         )
 
-def query_qdrant(embedding, top_k=5, collection_name="rhaetor.github.io_components"):
-    
-    results = create_qdrant_client().search(
-        collection_name=collection_name,
-        query_vector=(embedding),
-        with_payload=True,
-        with_vectors=True,
-        limit=top_k,
-    )
-    
-    return results
+def collections_of(tool):
+    """The collections a retrieval tool searches (none for other tools)."""
+    return getattr(tool, "collections", None) or (tool.metadata or {}).get("collections", [])
+
+def search_many(queries, with_payload=True):
+    return get_vector_store().search_many(queries, with_payload=with_payload)
+
+async def asearch_many(queries, with_payload=True):
+    return await get_vector_store().asearch_many(queries, with_payload=with_payload)
 
 def get_embedding(text, model="text-embedding-ada-002"):
-   start = time.time()
-   text = text.replace("\n", " ")
-   resp = create_openai_client().embeddings.create(input = [text], model=model)
-   print("Embedding ms: ", time.time() - start)
-   return resp.data[0].embedding
-
-def create_openai_client():
-    client = OpenAI(
-        timeout=httpx.Timeout(
-            10.0, read=8.0, write=3.0, connect=3.0
-            )
-    )
-    return client
-
-def create_qdrant_client(): 
-    client = QdrantClient(
-       QDRANT_URL,
-        api_key=QDRANT_KEY,
-    )
-    return client
-    
-def fetch_and_rerank(entities, collections):
+   return embed(text, model=model)
+
+async def aget_embedding(text, model="text-embedding-ada-002"):
+   return await aembed(text, model=model)
+
+def fetch_and_rerank(entities, collections, fetch_k=15, k=5, lambda_mult=0.85):
+
+    # repeated questions are served without reaching the vector store
+    cache_key = retrieval_cache.key(entities, collections, fetch_k, k, lambda_mult)
+    with span("retrieval_cache") as attrs:
+        cached, generation = retrieval_cache.get(cache_key)
+        attrs["hit"] = cached is not None
+    if cached is not None:
+        return cached
     
     # compute the query embedding
     embedding = get_embedding(text=entities)
 
-    # lookup across multiple vector store
-    results = []    
-    for name in collections:        
-        intermittent_results = query_qdrant(embedding=embedding, collection_name=name, top_k=15)
-        results.extend(intermittent_results)
+    # phase 1: ids, scores and vectors across multiple vector stores, batched and concurrently
+    # (or the candidates prefetched for the question of this turn, if the keywords are close to it)
+    prefetch = current_prefetch()
+    responses = prefetch.responses_for(embedding, collections, fetch_k) if prefetch else None
+    if responses is None:
+        responses = search_many([(name, embedding, fetch_k) for name in collections], with_payload=False)
+    candidates = candidates_of(collections, responses)
+    with span("mmr", candidates=len(candidates), k=k):
+        selected = rerank(embedding, candidates, k=k, lambda_mult=lambda_mult)
+
+    # phase 2: payloads for the MMR winners only
+    with span("fetch_payloads", points=len(selected)):
+        payloads = get_vector_store().retrieve_payloads(payload_requests(selected))
+
+    documents = to_documents(selected, payloads)
+    retrieval_cache.put(cache_key, documents, generation)
+    return documents
+
+async def afetch_and_rerank(entities, collections, fetch_k=15, k=5, lambda_mult=0.85):
+
+    # repeated questions are served without reaching the vector store
+    cache_key = retrieval_cache.key(entities, collections, fetch_k, k, lambda_mult)
+    with span("retrieval_cache") as attrs:
+        cached, generation = retrieval_cache.get(cache_key)
+        attrs["hit"] = cached is not None
+    if cached is not None:
+        return cached
 
-        
-    ## The MMR impl used with retriever(search_type='mmr')    
-    embeddings = [result.vector for result in results]
+    # compute the query embedding
+    embedding = await aget_embedding(text=entities)
+
+    # phase 1: ids, scores and vectors across multiple vector stores, batched and concurrently
+    # (or the candidates prefetched for the question of this turn, if the keywords are close to it)
+    prefetch = current_prefetch()
+    responses = await prefetch.aresponses_for(embedding, collections, fetch_k) if prefetch else None
+    if responses is None:
+        responses = await asearch_many([(name, embedding, fetch_k) for name in collections], with_payload=False)
+    candidates = candidates_of(collections, responses)
+    with span("mmr", candidates=len(candidates), k=k):
+        selected = rerank(embedding, candidates, k=k, lambda_mult=lambda_mult)
+
+    # phase 2: payloads for the MMR winners only
+    with span("fetch_payloads", points=len(selected)):
+        payloads = await get_vector_store().aretrieve_payloads(payload_requests(selected))
+
+    documents = to_documents(selected, payloads)
+    retrieval_cache.put(cache_key, documents, generation)
+    return documents
+
+def candidates_of(collections, responses):
+    """Flatten per-collection search responses into (collection, hit) pairs."""
+    return [
+        (name, hit)
+        for name, hits in zip(collections, responses)
+        for hit in hits
+    ]
+
+def rerank(embedding, candidates, k=5, lambda_mult=0.85):
+    if not candidates:
+        return []
+
+    ## vectorized MMR over a float32 matrix of the candidate vectors
+    embeddings = np.array([hit.vector for _, hit in candidates], dtype=np.float32)
     
     mmr_selected = maximal_marginal_relevance(
-            np.array(embedding), embeddings, k=5, lambda_mult=0.85
-        )
-    
-    mmr_results = [
-        (
-            document_from_scored_point(
-                scored_point=results[i], 
-                content_payload_key="page_content", 
-                metadata_payload_key="metadata"
-            ),
-            results[i].score,
+            np.array(embedding, dtype=np.float32), embeddings, k=k, lambda_mult=lambda_mult
         )
-        for i in mmr_selected
-    ]
     
+    return [candidates[i] for i in mmr_selected]
+
+def payload_requests(selected):
+    """One (collection, ids) request per collection of the selected hits."""
+    ids = {}
+    for name, hit in selected:
+        ids.setdefault(name, []).append(hit.id)
+    return list(ids.items())
+
+def to_documents(selected, payloads):
+    payload_by_id = {}
+    for name, response in zip([name for name, _ in payload_requests(selected)], payloads):
+        for point_id, payload in response.items():
+            payload_by_id[(name, str(point_id))] = payload
+
     response_documents = []
-    for i, article in enumerate(mmr_results):    
-        doc = article[0]
-        score = article[1]        
-        print(str(round(score, 3)), ": ", doc.metadata["page_number"])
+    for name, hit in selected:
+        payload = payload_by_id.get((name, str(hit.id)))
+        if payload is None:
+            # deleted in between the two phases
+            continue
+        doc = document_from_payload(
+            payload=payload, 
+            content_payload_key="page_content", 
+            metadata_payload_key="metadata"
+        )
+        logger.debug("%.3f: %s", hit.score, doc.metadata.get("page_number"))
         response_documents.append(doc)
     
     return response_documents
@@ -114,39 +171,62 @@ class QuarkusReferenceTool(BaseTool):
     name = "search_quarkus_reference"
     description = "Useful when you need to answer questions about specific Camel Components used with Camel Quarkus. Input should be a list of 5-8 keywords from the original question"
 
+    collections: List[str] = ["quarkus_reference_2", "rhaetor.github.io_components_2"]
+
     def _run(
         self, query: str, run_manager: Optional[CallbackManagerForToolRun] = None
     ) -> str:
         """Use the tool."""
-        response_content = []
-        docs = fetch_and_rerank(query, ["quarkus_reference_2", "rhaetor.github.io_components_2"])
-        response_content = [str(d) for d in docs]
-        return ' '.join(response_content)
+        docs = fetch_and_rerank(query, self.collections)
+        return pack_documents(docs)
 
     async def _arun(
         self, query: str, run_manager: Optional[AsyncCallbackManagerForToolRun] = None
     ) -> str:
         """Use the tool asynchronously."""
-        raise NotImplementedError("custom_search does not support async")
+        docs = await afetch_and_rerank(query, self.collections)
+        return pack_documents(docs)
 
 
 class CamelCoreTool(BaseTool):
     name = "search_camel_core"
     description = "Useful when you need to answer questions about enterprise integration patterns, languages or data formats in Camel, as well as the framework in general. Input should be a list of 5-8 keywords from the original question"
 
+    collections: List[str] = ["rhaetor.github.io_2", "rhaetor.github.io_components_2"]
+
     def _run(
         self, query: str, run_manager: Optional[CallbackManagerForToolRun] = None
     ) -> str:
         """Use the tool."""
-        response_content = []
-        docs = fetch_and_rerank(query, ["rhaetor.github.io_2", "rhaetor.github.io_components_2"])
-        response_content = [str(d) for d in docs]
-        return ' '.join(response_content)
+        docs = fetch_and_rerank(query, self.collections)
+        return pack_documents(docs)
 
     async def _arun(
         self, query: str, run_manager: Optional[AsyncCallbackManagerForToolRun] = None
     ) -> str:
         """Use the tool asynchronously."""
-        raise NotImplementedError("custom_search does not support async")
+        docs = await afetch_and_rerank(query, self.collections)
+        return pack_documents(docs)
+
 
+class CollectionRetriever(BaseRetriever):
+    """MMR retriever over one or more collections, backed by `fetch_and_rerank`."""
 
+    collections: List[str]
+    fetch_k: int = 15
+    k: int = 5
+    lambda_mult: float = 0.85
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return fetch_and_rerank(
+            query, self.collections, fetch_k=self.fetch_k, k=self.k, lambda_mult=self.lambda_mult
+        )
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return await afetch_and_rerank(
+            query, self.collections, fetch_k=self.fetch_k, k=self.k, lambda_mult=self.lambda_mult
+        )
@@ -2,6 +2,8 @@
 
 from __future__ import annotations
 
+import functools
+import threading
 from enum import Enum
 from typing import TYPE_CHECKING, Any, Dict, List, NamedTuple, Optional
 
@@ -228,9 +230,29 @@ class LLMThought:
         self._container.clear()
 
 
+def _in_script_context(method):
+    """
+        Attach the script context of the handler to the calling thread before writing.
+        The agent loop thread is shared by all sessions, so this is done per callback.
+    """
+    @functools.wraps(method)
+    def run(self, *args, **kwargs):
+        if self._script_run_ctx is not None:
+            from streamlit.runtime.scriptrunner import add_script_run_ctx
+
+            add_script_run_ctx(threading.current_thread(), self._script_run_ctx)
+        return method(self, *args, **kwargs)
+
+    return run
+
+
 class MyStreamlitCallbackHandler(BaseCallbackHandler):
     """A callback handler that writes to a Streamlit app."""
 
+    # on the async path, write from the thread of the event loop: the callbacks of a
+    # session can't interleave there, unlike in the executor threads
+    run_inline = True
+
     def __init__(
         self,
         parent_container: DeltaGenerator,
@@ -271,6 +293,11 @@ class MyStreamlitCallbackHandler(BaseCallbackHandler):
         self._collapse_completed_thoughts = collapse_completed_thoughts
         self._thought_labeler = thought_labeler or LLMThoughtLabeler()
 
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+        # the session this handler writes to
+        self._script_run_ctx = get_script_run_ctx()
+
     def _require_current_thought(self) -> LLMThought:
         """Return our current LLMThought. Raise an error if we have no current
         thought.
@@ -331,6 +358,7 @@ class MyStreamlitCallbackHandler(BaseCallbackHandler):
                 self._history_container.append_copy(oldest_thought.container)                
             oldest_thought.clear()
 
+    @_in_script_context
     def on_llm_start(
         self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any
     ) -> None:
@@ -347,24 +375,29 @@ class MyStreamlitCallbackHandler(BaseCallbackHandler):
         # We don't prune_old_thought_containers here, because our container won't
         # be visible until it has a child.
 
+    @_in_script_context
     def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
         self._require_current_thought().on_llm_new_token(token, **kwargs)
         self._prune_old_thought_containers()
 
+    @_in_script_context
     def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
         self._require_current_thought().on_llm_end(response, **kwargs)
         self._prune_old_thought_containers()
 
+    @_in_script_context
     def on_llm_error(self, error: BaseException, **kwargs: Any) -> None:
         self._require_current_thought().on_llm_error(error, **kwargs)
         self._prune_old_thought_containers()
 
+    @_in_script_context
     def on_tool_start(
         self, serialized: Dict[str, Any], input_str: str, **kwargs: Any
     ) -> None:
         self._require_current_thought().on_tool_start(serialized, input_str, **kwargs)
         self._prune_old_thought_containers()
 
+    @_in_script_context
     def on_tool_end(
         self,
         output: str,
@@ -397,6 +430,7 @@ class MyStreamlitCallbackHandler(BaseCallbackHandler):
         )
         self._complete_current_thought()
 
+    @_in_script_context
     def on_tool_error(self, error: BaseException, **kwargs: Any) -> None:
         self._require_current_thought().on_tool_error(error, **kwargs)
         self._prune_old_thought_containers()
@@ -421,12 +455,14 @@ class MyStreamlitCallbackHandler(BaseCallbackHandler):
     def on_chain_error(self, error: BaseException, **kwargs: Any) -> None:
         pass
 
+    @_in_script_context
     def on_agent_action(
         self, action: AgentAction, color: Optional[str] = None, **kwargs: Any
     ) -> Any:
         self._require_current_thought().on_agent_action(action, color, **kwargs)
         self._prune_old_thought_containers()
 
+    @_in_script_context
     def on_agent_finish(
         self, finish: AgentFinish, color: Optional[str] = None, **kwargs: Any
     ) -> None:
@@ -1,114 +1,176 @@
+"""
+The assistant agent, its LLM and tools.
 
-__all__ = ['agent_executor', 'agent_llm', 'agent_memory'] 
+Nothing is constructed (or even imported from langchain) until the first
+call to `get_agent_executor()` / `get_agent_llm()`, so entry points that
+never run the agent do not pay for it. `agent_executor` and `agent_llm`
+are still available as module attributes and are built on first access.
+"""
 
-from langchain_openai.embeddings import OpenAIEmbeddings
-from langchain_openai.chat_models import ChatOpenAI
-from langchain.agents import OpenAIFunctionsAgent, AgentExecutor
+__all__ = ['get_agent_executor', 'get_agent_llm', 'create_agent_executor']
 
-from langchain.schema import SystemMessage
-from langchain.prompts import MessagesPlaceholder
+import threading
 
-from langchain.vectorstores import Qdrant
-from qdrant_client import QdrantClient
 from conf.constants import *
 
+# ---
 
-from langchain.tools import Tool
+SYSTEM_PROMPT = """
+        You are an assistant helping software developers develop applications using the Apache Camel framework. The framework is used to integrate systems.
+        Unless otherwise explicitly stated, it is probably fair to assume that questions are about Apache Camel.
 
+        You always request additional information using the functions provided before answering the original question.
 
-from core.CustomTools import QuarkusReferenceTool, CamelCoreTool
+        Please base your answer only on the search results and nothing else!
+        Very important! Your answer MUST be grounded in the search results provided.
+        Please explain why your answer is grounded in the search results!
 
+        If the user asks for an example, provide end-to-end code examples, for instance the full Java source for a Camel route, any required configuration settings and maven artefacts references.
+        Otherwise, respond by explaining key concepts based on the information provided in the context.
+        """
 
-def create_qdrant_client(): 
-    client = QdrantClient(
-       QDRANT_URL,
-        api_key=QDRANT_KEY,
-    )
-    return client
 
 def configure_retriever(collection_name):
-    
-    qdrant = Qdrant(
-        client=create_qdrant_client(), 
-        collection_name=collection_name, 
-        embeddings=OpenAIEmbeddings())
-    
-    retriever = qdrant.as_retriever(        
-        search_type="mmr",
-        search_kwargs={"fetch_k":15, "k": 5, "lambda_mult":0.85}
-        ) 
-        
+    from core.CustomTools import CollectionRetriever
+
+    # same search path (batched search, cached embeddings, MMR) as the custom tools
+    retriever = CollectionRetriever(
+        collections=[collection_name],
+        fetch_k=15, k=5, lambda_mult=0.85
+        )
+
     return retriever
 
 def create_lookup_tool(retriever, name, description):
+    from langchain.tools import Tool
+    from core.context_packer import pack_documents
+
+    # compact, token-budgeted context instead of the Document reprs
+    def lookup(query):
+        return pack_documents(retriever.get_relevant_documents(query))
+
+    async def alookup(query):
+        return pack_documents(await retriever.aget_relevant_documents(query))
+
     return Tool(
         name=name,
         description=description,
-        func=retriever.get_relevant_documents                       
+        func=lookup,
+        coroutine=alookup,
+        metadata={"collections": retriever.collections}
     )
 
-# tools offering access to explicit knowledge
-tooling_guide = create_lookup_tool(
-    configure_retriever("tooling_guide_2"),
-    "search_tooling_guide",
-    "Useful when you need to answer questions about tools (i.e. jbang, command line, maven plugins, vscode) for developing Camel applications. Input should be a list of 5-8 keywords from the original question",
-)
-
-spring_reference = create_lookup_tool(
-    configure_retriever("spring_reference_2"),
-    "search_spring_reference",
-    "Useful when you need to answer questions about specific Camel Components used within a Spring Boot Application. Input should be a list of 5-8 keywords from the original question",
-)
-
-spring_started_tool = create_lookup_tool(
-    configure_retriever("spring_get_started_2"),
-    "search_spring_getting_started",
-    "Useful when you need to answer questions about creating projects using Spring Boot and Camel. Input should be a list of 5-8 keywords from the original question",
-)
-
-quarkus_started_tool = create_lookup_tool(
-    configure_retriever("quarkus_getting_started_2"),
-    "search_quarkus_getting_started",
-    "Useful when you need to answer questions about creating projects with Quarkus and Camel. Input should be a list of 5-8 keywords from the original question",
-)
-
-tools = [CamelCoreTool(), tooling_guide, QuarkusReferenceTool(), quarkus_started_tool, spring_reference, spring_started_tool]
-
-# LLM instructions
-agent_llm = ChatOpenAI(temperature=0, streaming=True, model="gpt-3.5-turbo-1106")
-
-message = SystemMessage(
-    content=(
-        """
-        You are an assistant helping software developers develop applications using the Apache Camel framework. The framework is used to integrate systems.
-        Unless otherwise explicitly stated, it is probably fair to assume that questions are about Apache Camel.         
+def create_tools():
+    from core.CustomTools import QuarkusReferenceTool, CamelCoreTool
 
-        You always request additional information using the functions provided before answering the original question.        
+    # tools offering access to explicit knowledge
+    tooling_guide = create_lookup_tool(
+        configure_retriever("tooling_guide_2"),
+        "search_tooling_guide",
+        "Useful when you need to answer questions about tools (i.e. jbang, command line, maven plugins, vscode) for developing Camel applications. Input should be a list of 5-8 keywords from the original question",
+    )
 
-        Please base your answer only on the search results and nothing else!
-        Very important! Your answer MUST be grounded in the search results provided.
-        Please explain why your answer is grounded in the search results!
-        
-        If the user asks for an example, provide end-to-end code examples, for instance the full Java source for a Camel route, any required configuration settings and maven artefacts references.
-        Otherwise, respond by explaining key concepts based on the information provided in the context.
-        """       
+    spring_reference = create_lookup_tool(
+        configure_retriever("spring_reference_2"),
+        "search_spring_reference",
+        "Useful when you need to answer questions about specific Camel Components used within a Spring Boot Application. Input should be a list of 5-8 keywords from the original question",
+    )
+
+    spring_started_tool = create_lookup_tool(
+        configure_retriever("spring_get_started_2"),
+        "search_spring_getting_started",
+        "Useful when you need to answer questions about creating projects using Spring Boot and Camel. Input should be a list of 5-8 keywords from the original question",
     )
-)
-prompt = OpenAIFunctionsAgent.create_prompt(
-    system_message=message,
-    extra_prompt_messages=[MessagesPlaceholder(variable_name="history")],
-)
-agent = OpenAIFunctionsAgent(
-     llm=agent_llm, 
-     tools=tools, 
-     prompt=prompt
-     ) 
-
-agent_executor = AgentExecutor(
-    agent=agent,
-    tools=tools,
-    verbose=False,
-    return_intermediate_steps=True,
-    max_iterations=5,
-    early_stopping_method="generate",
-)
\ No newline at end of file
+
+    quarkus_started_tool = create_lookup_tool(
+        configure_retriever("quarkus_getting_started_2"),
+        "search_quarkus_getting_started",
+        "Useful when you need to answer questions about creating projects with Quarkus and Camel. Input should be a list of 5-8 keywords from the original question",
+    )
+
+    return [CamelCoreTool(), tooling_guide, QuarkusReferenceTool(), quarkus_started_tool, spring_reference, spring_started_tool]
+
+def tool_collections(tools):
+    """The collections searched by the tools, in order and without duplicates."""
+    from core.CustomTools import collections_of
+
+    collections = []
+    for tool in tools:
+        collections.extend(name for name in collections_of(tool) if name not in collections)
+    return collections
+
+def create_agent_llm():
+    from langchain_openai.chat_models import ChatOpenAI
+    from core.clients import AsyncChatCompletions, get_openai_http_client
+
+    # LLM instructions
+    llm = ChatOpenAI(
+        temperature=0, streaming=True, model="gpt-3.5-turbo-1106",
+        http_client=get_openai_http_client(), async_client=AsyncChatCompletions()
+    )
+    # same timeout on the async path as on the sync one
+    llm.async_client.timeout = llm.request_timeout
+    return llm
+
+def create_agent_executor(llm=None, tools=None, parallel_tool_calls=PARALLEL_TOOL_CALLS):
+    from langchain.agents import OpenAIFunctionsAgent
+    from langchain.schema import SystemMessage
+    from langchain.prompts import MessagesPlaceholder
+    from core.executor import AssistantAgentExecutor, create_tools_agent
+
+    llm = llm or get_agent_llm()
+    tools = tools or create_tools()
+
+    prompt = OpenAIFunctionsAgent.create_prompt(
+        system_message=SystemMessage(content=SYSTEM_PROMPT),
+        extra_prompt_messages=[MessagesPlaceholder(variable_name="history")],
+    )
+
+    if parallel_tool_calls:
+        # the model may request several lookups per step, they run concurrently
+        agent = create_tools_agent(llm, tools, prompt)
+    else:
+        agent = OpenAIFunctionsAgent(
+             llm=llm,
+             tools=tools,
+             prompt=prompt
+             )
+
+    return AssistantAgentExecutor(
+        agent=agent,
+        tools=tools,
+        prefetch_collections=tool_collections(tools),
+        verbose=False,
+        return_intermediate_steps=True,
+        max_iterations=5,
+        early_stopping_method="generate",
+    )
+
+# ---
+
+_lock = threading.RLock()
+_agent_llm = None
+_agent_executor = None
+
+def get_agent_llm():
+    global _agent_llm
+    with _lock:
+        if _agent_llm is None:
+            _agent_llm = create_agent_llm()
+        return _agent_llm
+
+def get_agent_executor():
+    """The process-wide agent executor (it is stateless, memory is passed per call)."""
+    global _agent_executor
+    with _lock:
+        if _agent_executor is None:
+            _agent_executor = create_agent_executor()
+        return _agent_executor
+
+def __getattr__(name):
+    # module attributes of earlier versions, constructed on first access
+    if name == "agent_executor":
+        return get_agent_executor()
+    if name == "agent_llm":
+        return get_agent_llm()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,194 @@
+"""Semantic cache of final agent answers.
+
+Near-duplicate first-turn questions ("how do I configure the Kafka
+component in Quarkus") are answered from earlier answers instead of
+running the agent loop. Entries are matched by the cosine similarity of
+the question embeddings and live in a sqlite file shared by the bot, the
+CLI and the web UI. Every entry remembers the generations of the
+collections its answer was grounded on; re-ingesting one of them
+(see `core/retrieval_cache.py`) invalidates the entry.
+"""
+
+import asyncio
+import json
+import threading
+import time
+from array import array
+
+import numpy as np
+
+from conf.constants import *
+from core.embeddings import aembed, embed, normalize_text
+from core.mmr import as_matrix, normalize_rows
+from core.retrieval_cache import generations
+from util.utils import connect_sqlite
+
+# ---
+
+
+class CachedAnswer:
+
+    def __init__(self, entry_id, question, answer, similarity):
+        self.entry_id = entry_id
+        self.question = question
+        self.answer = answer
+        self.similarity = similarity
+
+
+class AnswerCache:
+
+    def __init__(self, path=ANSWER_CACHE_PATH, similarity=ANSWER_CACHE_SIMILARITY,
+                 ttl=ANSWER_CACHE_TTL, max_entries=ANSWER_CACHE_SIZE, generation_store=generations):
+        self.path = path
+        self.similarity = similarity
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.generations = generation_store
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        self._lock = threading.Lock()
+        self._conn = None
+
+        # in-memory mirror of the table for the similarity search
+        self._state = None
+        self._ids = []
+        self._matrix = None
+
+    def _db(self):
+        if self._conn is None:
+            self._conn = connect_sqlite(self.path)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS answers (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    question TEXT NOT NULL,
+                    embedding BLOB NOT NULL,
+                    answer TEXT NOT NULL,
+                    collections TEXT NOT NULL,
+                    generations TEXT NOT NULL,
+                    created REAL NOT NULL
+                )
+                """)
+        return self._conn
+
+    def _refresh(self):
+        """Catch up with the table, other processes (and this one) add and delete entries."""
+        conn = self._db()
+        state = conn.execute("SELECT COUNT(*), MAX(id) FROM answers").fetchone()
+        if state == self._state:
+            return
+
+        # new entries are appended, only their embeddings are loaded
+        last_id = self._ids[-1] if self._ids else 0
+        rows = conn.execute("SELECT id, embedding FROM answers WHERE id > ? ORDER BY id", (last_id,)).fetchall()
+        if rows:
+            added = normalize_rows(as_matrix([array("f", row[1]) for row in rows]))
+            self._ids.extend(row[0] for row in rows)
+            self._matrix = added if self._matrix is None else np.vstack([self._matrix, added])
+
+        # entries deleted elsewhere (pruned, invalidated): drop their rows
+        if len(self._ids) != state[0]:
+            existing = {row[0] for row in conn.execute("SELECT id FROM answers")}
+            self._keep(existing)
+        self._state = state
+
+    def _keep(self, entry_ids):
+        keep = [i for i, entry_id in enumerate(self._ids) if entry_id in entry_ids]
+        self._ids = [self._ids[i] for i in keep]
+        self._matrix = self._matrix[keep] if keep else None
+
+    def _delete(self, entry_id):
+        conn = self._db()
+        conn.execute("DELETE FROM answers WHERE id=?", (entry_id,))
+        self._keep(set(self._ids) - {entry_id})
+        self._state = conn.execute("SELECT COUNT(*), MAX(id) FROM answers").fetchone()
+
+    def _find(self, question, embedding):
+        now = time.time()
+
+        with self._lock:
+            self._refresh()
+            if self._matrix is None:
+                self.misses += 1
+                return None
+
+            query = normalize_rows(as_matrix([embedding]))[0]
+            similarities = self._matrix @ query
+            candidates = [i for i in np.argsort(-similarities) if similarities[i] >= self.similarity]
+            entry_ids = [self._ids[i] for i in candidates]
+
+            # the best valid match, stale entries on the way are dropped
+            for i, entry_id in zip(candidates, entry_ids):
+                row = self._db().execute(
+                    "SELECT question, answer, collections, generations, created FROM answers WHERE id=?",
+                    (entry_id,)
+                ).fetchone()
+                if row is None:
+                    continue
+
+                cached_question, answer, collections, stored_generations, created = row
+                collections = json.loads(collections)
+                expired = self.ttl > 0 and now - created >= self.ttl
+                if expired or list(self.generations.get(collections)) != json.loads(stored_generations):
+                    self._delete(entry_id)
+                    self.invalidations += 1
+                    continue
+
+                self.hits += 1
+                return CachedAnswer(entry_id, cached_question, answer, float(similarities[i]))
+
+            self.misses += 1
+            return None
+
+    def lookup(self, question):
+        """The cached answer of the most similar earlier question, or None."""
+        question = normalize_text(question)
+        return self._find(question, embed(question))
+
+    async def alookup(self, question):
+        question = normalize_text(question)
+        embedding = await aembed(question)
+        # sqlite and the lock (shared with the pool threads) stay off the event loop
+        return await asyncio.to_thread(self._find, question, embedding)
+
+    def _insert(self, question, embedding, answer, collections):
+        with self._lock:
+            conn = self._db()
+            conn.execute(
+                "INSERT INTO answers (question, embedding, answer, collections, generations, created) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    question, array("f", embedding).tobytes(), answer,
+                    json.dumps(collections), json.dumps(list(self.generations.get(collections))), time.time()
+                )
+            )
+            conn.execute(
+                "DELETE FROM answers WHERE id IN (SELECT id FROM answers ORDER BY id DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def put(self, question, answer, collections):
+        """Remember an answer grounded on the given collections."""
+        question = normalize_text(question)
+        self._insert(question, embed(question), answer, sorted(set(collections)))
+
+    async def aput(self, question, answer, collections):
+        question = normalize_text(question)
+        embedding = await aembed(question)
+        await asyncio.to_thread(self._insert, question, embedding, answer, sorted(set(collections)))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._ids),
+        }
+
+
+# process-wide cache used by the agent executor
+answer_cache = AnswerCache()
@@ -0,0 +1,169 @@
+"""Batch mode of agent-cli: answers many prompts in one warm process.
+
+Prompts come from a directory of text files (`examples/`, `ragas_data/`)
+or a JSONL file and run concurrently on one event loop. Every result is
+appended to a JSONL report as soon as it is done (answer, tool calls,
+token usage, latency), the summary with throughput and latency
+percentiles is printed at the end.
+"""
+
+import asyncio
+import json
+import os
+import time
+
+import numpy as np
+
+from core.costs import CostCalcAsyncHandler, TokenCostProcess
+from core.tracing import TracingCallbackHandler
+
+# ---
+
+# separates the question from the reference answer in ragas_data/*.txt
+REFERENCE_SEPARATOR = "__###__"
+
+# keys of a JSONL line that may hold the prompt
+PROMPT_KEYS = ("prompt", "question", "input")
+
+
+class BatchPrompt:
+
+    def __init__(self, prompt_id, text, source, reference=None):
+        self.prompt_id = prompt_id
+        self.text = text
+        self.source = source
+        self.reference = reference
+
+
+def _file_order(name):
+    # 1.txt, 2.txt, ..., 10.txt
+    stem = os.path.splitext(name)[0]
+    return (0, int(stem), name) if stem.isdigit() else (1, 0, name)
+
+
+def load_prompts(path):
+    """Prompts of a directory (one per text file) or a JSONL file (one per line)."""
+    prompts = []
+
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path), key=_file_order):
+            file_path = os.path.join(path, name)
+            if name.startswith(".") or not os.path.isfile(file_path):
+                continue
+            with open(file_path) as f:
+                content = f.read()
+            text, _, reference = content.partition(REFERENCE_SEPARATOR)
+            prompts.append(BatchPrompt(
+                os.path.splitext(name)[0],
+                text.replace('\n', ' ').replace('\r', '').strip(),
+                file_path,
+                reference.strip() or None
+            ))
+        return prompts
+
+    with open(path) as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            text = next((record[key] for key in PROMPT_KEYS if record.get(key)), None)
+            if text is None:
+                print("Skipping line ", line_number, ": no prompt")
+                continue
+            prompts.append(BatchPrompt(
+                str(record.get("id", line_number)),
+                text,
+                path + ":" + str(line_number),
+                record.get("reference") or record.get("ground_truth")
+            ))
+    return prompts
+
+
+def tool_calls(intermediate_steps):
+    return [
+        {"tool": action.tool, "input": action.tool_input, "observation_chars": len(str(observation))}
+        for action, observation in intermediate_steps
+    ]
+
+
+async def answer_prompt(agent_executor, prompt, semaphore):
+    async with semaphore:
+        token_cost_process = TokenCostProcess()
+        result = {
+            "id": prompt.prompt_id,
+            "source": prompt.source,
+            "prompt": prompt.text,
+        }
+        if prompt.reference is not None:
+            result["reference"] = prompt.reference
+
+        start = time.perf_counter()
+        try:
+            response = await agent_executor.ainvoke(
+                {"input": prompt.text, "history": []},
+                {"callbacks": [CostCalcAsyncHandler(token_cost_process), TracingCallbackHandler("agent-cli")]},
+            )
+            result["answer"] = response["output"]
+            result["cached"] = bool(response.get("cached"))
+            result["tools"] = tool_calls(response.get("intermediate_steps", []))
+        except Exception as e:
+            result["error"] = str(e)
+
+        result["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        result["tokens"] = {
+            "prompt": token_cost_process.prompt_tokens,
+            "completion": token_cost_process.completion_tokens,
+            "total": token_cost_process.total_tokens,
+        }
+        result["cost_usd"] = token_cost_process.get_total_costs()
+        return result
+
+
+def summarize(results, elapsed):
+    latencies = [result["latency_ms"] for result in results if "error" not in result]
+    summary = {
+        "prompts": len(results),
+        "errors": sum(1 for result in results if "error" in result),
+        "cached": sum(1 for result in results if result.get("cached")),
+        "elapsed_s": round(elapsed, 2),
+        "throughput_per_min": round(len(results) / elapsed * 60, 2) if elapsed else 0.0,
+        "tokens": sum(result["tokens"]["total"] for result in results),
+        "cost_usd": round(sum(result["cost_usd"] for result in results), 5),
+    }
+    if latencies:
+        summary["latency_p50_ms"] = round(float(np.percentile(latencies, 50)), 1)
+        summary["latency_p95_ms"] = round(float(np.percentile(latencies, 95)), 1)
+        summary["latency_max_ms"] = max(latencies)
+    return summary
+
+
+async def run_batch(agent_executor, prompts, output_path, concurrency=4):
+    """Answer the prompts, append the results to output_path, return the summary."""
+    directory = os.path.dirname(output_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    results = []
+    start = time.perf_counter()
+
+    with open(output_path, "w") as out:
+        tasks = [asyncio.ensure_future(answer_prompt(agent_executor, prompt, semaphore)) for prompt in prompts]
+        for task in asyncio.as_completed(tasks):
+            result = await task
+            results.append(result)
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+
+            status = "failed: " + result["error"] if "error" in result else str(result["latency_ms"]) + " ms"
+            print(f"[{len(results)}/{len(prompts)}] {result['id']} {status}")
+
+    return summarize(results, time.perf_counter() - start)
+
+
+def print_summary(summary):
+    print("\nPrompts: ", summary["prompts"], " (errors: ", summary["errors"], ", cached: ", summary["cached"], ")")
+    print("Elapsed: ", summary["elapsed_s"], "s, throughput: ", summary["throughput_per_min"], " prompts/min")
+    if "latency_p50_ms" in summary:
+        print("Latency p50: ", summary["latency_p50_ms"], " ms, p95: ", summary["latency_p95_ms"], " ms, max: ", summary["latency_max_ms"], " ms")
+    print("Tokens: ", summary["tokens"], ", costs USD: ", format(summary["cost_usd"], '.5f'))
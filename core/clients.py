@@ -0,0 +1,206 @@
+"""Process-wide registry of pooled Qdrant and OpenAI clients.
+
+Every retrieval and ingestion path should obtain its clients from here
+instead of constructing new ones, so that TCP/TLS connections are kept
+alive and reused across tool calls.
+"""
+
+import asyncio
+import atexit
+import os
+import threading
+import weakref
+
+import httpx
+
+from conf.constants import *
+
+# ---
+
+_lock = threading.RLock()
+_clients = {}
+_owner_pid = os.getpid()
+
+# async clients are bound to the event loop that created them
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def _pool_limits(size):
+    return httpx.Limits(
+        max_connections=size,
+        max_keepalive_connections=size,
+        keepalive_expiry=CLIENT_KEEPALIVE_EXPIRY,
+    )
+
+
+def _registered(name, factory):
+    global _owner_pid
+
+    with _lock:
+        # pools inherited through fork() (i.e. the ingestion workers) must not be shared
+        if _owner_pid != os.getpid():
+            _clients.clear()
+            _owner_pid = os.getpid()
+
+        client = _clients.get(name)
+        if client is None:
+            client = factory()
+            _clients[name] = client
+        return client
+
+
+def _registered_async(name, factory):
+    loop = asyncio.get_running_loop()
+    with _lock:
+        clients = _async_clients.setdefault(loop, {})
+        client = clients.get(name)
+        if client is None:
+            client = factory()
+            clients[name] = client
+        return client
+
+
+def create_openai_http_client():
+    return httpx.Client(limits=_pool_limits(OPENAI_POOL_SIZE))
+
+
+# the SDKs are imported on first use, they dominate the import time of this module
+
+def create_openai_client(http_client=None):
+    from openai import OpenAI
+
+    client = OpenAI(
+        timeout=httpx.Timeout(
+            10.0, read=8.0, write=3.0, connect=3.0
+            ),
+        http_client=http_client
+    )
+    return client
+
+
+def create_qdrant_client():
+    from qdrant_client import QdrantClient
+
+    client = QdrantClient(
+        QDRANT_URL,
+        api_key=QDRANT_KEY,
+        prefer_grpc=QDRANT_PREFER_GRPC,
+        limits=_pool_limits(QDRANT_POOL_SIZE),
+    )
+    return client
+
+
+def create_async_openai_client():
+    from openai import AsyncOpenAI
+
+    client = AsyncOpenAI(
+        timeout=httpx.Timeout(
+            10.0, read=8.0, write=3.0, connect=3.0
+            ),
+        http_client=httpx.AsyncClient(limits=_pool_limits(OPENAI_POOL_SIZE))
+    )
+    return client
+
+
+def create_async_qdrant_client():
+    from qdrant_client import AsyncQdrantClient
+
+    client = AsyncQdrantClient(
+        QDRANT_URL,
+        api_key=QDRANT_KEY,
+        prefer_grpc=QDRANT_PREFER_GRPC,
+        limits=_pool_limits(QDRANT_POOL_SIZE),
+    )
+    return client
+
+
+def get_openai_http_client():
+    """The pooled transport shared by all OpenAI clients (incl. langchain's)."""
+    return _registered("openai_http", create_openai_http_client)
+
+
+def get_openai_client():
+    return _registered(
+        "openai",
+        lambda: create_openai_client(http_client=get_openai_http_client())
+    )
+
+
+def get_qdrant_client():
+    return _registered("qdrant", create_qdrant_client)
+
+
+def get_async_openai_client():
+    """Pooled async OpenAI client for the running event loop."""
+    return _registered_async("openai", create_async_openai_client)
+
+
+def get_async_qdrant_client():
+    """Pooled async Qdrant client for the running event loop."""
+    return _registered_async("qdrant", create_async_qdrant_client)
+
+
+_event_loop = None
+
+
+def get_event_loop():
+    """
+        The long-lived event loop the agents of the process (Slack bot, web UI) run on,
+        started on first use. Its async clients are kept for the life of the process.
+    """
+    global _event_loop
+    with _lock:
+        if _event_loop is None:
+            _event_loop = asyncio.new_event_loop()
+            threading.Thread(target=_event_loop.run_forever, name="agent-loop", daemon=True).start()
+        return _event_loop
+
+
+class AsyncChatCompletions:
+    """
+        Stands in for `AsyncOpenAI().chat.completions` in langchain's `ChatOpenAI`
+        (`async_client`): every call goes through the pooled async client of the
+        running event loop, so the model can be awaited from any loop.
+
+        The pooled client is tuned for embedding calls, a completion gets the
+        timeout of the model instead (None: the SDK default).
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+
+    async def create(self, **kwargs):
+        from openai import DEFAULT_TIMEOUT
+
+        kwargs.setdefault("timeout", DEFAULT_TIMEOUT if self.timeout is None else self.timeout)
+        return await get_async_openai_client().chat.completions.create(**kwargs)
+
+
+async def aclose_clients():
+    """Close the async clients that belong to the running event loop."""
+    with _lock:
+        clients = _async_clients.pop(asyncio.get_running_loop(), {})
+
+    for name, client in clients.items():
+        try:
+            await client.close()
+        except Exception as e:
+            print("Failed to close async client ", name, ": ", str(e))
+
+
+def close_clients():
+    """Close all pooled connections. Safe to call more than once."""
+    with _lock:
+        if _owner_pid != os.getpid():
+            _clients.clear()
+            return
+
+        for name, client in list(_clients.items()):
+            try:
+                client.close()
+            except Exception as e:
+                print("Failed to close client ", name, ": ", str(e))
+        _clients.clear()
+
+
+atexit.register(close_clients)
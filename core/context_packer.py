@@ -0,0 +1,97 @@
+"""Compact rendering of retrieved documents for the agent prompt.
+
+The retrieval tools used to return the `Document` reprs joined by spaces,
+including the quotes the ingester wraps around every page and the
+metadata (keywords, summaries) that only matter for the search itself.
+`pack_documents` renders the page content only, merges adjacent chunks
+of the same page (dropping the overlap the text splitter repeats between
+them) and stops at a token budget measured with tiktoken.
+"""
+
+import re
+
+from conf.constants import *
+from util.utils import get_encoding
+
+# ---
+
+CHUNK_SUFFIX = re.compile(r"^(.*)_(\d+)$")
+
+# chunks shorter than this are not worth starting once the budget is almost spent
+MIN_PARTIAL_TOKENS = 50
+
+
+def page_content(document):
+    """Page content without the quotes the ingester wraps around it."""
+    content = (document.page_content or "").strip()
+    if len(content) >= 2 and content[0] == '"' and content[-1] == '"':
+        content = content[1:-1].strip()
+    return content
+
+
+def split_page_number(page_number):
+    """'<page>_<chunk>' -> (page, chunk), unsplit pages -> (page, None)."""
+    page_number = str(page_number)
+    match = CHUNK_SUFFIX.match(page_number)
+    if match is None:
+        return page_number, None
+    return match[1], int(match[2])
+
+
+def overlap_length(previous, current, max_overlap=2*CHUNK_OVERLAP):
+    """Length of the longest suffix of `previous` that `current` starts with."""
+    limit = min(len(previous), len(current), max_overlap)
+    for length in range(limit, 0, -1):
+        if previous.endswith(current[:length]):
+            return length
+    return 0
+
+
+def merge_chunks(chunks):
+    """Join the (chunk index, text) pairs of one page, dropping repeated overlap."""
+    merged = []
+    previous_index = None
+    for index, text in sorted(chunks, key=lambda chunk: (chunk[0] is None, chunk[0] or 0)):
+        if merged and index is not None and previous_index is not None and index == previous_index + 1:
+            text = text[overlap_length(merged[-1], text):].lstrip()
+        if text:
+            merged.append(text)
+        previous_index = index
+    return "\n".join(merged)
+
+
+def group_by_page(documents):
+    """Sections of (page, text) in retrieval order, chunks of a page merged into one."""
+    pages = {}
+    for document in documents:
+        metadata = document.metadata or {}
+        page, chunk = split_page_number(metadata.get("page_number", ""))
+        chunks = pages.setdefault(page, [])
+        content = page_content(document)
+        if content and (chunk, content) not in chunks:
+            chunks.append((chunk, content))
+
+    return [(page, merge_chunks(chunks)) for page, chunks in pages.items() if chunks]
+
+
+def pack_documents(documents, token_budget=CONTEXT_TOKEN_BUDGET, model="gpt-3.5-turbo", encoding=None):
+    """
+        Render the documents as compact context of at most `token_budget` tokens.
+        Sections are added in retrieval order, the last one is cut at a token
+        boundary if there is enough budget left for it to be useful.
+    """
+    encoding = encoding or get_encoding(model)
+
+    sections = []
+    remaining = token_budget
+    for page, text in group_by_page(documents):
+        section = f"[{page}]\n{text}"
+        tokens = encoding.encode(section)
+        if len(tokens) > remaining:
+            if remaining >= MIN_PARTIAL_TOKENS:
+                sections.append(encoding.decode(tokens[:remaining]))
+            break
+        sections.append(section)
+        remaining -= len(tokens) + 1
+
+    return "\n\n".join(sections)
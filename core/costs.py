@@ -1,46 +1,79 @@
 # Inspired by https://raw.githubusercontent.com/langchain-ai/langchain/master/libs/community/langchain_community/callbacks/openai_info.py
 # Inspierd by https://github.com/langchain-ai/langchain/issues/3114
 
-from langchain.callbacks.base import AsyncCallbackHandler
+from langchain.callbacks.base import BaseCallbackHandler
 from langchain.schema import LLMResult
 from langchain_core.messages import BaseMessage
 from uuid import UUID
 from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence, TypeVar, Union
 
-import tiktoken
-
-MODEL_COST_PER_1K_TOKENS = {        
-    "prompt": 0.001,       
-    "completion": 0.002,
+import json
+import threading
+
+from util.utils import get_encoding, message_tokens
+
+# USD per 1K tokens, the longest matching prefix of the model name wins
+MODEL_COST_PER_1K_TOKENS = {
+    "gpt-3.5-turbo-1106": {"prompt": 0.001, "completion": 0.002},
+    "gpt-3.5-turbo-0125": {"prompt": 0.0005, "completion": 0.0015},
+    "gpt-3.5-turbo-16k": {"prompt": 0.003, "completion": 0.004},
+    "gpt-3.5-turbo-instruct": {"prompt": 0.0015, "completion": 0.002},
+    "gpt-3.5-turbo": {"prompt": 0.0015, "completion": 0.002},
+    "gpt-4-1106-preview": {"prompt": 0.01, "completion": 0.03},
+    "gpt-4-0125-preview": {"prompt": 0.01, "completion": 0.03},
+    "gpt-4-turbo": {"prompt": 0.01, "completion": 0.03},
+    "gpt-4-32k": {"prompt": 0.06, "completion": 0.12},
+    "gpt-4": {"prompt": 0.03, "completion": 0.06},
+    "text-embedding-ada-002": {"prompt": 0.0001, "completion": 0.0},
 }
 
+DEFAULT_MODEL = "gpt-3.5-turbo-1106"
+
+# every reply is primed with <im_start>assistant
+REPLY_PRIMING_TOKENS = 3
 
-class TokenCostProcess:
-    total_tokens: int = 0
-    prompt_tokens: int = 0
-    completion_tokens: int = 0
-    successful_requests: int = 0
 
-    def sum_prompt_tokens( self, tokens: int ):
-      self.prompt_tokens = self.prompt_tokens + tokens
-      self.total_tokens = self.total_tokens + tokens
+def model_cost(model: str) -> Dict[str, float]:
+    """Prices of the model, unknown models are priced like the default model."""
+    matches = [name for name in MODEL_COST_PER_1K_TOKENS if model.startswith(name)]
+    if not matches:
+        return MODEL_COST_PER_1K_TOKENS[DEFAULT_MODEL]
+    return MODEL_COST_PER_1K_TOKENS[max(matches, key=len)]
 
-    def sum_completion_tokens( self, tokens: int ):
-      self.completion_tokens = self.completion_tokens + tokens
-      self.total_tokens = self.total_tokens + tokens
 
-    def sum_successful_requests( self, requests: int ):
-      self.successful_requests = self.successful_requests + requests
+class TokenCostProcess:
+    """Thread-safe token and cost counters, of one conversation or the whole process."""
+
+    def __init__(self):
+        self.total_tokens = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.successful_requests = 0
+        # {model: [prompt_tokens, completion_tokens]}
+        self.models = {}
+        self._lock = threading.Lock()
+
+    def add_usage(self, model: str, prompt_tokens: int, completion_tokens: int, requests: int = 1):
+        with self._lock:
+            usage = self.models.setdefault(model, [0, 0])
+            usage[0] += prompt_tokens
+            usage[1] += completion_tokens
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.total_tokens += prompt_tokens + completion_tokens
+            self.successful_requests += requests
 
     def get_openai_total_cost_for_model( self, model: str ) -> float:
-       return MODEL_COST_PER_1K_TOKENS[model] * self.total_tokens / 1000
-    
-    def compute_costs(self) -> int:
-        prompt_costs = MODEL_COST_PER_1K_TOKENS["prompt"] * self.prompt_tokens / 1000
-        completion_costs = MODEL_COST_PER_1K_TOKENS["completion"] * self.completion_tokens / 1000
-        cost = prompt_costs+completion_costs
-        return cost
-    
+        with self._lock:
+            prompt_tokens, completion_tokens = self.models.get(model, (0, 0))
+        cost = model_cost(model)
+        return (cost["prompt"] * prompt_tokens + cost["completion"] * completion_tokens) / 1000
+
+    def compute_costs(self) -> float:
+        with self._lock:
+            models = list(self.models)
+        return sum(self.get_openai_total_cost_for_model(model) for model in models)
+
     def get_cost_summary(self) -> str:
 
         cost = self.compute_costs()
@@ -52,51 +85,45 @@ class TokenCostProcess:
             f"Successful Requests: {self.successful_requests}\n"
             f"Total Cost (USD): {cost}"
         )
-    
+
     def get_total_tokens(self):
-       return self.total_tokens
-    
+        return self.total_tokens
+
     def get_total_costs(self):
-       return self.compute_costs()
+        return self.compute_costs()
 
-class CostCalcAsyncHandler(AsyncCallbackHandler):
-    
-    model: str = ""
-    socketprint = None
-    websocketaction: str = "appendtext"
-    token_cost_process: TokenCostProcess
 
-    def __init__( self, token_cost_process ):
-       self.model = "gpt-3.5-turbo-1106"
-       self.token_cost_process = token_cost_process
+# all usage of the process, the per conversation counters add up here
+process_costs = TokenCostProcess()
 
-    def on_llm_start( self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any) -> None:
-       encoding = tiktoken.encoding_for_model( self.model )
 
-       if self.token_cost_process == None: return
+class CostCalcAsyncHandler(BaseCallbackHandler):
+    """
+        Records the token usage of every LLM call. The prompt is counted once when the
+        call starts, the completion once when it ends; the usage reported by the provider
+        replaces these counts when present (it is missing for streamed completions).
+        Nothing is done per streamed token. Runs inline, for both sync and async runs.
+        The usage is recorded in the given counters and in `process_costs`.
+    """
 
-       for prompt in prompts:
-          self.token_cost_process.sum_prompt_tokens( len(encoding.encode(prompt)) )
+    run_inline = True
 
-    async def on_llm_new_token(self, token: str, **kwargs) -> None:
-      self.token_cost_process.sum_completion_tokens( 1 )
+    def __init__( self, token_cost_process, model=DEFAULT_MODEL ):
+        self.model = model
+        self.token_cost_process = token_cost_process
+        # {run_id: (model, prompt_tokens)} of the running calls
+        self._runs = {}
 
-    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
-      self.token_cost_process.sum_successful_requests( 1 )
+    def _model(self, kwargs):
+        params = kwargs.get("invocation_params") or {}
+        return params.get("model") or params.get("model_name") or self.model
 
-    async def on_tool_end(
-        self,
-        output: str,
-        color: Optional[str] = None,
-        observation_prefix: Optional[str] = None,
-        llm_prefix: Optional[str] = None,
-        **kwargs: Any,
-    ) -> None:
-       
-        encoding = tiktoken.encoding_for_model( self.model )              
-        self.token_cost_process.sum_prompt_tokens( len(encoding.encode(output)) )
-        
-    async def on_chat_model_start(
+    def on_llm_start( self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any) -> None:
+        model = self._model(kwargs)
+        encoding = get_encoding(model)
+        self._runs[run_id] = (model, sum(len(encoding.encode(prompt)) for prompt in prompts))
+
+    def on_chat_model_start(
         self,
         serialized: Dict[str, Any],
         messages: List[List[BaseMessage]],
@@ -108,5 +135,51 @@ class CostCalcAsyncHandler(AsyncCallbackHandler):
         **kwargs: Any,
     ) -> Any:
         """Run when a chat model starts running."""
-        
-     
\ No newline at end of file
+        model = self._model(kwargs)
+        prompt_tokens = sum(
+            sum(message_tokens(message, model) for message in prompt) + REPLY_PRIMING_TOKENS
+            for prompt in messages
+        )
+        # the tool/function schemas are sent along with every prompt
+        params = kwargs.get("invocation_params") or {}
+        schemas = [params[key] for key in ("tools", "functions") if params.get(key)]
+        if schemas:
+            encoding = get_encoding(model)
+            prompt_tokens += len(messages) * sum(len(encoding.encode(json.dumps(schema))) for schema in schemas)
+        self._runs[run_id] = (model, prompt_tokens)
+
+    def _completion_tokens(self, response: LLMResult, model: str) -> int:
+        encoding = get_encoding(model)
+        tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                tokens += len(encoding.encode(generation.text))
+                message = getattr(generation, "message", None)
+                if message is None:
+                    continue
+                calls = message.additional_kwargs.get("tool_calls") or []
+                function_call = message.additional_kwargs.get("function_call")
+                if function_call:
+                    calls = calls + [{"function": function_call}]
+                for call in calls:
+                    function = call.get("function", {})
+                    tokens += len(encoding.encode(function.get("name", "") + function.get("arguments", "")))
+        return tokens
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        model, prompt_tokens = self._runs.pop(run_id, (self.model, 0))
+        llm_output = response.llm_output or {}
+        model = llm_output.get("model_name") or model
+
+        usage = llm_output.get("token_usage") or {}
+        if "prompt_tokens" in usage and "completion_tokens" in usage:
+            prompt_tokens, completion_tokens = usage["prompt_tokens"], usage["completion_tokens"]
+        else:
+            completion_tokens = self._completion_tokens(response, model)
+
+        if self.token_cost_process is not None and self.token_cost_process is not process_costs:
+            self.token_cost_process.add_usage(model, prompt_tokens, completion_tokens)
+        process_costs.add_usage(model, prompt_tokens, completion_tokens)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._runs.pop(run_id, None)
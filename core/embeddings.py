@@ -0,0 +1,287 @@
+"""Cached access to the OpenAI embeddings API.
+
+Embeddings are keyed by (model, normalized text) and kept in two tiers:
+a bounded in-memory LRU with a TTL and an optional sqlite file that can
+be shared by several processes (the bot, the CLI and the ingester).
+"""
+
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+from conf.constants import *
+from core.clients import get_async_openai_client, get_openai_client
+from core.tracing import span
+from util.utils import connect_sqlite, get_encoding
+
+# ---
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EMBEDDING_MODEL = "text-embedding-ada-002"
+
+
+def normalize_text(text):
+    return " ".join(text.split())
+
+
+def cache_key(model, text):
+    return hashlib.sha256((model + "\0" + text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+
+    def __init__(self, max_entries=EMBEDDING_CACHE_SIZE, ttl=EMBEDDING_CACHE_TTL,
+                 path=EMBEDDING_CACHE_PATH, max_disk_entries=EMBEDDING_CACHE_DISK_SIZE):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.max_disk_entries = max_disk_entries
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        # guards the memory tier and the counters, the disk tier has a connection per thread
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._disk_writes = 0
+
+    def _disk(self):
+        if not self.path:
+            return None
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect_sqlite(self.path)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    created REAL NOT NULL
+                )
+                """)
+            self._local.conn = conn
+        return conn
+
+    def _from_memory(self, key, now):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                vector, created = entry
+                if self.ttl <= 0 or now - created < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.memory_hits += 1
+                    return vector
+                del self._entries[key]
+        return None
+
+    def _from_disk(self, key, now):
+        conn = self._disk()
+        row = None
+        if conn is not None:
+            row = conn.execute("SELECT vector FROM embeddings WHERE key=?", (key,)).fetchone()
+
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.disk_hits += 1
+            vector = array("f", row[0]).tolist()
+            self._remember(key, vector, now)
+            return vector
+
+    def get(self, model, text):
+        key = cache_key(model, text)
+        now = time.time()
+
+        vector = self._from_memory(key, now)
+        if vector is None:
+            vector = self._from_disk(key, now)
+        return vector
+
+    async def aget_many(self, model, texts):
+        """Like `get` for many texts, the disk tier is read in a worker thread."""
+        keys = [cache_key(model, text) for text in texts]
+        now = time.time()
+
+        vectors = [self._from_memory(key, now) for key in keys]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            found = await asyncio.to_thread(lambda: [self._from_disk(keys[i], now) for i in missing])
+            for i, vector in zip(missing, found):
+                vectors[i] = vector
+        return vectors
+
+    def put(self, model, text, vector):
+        key = cache_key(model, text)
+        now = time.time()
+
+        with self._lock:
+            self._remember(key, vector, now)
+            self._disk_writes += 1
+            prune = self._disk_writes % 500 == 0
+
+        conn = self._disk()
+        if conn is not None:
+            conn.execute(
+                "INSERT OR REPLACE INTO embeddings (key, model, vector, created) VALUES (?, ?, ?, ?)",
+                (key, model, array("f", vector).tobytes(), now)
+            )
+
+            # keep the shared file bounded, checked every few hundred writes
+            if prune:
+                conn.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                    (self.max_disk_entries,)
+                )
+
+    async def aput_many(self, model, vectors):
+        """`put` of a {text: vector} dict, the disk tier is written in a worker thread."""
+        await asyncio.to_thread(lambda: [self.put(model, text, vector) for text, vector in vectors.items()])
+
+    def _remember(self, key, vector, created):
+        self._entries[key] = (vector, created)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+        }
+
+
+# process-wide cache used by every embedding call site
+embedding_cache = EmbeddingCache()
+
+
+def embed(text, model=DEFAULT_EMBEDDING_MODEL, openai_client=None):
+    return embed_many([text], model=model, openai_client=openai_client)[0]
+
+
+def embed_many(texts, model=DEFAULT_EMBEDDING_MODEL, openai_client=None):
+    texts = [normalize_text(text) for text in texts]
+    vectors = [embedding_cache.get(model, text) for text in texts]
+
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing:
+        unique = list(dict.fromkeys(texts[i] for i in missing))
+        client = openai_client or get_openai_client()
+        with span("embed", model=model, texts=len(unique)):
+            resp = client.embeddings.create(input=unique, model=model)
+
+        fetched = {text: data.embedding for text, data in zip(unique, resp.data)}
+        for text, vector in fetched.items():
+            embedding_cache.put(model, text, vector)
+        for i in missing:
+            vectors[i] = fetched[texts[i]]
+
+    return vectors
+
+
+def token_batches(texts, max_texts=EMBEDDING_BATCH_SIZE, max_tokens=EMBEDDING_BATCH_TOKENS, model=DEFAULT_EMBEDDING_MODEL):
+    """
+        Split the indices of the texts into batches of at most max_texts texts and max_tokens
+        tokens. A text that exceeds max_tokens on its own gets a batch of its own.
+    """
+    encoding = get_encoding(model)
+    batch, batch_tokens = [], 0
+    for i, text in enumerate(texts):
+        tokens = len(encoding.encode(text))
+        if batch and (len(batch) >= max_texts or batch_tokens + tokens > max_tokens):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+
+def is_transient(error):
+    """Rate limits, timeouts, dropped connections and server errors: worth retrying as is."""
+    import openai
+
+    return isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError))
+
+
+def is_input_error(error):
+    """The request was rejected because of its texts (i.e. one exceeds the context length)."""
+    import openai
+
+    return isinstance(error, (openai.BadRequestError, openai.UnprocessableEntityError))
+
+
+async def aembed_batched(texts, model=DEFAULT_EMBEDDING_MODEL,
+                         max_texts=EMBEDDING_BATCH_SIZE, max_tokens=EMBEDDING_BATCH_TOKENS,
+                         attempts=EMBEDDING_RETRY_ATTEMPTS, wait=wait_random_exponential(min=1, max=60)):
+    """
+        Embed many texts with as few requests as possible. Transient errors are retried
+        with backoff. A request rejected because of its input is split in halves and
+        retried, so only the texts that actually fail are left out (None).
+    """
+    vectors = [None] * len(texts)
+
+    async def request(indices):
+        async for attempt in AsyncRetrying(
+            retry=retry_if_exception(is_transient), wait=wait, stop=stop_after_attempt(attempts), reraise=True
+        ):
+            with attempt:
+                return await aembed_many([texts[i] for i in indices], model=model)
+
+    async def run(indices):
+        try:
+            batch = await request(indices)
+        except Exception as e:
+            if not is_input_error(e):
+                logger.error("Failed to embed %d texts: %s", len(indices), e)
+                return
+            if len(indices) == 1:
+                logger.warning("Dropped text %d, rejected by the embeddings API: %s", indices[0], e)
+                return
+            middle = len(indices) // 2
+            await run(indices[:middle])
+            await run(indices[middle:])
+            return
+        for i, vector in zip(indices, batch):
+            vectors[i] = vector
+
+    for indices in token_batches(texts, max_texts=max_texts, max_tokens=max_tokens, model=model):
+        await run(indices)
+    return vectors
+
+
+async def aembed(text, model=DEFAULT_EMBEDDING_MODEL):
+    return (await aembed_many([text], model=model))[0]
+
+
+async def aembed_many(texts, model=DEFAULT_EMBEDDING_MODEL):
+    texts = [normalize_text(text) for text in texts]
+    vectors = await embedding_cache.aget_many(model, texts)
+
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing:
+        unique = list(dict.fromkeys(texts[i] for i in missing))
+        with span("embed", model=model, texts=len(unique)):
+            resp = await get_async_openai_client().embeddings.create(input=unique, model=model)
+
+        fetched = {text: data.embedding for text, data in zip(unique, resp.data)}
+        await embedding_cache.aput_many(model, fetched)
+        for i in missing:
+            vectors[i] = fetched[texts[i]]
+
+    return vectors
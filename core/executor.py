@@ -0,0 +1,550 @@
+"""Agent executor that runs the tool calls of one step concurrently
+and prefetches retrieval results for the question (see core/prefetch.py).
+
+With parallel function calling the model can request several lookups in
+one step (i.e. the Quarkus reference and the core docs). The stock
+`AgentExecutor` runs them one after another; `AssistantAgentExecutor`
+submits them to a bounded pool and returns the observations in the order
+the model asked for them, so a step takes as long as its slowest tool.
+On the async path (`ainvoke`) the tool calls are gathered on the event
+loop instead.
+"""
+
+import asyncio
+import json
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple, Union
+
+from langchain.agents import AgentExecutor
+from langchain.agents.agent import ExceptionTool, RunnableMultiActionAgent
+from langchain.agents.format_scratchpad.openai_tools import format_to_openai_tool_messages
+from langchain.agents.output_parsers.openai_functions import OpenAIFunctionsAgentOutputParser
+from langchain.agents.output_parsers.openai_tools import OpenAIToolsAgentOutputParser, parse_ai_message_to_openai_tool_action
+from langchain.agents.tools import InvalidTool
+from langchain.callbacks.manager import AsyncCallbackManagerForChainRun, CallbackManagerForChainRun
+from langchain.tools.render import format_tool_to_openai_tool
+from langchain.utilities.asyncio import asyncio_timeout
+from langchain_core.agents import AgentAction, AgentFinish, AgentStep
+from langchain_core.exceptions import OutputParserException
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration
+from langchain_core.runnables import Runnable, RunnablePassthrough
+from langchain_core.tools import BaseTool
+from langchain_core.utils.input import get_color_mapping
+
+from conf.constants import *
+from core.answer_cache import answer_cache
+from core.CustomTools import collections_of
+from core.embeddings import aembed, embed, embedding_cache
+from core.prefetch import prefetch_stats, prefetching
+from core.retrieval_cache import retrieval_cache
+from core.router import get_router
+from core.tracing import current_trace, run_in_context, span
+
+# ---
+
+# shared by all executors of the process, bounds the concurrent tool calls
+tool_pool = ThreadPoolExecutor(max_workers=TOOL_CONCURRENCY, thread_name_prefix="tool")
+
+
+def in_caller_context(fn):
+    """
+        Wrap `fn` to run in a pool thread with the caller's context vars (trace spans)
+        and, in the web UI, the streamlit script context that callbacks write through.
+    """
+    fn = run_in_context(fn)
+    if "streamlit" not in sys.modules:
+        return fn
+
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+    script_run_ctx = get_script_run_ctx()
+    if script_run_ctx is None:
+        return fn
+
+    def run(*args, **kwargs):
+        add_script_run_ctx(threading.current_thread(), script_run_ctx)
+        return fn(*args, **kwargs)
+
+    return run
+
+
+class ToolsAgent(RunnableMultiActionAgent):
+    """Agent using parallel function calling (OpenAI tools), with support for early_stopping_method="generate"."""
+
+    final_answer: Runnable
+    """Same prompt without tools, forces an answer once the iteration limit is reached."""
+
+    def return_stopped_response(self, early_stopping_method, intermediate_steps, **kwargs):
+        if early_stopping_method != "generate":
+            return super().return_stopped_response(early_stopping_method, intermediate_steps, **kwargs)
+
+        agent_decision = self.final_answer.invoke({**kwargs, "intermediate_steps": intermediate_steps})
+        if isinstance(agent_decision, AgentFinish):
+            return agent_decision
+        raise ValueError(f"got tool calls with no tools provided: {agent_decision}")
+
+    async def areturn_stopped_response(self, early_stopping_method, intermediate_steps, callbacks=None, **kwargs):
+        if early_stopping_method != "generate":
+            return super().return_stopped_response(early_stopping_method, intermediate_steps, **kwargs)
+
+        agent_decision = await self.final_answer.ainvoke(
+            {**kwargs, "intermediate_steps": intermediate_steps},
+            {"callbacks": callbacks}
+        )
+        if isinstance(agent_decision, AgentFinish):
+            return agent_decision
+        raise ValueError(f"got tool calls with no tools provided: {agent_decision}")
+
+
+def create_tools_agent(llm, tools, prompt):
+    """Like langchain's `create_openai_tools_agent`, the prompt needs an `agent_scratchpad`."""
+    with_scratchpad = RunnablePassthrough.assign(
+        agent_scratchpad=lambda x: format_to_openai_tool_messages(x["intermediate_steps"])
+    )
+    llm_with_tools = llm.bind(tools=[format_tool_to_openai_tool(tool) for tool in tools])
+
+    return ToolsAgent(
+        runnable=with_scratchpad | prompt | llm_with_tools | OpenAIToolsAgentOutputParser(),
+        final_answer=with_scratchpad | prompt | llm | OpenAIToolsAgentOutputParser(),
+    )
+
+
+class AssistantAgentExecutor(AgentExecutor):
+
+    prefetch_collections: List[str] = []
+    """Collections searched speculatively for the question while the first LLM call runs."""
+
+    use_answer_cache: bool = ANSWER_CACHE_ENABLED
+    """Answer first-turn questions from the semantic answer cache."""
+
+    use_router: bool = ROUTER_ENABLED
+    """Let the embedding router pick the tools of the first step when it is confident."""
+
+    def _first_turn(self, inputs):
+        # follow-up questions depend on the conversation, only fresh questions are cached
+        history = inputs.get("history") or []
+        return self.use_answer_cache and not any(isinstance(message, HumanMessage) for message in history)
+
+    def _cached_outputs(self, cached):
+        stats = answer_cache.stats()
+        print(f"Answered from cache (similarity {cached.similarity:.3f}, hit rate {stats['hit_rate']:.0%})")
+        return {"output": cached.answer, "intermediate_steps": [], "cached": True}
+
+    def _report_stats(self):
+        """Process-wide cache and prefetch stats at the end of a turn, also added to its trace."""
+        stats = {
+            "embedding_cache": embedding_cache.stats(),
+            "retrieval_cache": retrieval_cache.stats(),
+            "prefetch": prefetch_stats.stats(),
+        }
+        trace = current_trace()
+        if trace is not None:
+            trace.stats.update(stats)
+        print(
+            f"Hit rates: embeddings {stats['embedding_cache']['hit_rate']:.0%}, "
+            f"retrieval {stats['retrieval_cache']['hit_rate']:.0%}, "
+            f"prefetch {stats['prefetch']['hit_rate']:.0%}"
+        )
+
+    def _answer_collections(self, outputs):
+        """Collections the answer is grounded on, answers without retrieval are not cached."""
+        tools = {tool.name: tool for tool in self.tools}
+        if "output" not in outputs:
+            return []
+        return [
+            name
+            for action, _ in outputs.get("intermediate_steps", [])
+            if action.tool in tools
+            for name in collections_of(tools[action.tool])
+        ]
+
+    def _remember_answer(self, question, outputs):
+        collections = self._answer_collections(outputs)
+        if not collections:
+            return
+        try:
+            answer_cache.put(question, outputs["output"], collections)
+        except Exception as e:
+            print("Failed to cache answer: ", str(e))
+
+    async def _aremember_answer(self, question, outputs):
+        collections = self._answer_collections(outputs)
+        if not collections:
+            return
+        try:
+            await answer_cache.aput(question, outputs["output"], collections)
+        except Exception as e:
+            print("Failed to cache answer: ", str(e))
+
+    def _call(
+        self, inputs: Dict[str, str], run_manager: Optional[CallbackManagerForChainRun] = None
+    ) -> Dict[str, Any]:
+        first_turn = self._first_turn(inputs)
+        if first_turn:
+            try:
+                with span("answer_cache", category="cache") as attrs:
+                    cached = answer_cache.lookup(inputs["input"])
+                    attrs["hit"] = cached is not None
+            except Exception as e:
+                print("Answer cache lookup failed: ", str(e))
+                cached = None
+            if cached is not None:
+                self._report_stats()
+                return self._cached_outputs(cached)
+
+        with prefetching(inputs.get("input"), self.prefetch_collections):
+            outputs = super()._call(inputs, run_manager=run_manager)
+
+        if first_turn:
+            self._remember_answer(inputs["input"], outputs)
+        self._report_stats()
+        return outputs
+
+    async def _acall(
+        self, inputs: Dict[str, str], run_manager: Optional[AsyncCallbackManagerForChainRun] = None
+    ) -> Dict[str, str]:
+        first_turn = self._first_turn(inputs)
+        if first_turn:
+            try:
+                with span("answer_cache", category="cache") as attrs:
+                    cached = await answer_cache.alookup(inputs["input"])
+                    attrs["hit"] = cached is not None
+            except Exception as e:
+                print("Answer cache lookup failed: ", str(e))
+                cached = None
+            if cached is not None:
+                self._report_stats()
+                return self._cached_outputs(cached)
+
+        with prefetching(inputs.get("input"), self.prefetch_collections):
+            outputs = await self._arun_loop(inputs, run_manager=run_manager)
+
+        if first_turn:
+            await self._aremember_answer(inputs["input"], outputs)
+        self._report_stats()
+        return outputs
+
+    async def _astopped_response(self, intermediate_steps, inputs, run_manager):
+        """The answer once the iteration or time limit is hit, awaited with the callbacks of the run."""
+        if isinstance(self.agent, ToolsAgent):
+            return await self.agent.areturn_stopped_response(
+                self.early_stopping_method,
+                intermediate_steps,
+                callbacks=run_manager.get_child() if run_manager else None,
+                **inputs
+            )
+        # the sync agents must not block the event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, run_in_context(
+            lambda: self.agent.return_stopped_response(self.early_stopping_method, intermediate_steps, **inputs)
+        ))
+
+    async def _arun_loop(
+        self, inputs: Dict[str, str], run_manager: Optional[AsyncCallbackManagerForChainRun] = None
+    ) -> Dict[str, Any]:
+        """
+            `AgentExecutor._acall`, with the stopped response awaited instead of invoked.
+            tests/test_executor.py fails when the upstream loop changes.
+        """
+        name_to_tool_map = {tool.name: tool for tool in self.tools}
+        color_mapping = get_color_mapping(
+            [tool.name for tool in self.tools], excluded_colors=["green"]
+        )
+        intermediate_steps: List[Tuple[AgentAction, str]] = []
+        iterations = 0
+        time_elapsed = 0.0
+        start_time = time.time()
+        try:
+            async with asyncio_timeout(self.max_execution_time):
+                while self._should_continue(iterations, time_elapsed):
+                    next_step_output = await self._atake_next_step(
+                        name_to_tool_map,
+                        color_mapping,
+                        inputs,
+                        intermediate_steps,
+                        run_manager=run_manager,
+                    )
+                    if isinstance(next_step_output, AgentFinish):
+                        return await self._areturn(next_step_output, intermediate_steps, run_manager=run_manager)
+
+                    intermediate_steps.extend(next_step_output)
+                    if len(next_step_output) == 1:
+                        # See if tool should return directly
+                        tool_return = self._get_tool_return(next_step_output[0])
+                        if tool_return is not None:
+                            return await self._areturn(tool_return, intermediate_steps, run_manager=run_manager)
+
+                    iterations += 1
+                    time_elapsed = time.time() - start_time
+        except (TimeoutError, asyncio.TimeoutError):
+            # stop early when interrupted by the async timeout
+            pass
+
+        output = await self._astopped_response(intermediate_steps, inputs, run_manager)
+        return await self._areturn(output, intermediate_steps, run_manager=run_manager)
+
+    def _tool_call_message(self, tool_names, question):
+        """The message the LLM would have answered with, calling the tools with the question."""
+        tools = {tool.name: tool for tool in self.tools}
+
+        def arguments(name):
+            tool = tools[name]
+            key = "__arg1" if tool.args_schema is None else next(iter(tool.args))
+            return json.dumps({key: question})
+
+        if isinstance(self.agent, ToolsAgent):
+            return AIMessage(content="", additional_kwargs={"tool_calls": [
+                {"id": "call_" + uuid.uuid4().hex[:24], "type": "function",
+                 "function": {"name": name, "arguments": arguments(name)}}
+                for name in tool_names
+            ]})
+        return AIMessage(content="", additional_kwargs={"function_call": {
+            "name": tool_names[0], "arguments": arguments(tool_names[0])
+        }})
+
+    def _routed_actions(self, inputs):
+        """Actions of the first step picked by the router, None to let the LLM decide."""
+        question = inputs.get("input")
+        router = get_router(self.prefetch_collections) if question else None
+        if router is None:
+            return None
+
+        try:
+            with span("route", category="router") as attrs:
+                tool_names = router.route(embed(question), {tool.name: collections_of(tool) for tool in self.tools})
+                attrs["tools"] = tool_names
+        except Exception as e:
+            print("Routing failed: ", str(e))
+            return None
+        return self._tool_call_actions(tool_names, question)
+
+    async def _arouted_actions(self, inputs):
+        question = inputs.get("input")
+        router = get_router(self.prefetch_collections) if question else None
+        if router is None:
+            return None
+
+        try:
+            with span("route", category="router") as attrs:
+                tool_names = router.route(await aembed(question), {tool.name: collections_of(tool) for tool in self.tools})
+                attrs["tools"] = tool_names
+        except Exception as e:
+            print("Routing failed: ", str(e))
+            return None
+        return self._tool_call_actions(tool_names, question)
+
+    def _tool_call_actions(self, tool_names, question):
+        if not tool_names:
+            return None
+        # the functions agent can only call one tool per step
+        if not isinstance(self.agent, ToolsAgent) and len(tool_names) > 1:
+            return None
+
+        print("Routed to ", tool_names)
+        message = self._tool_call_message(tool_names, question)
+        if isinstance(self.agent, ToolsAgent):
+            return parse_ai_message_to_openai_tool_action(message)
+        return [OpenAIFunctionsAgentOutputParser().parse_result([ChatGeneration(message=message)])]
+
+    def _parsing_error_action(self, e):
+        """Same handling of output parser errors as `AgentExecutor._iter_next_step`."""
+        if isinstance(self.handle_parsing_errors, bool):
+            raise_error = not self.handle_parsing_errors
+        else:
+            raise_error = False
+        if raise_error:
+            raise ValueError(
+                "An output parsing error occurred. "
+                "In order to pass this error back to the agent and have it try "
+                "again, pass `handle_parsing_errors=True` to the AgentExecutor. "
+                f"This is the error: {str(e)}"
+            )
+        text = str(e)
+        if isinstance(self.handle_parsing_errors, bool):
+            if e.send_to_llm:
+                observation = str(e.observation)
+                text = str(e.llm_output)
+            else:
+                observation = "Invalid or incomplete response"
+        elif isinstance(self.handle_parsing_errors, str):
+            observation = self.handle_parsing_errors
+        elif callable(self.handle_parsing_errors):
+            observation = self.handle_parsing_errors(e)
+        else:
+            raise ValueError("Got unexpected type of `handle_parsing_errors`")
+        return AgentAction("_Exception", observation, text)
+
+    def _handle_parsing_error(self, e, run_manager):
+        output = self._parsing_error_action(e)
+        if run_manager:
+            run_manager.on_agent_action(output, color="green")
+        tool_run_kwargs = self.agent.tool_run_logging_kwargs()
+        observation = ExceptionTool().run(
+            output.tool_input,
+            verbose=self.verbose,
+            color=None,
+            callbacks=run_manager.get_child() if run_manager else None,
+            **tool_run_kwargs,
+        )
+        return AgentStep(action=output, observation=observation)
+
+    async def _ahandle_parsing_error(self, e, run_manager):
+        output = self._parsing_error_action(e)
+        if run_manager:
+            await run_manager.on_agent_action(output, color="green")
+        tool_run_kwargs = self.agent.tool_run_logging_kwargs()
+        observation = await ExceptionTool().arun(
+            output.tool_input,
+            verbose=self.verbose,
+            color=None,
+            callbacks=run_manager.get_child() if run_manager else None,
+            **tool_run_kwargs,
+        )
+        return AgentStep(action=output, observation=observation)
+
+    def _run_tool(self, agent_action, name_to_tool_map, color_mapping, run_manager):
+        if run_manager:
+            run_manager.on_agent_action(agent_action, color="green")
+        tool_run_kwargs = self.agent.tool_run_logging_kwargs()
+        if agent_action.tool in name_to_tool_map:
+            tool = name_to_tool_map[agent_action.tool]
+            if tool.return_direct:
+                tool_run_kwargs["llm_prefix"] = ""
+            observation = tool.run(
+                agent_action.tool_input,
+                verbose=self.verbose,
+                color=color_mapping[agent_action.tool],
+                callbacks=run_manager.get_child() if run_manager else None,
+                **tool_run_kwargs,
+            )
+        else:
+            observation = InvalidTool().run(
+                {
+                    "requested_tool_name": agent_action.tool,
+                    "available_tool_names": list(name_to_tool_map.keys()),
+                },
+                verbose=self.verbose,
+                color=None,
+                callbacks=run_manager.get_child() if run_manager else None,
+                **tool_run_kwargs,
+            )
+        return AgentStep(action=agent_action, observation=observation)
+
+    def _iter_next_step(
+        self,
+        name_to_tool_map: Dict[str, BaseTool],
+        color_mapping: Dict[str, str],
+        inputs: Dict[str, str],
+        intermediate_steps: List[Tuple[AgentAction, str]],
+        run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> Iterator[Union[AgentFinish, AgentAction, AgentStep]]:
+        # the first step can skip the tool selection round-trip
+        output = self._routed_actions(inputs) if self.use_router and not intermediate_steps else None
+
+        if output is None:
+            try:
+                intermediate_steps = self._prepare_intermediate_steps(intermediate_steps)
+
+                # Call the LLM to see what to do.
+                output = self.agent.plan(
+                    intermediate_steps,
+                    callbacks=run_manager.get_child() if run_manager else None,
+                    **inputs,
+                )
+            except OutputParserException as e:
+                yield self._handle_parsing_error(e, run_manager)
+                return
+
+        if isinstance(output, AgentFinish):
+            yield output
+            return
+
+        actions = [output] if isinstance(output, AgentAction) else list(output)
+        for agent_action in actions:
+            yield agent_action
+
+        if len(actions) == 1:
+            yield self._run_tool(actions[0], name_to_tool_map, color_mapping, run_manager)
+            return
+
+        # independent lookups: run concurrently, report in the requested order
+        run_tool = in_caller_context(self._run_tool)
+        futures = [
+            tool_pool.submit(run_tool, agent_action, name_to_tool_map, color_mapping, run_manager)
+            for agent_action in actions
+        ]
+        for future in futures:
+            yield future.result()
+
+    async def _arun_tool(self, agent_action, name_to_tool_map, color_mapping, run_manager):
+        if run_manager:
+            await run_manager.on_agent_action(agent_action, color="green")
+        tool_run_kwargs = self.agent.tool_run_logging_kwargs()
+        if agent_action.tool in name_to_tool_map:
+            tool = name_to_tool_map[agent_action.tool]
+            if tool.return_direct:
+                tool_run_kwargs["llm_prefix"] = ""
+            observation = await tool.arun(
+                agent_action.tool_input,
+                verbose=self.verbose,
+                color=color_mapping[agent_action.tool],
+                callbacks=run_manager.get_child() if run_manager else None,
+                **tool_run_kwargs,
+            )
+        else:
+            observation = await InvalidTool().arun(
+                {
+                    "requested_tool_name": agent_action.tool,
+                    "available_tool_names": list(name_to_tool_map.keys()),
+                },
+                verbose=self.verbose,
+                color=None,
+                callbacks=run_manager.get_child() if run_manager else None,
+                **tool_run_kwargs,
+            )
+        return AgentStep(action=agent_action, observation=observation)
+
+    async def _aiter_next_step(
+        self,
+        name_to_tool_map: Dict[str, BaseTool],
+        color_mapping: Dict[str, str],
+        inputs: Dict[str, str],
+        intermediate_steps: List[Tuple[AgentAction, str]],
+        run_manager: Optional[AsyncCallbackManagerForChainRun] = None,
+    ) -> AsyncIterator[Union[AgentFinish, AgentAction, AgentStep]]:
+        output = await self._arouted_actions(inputs) if self.use_router and not intermediate_steps else None
+
+        if output is None:
+            try:
+                intermediate_steps = self._prepare_intermediate_steps(intermediate_steps)
+
+                # Call the LLM to see what to do.
+                output = await self.agent.aplan(
+                    intermediate_steps,
+                    callbacks=run_manager.get_child() if run_manager else None,
+                    **inputs,
+                )
+            except OutputParserException as e:
+                yield await self._ahandle_parsing_error(e, run_manager)
+                return
+
+        if isinstance(output, AgentFinish):
+            yield output
+            return
+
+        actions = [output] if isinstance(output, AgentAction) else list(output)
+        for agent_action in actions:
+            yield agent_action
+
+        # the async tools wait on the event loop, no pool thread is held
+        steps = await asyncio.gather(*[
+            self._arun_tool(agent_action, name_to_tool_map, color_mapping, run_manager)
+            for agent_action in actions
+        ])
+        for step in steps:
+            yield step
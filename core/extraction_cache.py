@@ -0,0 +1,158 @@
+"""Persistent cache of the entities extracted at ingest time.
+
+The entity extraction is the slowest and most expensive stage of the
+ingestion. Its results are kept in a sqlite file, keyed by the hash of
+the prompt template, the model and the hash of the chunk, so rebuilds
+and chunk size experiments only pay for the chunks they have not seen.
+Changing the prompt or the model misses the cache by construction.
+
+The cache can be exported to and imported from JSONL, to move it
+between machines:
+
+    python -m core.extraction_cache export extractions.jsonl
+    python -m core.extraction_cache import extractions.jsonl
+"""
+
+import argparse
+import hashlib
+import json
+import threading
+import time
+
+from conf.constants import *
+from util.utils import connect_sqlite
+
+# ---
+
+
+def template_hash(template):
+    return hashlib.sha256(template.encode("utf-8")).hexdigest()
+
+
+class ExtractionCache:
+
+    def __init__(self, path=EXTRACTION_CACHE_PATH):
+        self.path = path
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _db(self):
+        if not self.path:
+            return None
+        if self._conn is None:
+            self._conn = connect_sqlite(self.path)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS extractions (
+                    template_hash TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    chunk_hash TEXT NOT NULL,
+                    entities TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    PRIMARY KEY (template_hash, model, chunk_hash)
+                )
+                """)
+        return self._conn
+
+    def get(self, template, model, chunk_hash):
+        with self._lock:
+            conn = self._db()
+            row = None
+            if conn is not None:
+                row = conn.execute(
+                    "SELECT entities FROM extractions WHERE template_hash=? AND model=? AND chunk_hash=?",
+                    (template, model, chunk_hash)
+                ).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, template, model, chunk_hash, entities):
+        with self._lock:
+            conn = self._db()
+            if conn is not None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO extractions (template_hash, model, chunk_hash, entities, created) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (template, model, chunk_hash, entities, time.time())
+                )
+
+    def export(self, path):
+        """Write all entries to a JSONL file, returns the number of entries."""
+        with self._lock:
+            conn = self._db()
+            rows = [] if conn is None else conn.execute(
+                "SELECT template_hash, model, chunk_hash, entities, created FROM extractions ORDER BY created"
+            ).fetchall()
+
+        with open(path, "w") as f:
+            for template, model, chunk_hash, entities, created in rows:
+                f.write(json.dumps({
+                    "template_hash": template,
+                    "model": model,
+                    "chunk_hash": chunk_hash,
+                    "entities": entities,
+                    "created": created,
+                }) + "\n")
+        return len(rows)
+
+    def load(self, path):
+        """Add the entries of a JSONL export, existing entries are kept. Returns the number added."""
+        with open(path) as f:
+            rows = [
+                (record["template_hash"], record["model"], record["chunk_hash"], record["entities"],
+                 record.get("created", time.time()))
+                for record in map(json.loads, filter(str.strip, f))
+            ]
+
+        with self._lock:
+            conn = self._db()
+            if conn is None:
+                return 0
+            before = conn.execute("SELECT COUNT(*) FROM extractions").fetchone()[0]
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT OR IGNORE INTO extractions (template_hash, model, chunk_hash, entities, created) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            conn.execute("COMMIT")
+            return conn.execute("SELECT COUNT(*) FROM extractions").fetchone()[0] - before
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        with self._lock:
+            conn = self._db()
+            entries = 0 if conn is None else conn.execute("SELECT COUNT(*) FROM extractions").fetchone()[0]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+        }
+
+
+# process-wide cache used by the ingester
+extraction_cache = ExtractionCache()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export or import the entity extraction cache')
+    parser.add_argument('command', choices=['export', 'import', 'stats'])
+    parser.add_argument('file', nargs='?', help='The JSONL file')
+    args = parser.parse_args()
+
+    if args.command == "stats":
+        print(extraction_cache.stats())
+    elif args.file is None:
+        parser.error("a JSONL file is required")
+    elif args.command == "export":
+        print("Exported ", extraction_cache.export(args.file), " entries to ", args.file)
+    else:
+        print("Imported ", extraction_cache.load(args.file), " new entries from ", args.file)
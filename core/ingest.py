@@ -0,0 +1,389 @@
+"""Staged asyncio ingestion of text pages into a collection.
+
+    read -> split -> extract -> embed -> upsert
+
+The stages run on one event loop and are joined by bounded queues, so a
+slow stage (usually the entity extraction) makes the stages before it
+wait instead of piling up pages in memory. Every stage has its own
+concurrency limit: a single process keeps many extraction requests in
+flight, embeds in batches and writes through a `PointWriter`. Progress
+and throughput are reported every INGEST_REPORT_INTERVAL seconds.
+
+Point ids are derived from (collection, page_ref, chunk index) and every
+point stores the hash of its content. Given the points already stored, a
+refresh skips unchanged chunks before they reach the extraction, upserts
+new and changed chunks in place and deletes the chunks that are gone.
+Extracted entities are cached by chunk hash (see `core/extraction_cache.py`).
+"""
+
+import asyncio
+import hashlib
+import time
+import uuid
+
+from langchain_core.prompts import PromptTemplate
+from tenacity import (
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+from conf.constants import *
+from core.clients import get_async_openai_client
+from core.embeddings import aembed_batched, is_transient
+from core.extraction_cache import extraction_cache, template_hash
+from core.vectorstores import PointWriter, get_vector_store
+
+# ---
+
+PROMPT_TEMPLATE = PromptTemplate.from_template(
+        """
+        What are the top 20 entities mentioned in the given context?
+        Extract any part of the context AS IS that is relevant to answer the question.
+        At the end, provide a brief summary about the whole context.
+
+        > Context:
+        >>>
+        {text}
+        >>>
+
+        Exclude these entities in your response:
+        - Apache Camel
+        - Java
+        - Maven
+        - Red Hat
+
+        """
+    )
+
+EXTRACTION_MODEL = "gpt-3.5-turbo-1106"
+EXTRACTION_RETRY_ATTEMPTS = 5
+
+# part of the extraction cache key, a new prompt misses the cache
+PROMPT_TEMPLATE_HASH = template_hash(PROMPT_TEMPLATE.template)
+
+# pages longer than this are split into chunks
+SPLIT_THRESHOLD = 2500
+
+# namespace of the point ids, they must not change between runs
+POINT_ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "camel-quickstart-assistant/points")
+
+# closes a queue: every worker of the next stage puts it back for its siblings
+DONE = object()
+
+
+# extract keywords using the chat API with custom prompt,
+# retrying rate limits and transient errors with backoff
+@retry(
+    retry=retry_if_exception(is_transient),
+    wait=wait_random_exponential(min=10, max=60),
+    stop=stop_after_attempt(EXTRACTION_RETRY_ATTEMPTS),
+    reraise=True,
+)
+async def aextract_keywords(document, model=EXTRACTION_MODEL):
+    message = PROMPT_TEMPLATE.format(text=document)
+    response = await get_async_openai_client().chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": "You are a service used to extract entities from text"},
+                {"role": "user", "content": message}
+            ]
+        )
+    return response.choices[0].message.content
+
+
+async def aextract_entities(document, chunk_hash, model=EXTRACTION_MODEL, cache=extraction_cache):
+    """The entities of a chunk, extracted once per (prompt template, model, chunk hash)."""
+    entities = cache.get(PROMPT_TEMPLATE_HASH, model, chunk_hash)
+    if entities is None:
+        entities = await aextract_keywords(document, model=model)
+        cache.put(PROMPT_TEMPLATE_HASH, model, chunk_hash, entities)
+    return entities
+
+
+def split_page(page_ref, content, threshold=SPLIT_THRESHOLD, overlap=CHUNK_OVERLAP):
+    """(page_ref, content) of the chunks of a page, long pages get a chunk index suffix."""
+    if len(content) <= threshold:
+        return [(str(page_ref), content)]
+
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=threshold,
+        chunk_overlap=overlap
+    )
+    return [(str(page_ref) + "_" + str(i), chunk) for i, chunk in enumerate(text_splitter.split_text(content))]
+
+
+def point_id(collection_name, page_ref, chunk):
+    return str(uuid.uuid5(POINT_ID_NAMESPACE, f"{collection_name}/{page_ref}/{chunk}"))
+
+
+def content_hash(content):
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def stored_points(store, collection_name):
+    """{id: (page_ref, content_hash)} of the points of a collection, None for points without them."""
+    points = {}
+    for point in store.iter_points(
+        collection_name, with_vectors=False, with_payload=["metadata.page_ref", "metadata.content_hash"]
+    ):
+        metadata = (point.payload or {}).get("metadata", {})
+        points[str(point.id)] = (metadata.get("page_ref"), metadata.get("content_hash"))
+    return points
+
+
+def read_file(name):
+    with open(name) as f:
+        return f.read()
+
+
+async def collect(inbox, size, max_delay):
+    """
+        Up to size items of the queue, waiting at most max_delay seconds for more after
+        the first one. Returns (items, closed), closed once DONE was received.
+    """
+    loop = asyncio.get_running_loop()
+
+    item = await inbox.get()
+    if item is DONE:
+        return [], True
+    items = [item]
+
+    deadline = loop.time() + max_delay
+    while len(items) < size:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            item = await asyncio.wait_for(inbox.get(), timeout)
+        except asyncio.TimeoutError:
+            break
+        if item is DONE:
+            return items, True
+        items.append(item)
+    return items, False
+
+
+class IngestStats:
+
+    STAGES = ("read", "split", "extracted", "embedded", "upserted", "failed")
+
+    # outcomes of the chunks of a refresh
+    OUTCOMES = ("new", "changed", "unchanged", "deleted")
+
+    def __init__(self):
+        self.start = time.time()
+        self.counts = {stage: 0 for stage in self.STAGES + self.OUTCOMES}
+
+    def count(self, stage, n=1):
+        self.counts[stage] += n
+
+    def report(self, queues):
+        elapsed = time.time() - self.start
+        rate = self.counts["extracted"] / elapsed if elapsed else 0.0
+        print(
+            f"[{elapsed:6.0f}s] files {self.counts['read']}, chunks {self.counts['split']} "
+            f"({self.counts['unchanged']} unchanged), "
+            f"extracted {self.counts['extracted']} ({rate:.2f}/s), embedded {self.counts['embedded']}, "
+            f"upserted {self.counts['upserted']}, failed {self.counts['failed']} | queued: "
+            + ", ".join(f"{name} {queue.qsize()}" for name, queue in queues.items())
+        )
+
+    def refresh_report(self):
+        outcomes = ", ".join(f"{outcome} {self.counts[outcome]}" for outcome in self.OUTCOMES + ("failed",))
+        print("Refresh: " + outcomes)
+
+
+class IngestPipeline:
+    """
+        Ingests the given files. `known` are the stored points (see `stored_points`):
+        unchanged chunks are skipped, the stale chunks of the ingested pages are
+        deleted. With prune=True the files are the whole collection and all stored
+        points that were not seen are deleted.
+    """
+
+    def __init__(self, collection_name, filenames, page_ref_of, known=None, prune=False,
+                 extractors=INGEST_EXTRACT_CONCURRENCY, embedders=INGEST_EMBED_CONCURRENCY,
+                 embedding_batch=EMBEDDING_BATCH_SIZE, upsert_batch=UPSERT_BATCH_SIZE,
+                 queue_size=INGEST_QUEUE_SIZE, report_interval=INGEST_REPORT_INTERVAL, store=None):
+        self.collection_name = collection_name
+        self.filenames = filenames
+        self.page_ref_of = page_ref_of
+        self.known = known or {}
+        self.prune = prune
+        self.extractors = extractors
+        self.embedders = embedders
+        self.embedding_batch = embedding_batch
+        self.report_interval = report_interval
+
+        self.store = store or get_vector_store()
+        self.writer = PointWriter(collection_name, store=self.store, batch_size=upsert_batch)
+        self.stats = IngestStats()
+
+        # ids of the chunks of this run and of the points sent to the writer,
+        # pages that were read or failed to read
+        self.seen = set()
+        self.written = set()
+        self.pages = set()
+        self.unreadable = set()
+        self.deleted = set()
+
+        # the queue in front of each stage
+        self.queues = {
+            "split": asyncio.Queue(maxsize=queue_size),
+            "extract": asyncio.Queue(maxsize=queue_size),
+            "embed": asyncio.Queue(maxsize=queue_size),
+            "upsert": asyncio.Queue(maxsize=queue_size),
+        }
+
+    async def _read(self):
+        for name in self.filenames:
+            page_ref = str(self.page_ref_of(name))
+            try:
+                content = await asyncio.to_thread(read_file, name)
+            except Exception as e:
+                print("Failed to read file (skipping ... ): ", name, ": ", str(e))
+                self.stats.count("failed")
+                self.unreadable.add(page_ref)
+                continue
+            self.stats.count("read")
+            self.pages.add(page_ref)
+            await self.queues["split"].put((page_ref, content))
+
+    async def _split(self):
+        while (item := await self.queues["split"].get()) is not DONE:
+            page_ref, content = item
+            for chunk, (page_number, chunk_content) in enumerate(split_page(page_ref, content)):
+                self.stats.count("split")
+                chunk_id = point_id(self.collection_name, page_ref, chunk)
+                digest = content_hash(chunk_content)
+                self.seen.add(chunk_id)
+
+                stored = self.known.get(chunk_id)
+                if stored is not None and stored[1] == digest:
+                    self.stats.count("unchanged")
+                    continue
+                self.stats.count("new" if stored is None else "changed")
+                await self.queues["extract"].put((chunk_id, page_ref, page_number, chunk_content, digest))
+
+    async def _extract(self):
+        inbox = self.queues["extract"]
+        while (item := await inbox.get()) is not DONE:
+            page_content, digest = item[3], item[4]
+            try:
+                entities = await aextract_entities(page_content, digest)
+            except Exception as e:
+                print("Failed to call openai (skipping ... ): ", item[2])
+                print(e)
+                self.stats.count("failed")
+                continue
+            self.stats.count("extracted")
+            await self.queues["embed"].put(item + (entities,))
+        await inbox.put(DONE)
+
+    async def _embed(self):
+        inbox = self.queues["embed"]
+        closed = False
+        while not closed:
+            pages, closed = await collect(inbox, self.embedding_batch, max_delay=1.0)
+            if closed:
+                await inbox.put(DONE)
+            if not pages:
+                continue
+
+            vectors = await aembed_batched([page[-1] for page in pages], max_texts=self.embedding_batch)
+            for (chunk_id, page_ref, page_number, page_content, digest, entities), vector in zip(pages, vectors):
+                if vector is None:
+                    print("Failed to embed page (skipping ... ): ", page_number)
+                    self.stats.count("failed")
+                    continue
+                self.stats.count("embedded")
+                await self.queues["upsert"].put({
+                    "id": chunk_id,
+                    "vector": vector,
+                    "payload": {
+                        "page_content": "\"" + page_content + "\"",
+                        "metadata": {
+                            "page_number": page_number,
+                            "entities": entities,
+                            "page_ref": page_ref,
+                            "content_hash": digest
+                        }
+                    }
+                })
+
+    async def _upsert(self):
+        # a single writer, its batches are sent without waiting for them to be applied
+        # except the last one; batched here, so a batch is sent once it is full or its
+        # oldest point waited max_delay
+        closed = False
+        while not closed:
+            points, closed = await collect(self.queues["upsert"], self.writer.batch_size, self.writer.max_delay)
+            if not points:
+                continue
+            await asyncio.to_thread(self.writer.write, points, closed)
+            self.written.update(point["id"] for point in points)
+            self.stats.count("upserted", len(points))
+        return await asyncio.to_thread(self.writer.close)
+
+    def stale_ids(self):
+        """Stored points that are no longer part of the ingested pages (or the collection)."""
+        return [
+            stored_id for stored_id, (page_ref, _) in self.known.items()
+            if stored_id not in self.seen and page_ref not in self.unreadable
+            and (self.prune or page_ref in self.pages)
+        ]
+
+    async def _delete_stale(self):
+        stale = self.stale_ids()
+        if stale:
+            await asyncio.to_thread(self.store.delete, self.collection_name, stale)
+        self.deleted.update(stale)
+        self.stats.count("deleted", len(stale))
+
+    def expected_count(self):
+        """Points the collection should hold once the run is done."""
+        failed = {point["id"] for point in self.writer.failed_points}
+        return len((set(self.known) - self.deleted) | (self.written - failed))
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            self.stats.report(self.queues)
+
+    async def _stage(self, workers, inbox, outbox):
+        """Wait for the workers of a stage, then close the queue of the next one."""
+        await asyncio.gather(*workers)
+        # only the DONE put back by the last worker is left
+        while inbox is not None and not self.queues[inbox].empty():
+            self.queues[inbox].get_nowait()
+        await self.queues[outbox].put(DONE)
+
+    async def run(self):
+        """Ingest all files, returns the stats of the writer."""
+        reporter = asyncio.create_task(self._report())
+        upsert = asyncio.create_task(self._upsert())
+        try:
+            await asyncio.gather(
+                self._stage([self._read()], None, "split"),
+                self._stage([self._split()], "split", "extract"),
+                self._stage([self._extract() for _ in range(self.extractors)], "extract", "embed"),
+                self._stage([self._embed() for _ in range(self.embedders)], "embed", "upsert"),
+            )
+            writer_stats = await upsert
+            await self._delete_stale()
+        finally:
+            reporter.cancel()
+            upsert.cancel()
+
+        self.stats.report(self.queues)
+        self.stats.refresh_report()
+        cache = extraction_cache.stats()
+        print("Extraction cache: hits ", cache["hits"], ", misses ", cache["misses"],
+              ", hit rate ", format(cache["hit_rate"], '.2f'), ", entries ", cache["entries"])
+        for point in self.writer.failed_points:
+            print("Failed to upsert page: ", point["payload"]["metadata"]["page_number"])
+        return writer_stats
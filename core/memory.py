@@ -0,0 +1,95 @@
+"""Conversation memory of the assistant agent."""
+
+from collections import deque
+from typing import Any, Dict
+
+from langchain.agents.format_scratchpad.openai_functions import format_to_openai_function_messages
+from langchain.agents.format_scratchpad.openai_tools import format_to_openai_tool_messages
+from langchain.agents.openai_functions_agent.agent_token_buffer_memory import AgentTokenBufferMemory
+from langchain.agents.output_parsers.openai_tools import OpenAIToolAgentAction
+from langchain_core.messages import HumanMessage
+from langchain_core.pydantic_v1 import PrivateAttr
+
+from util.utils import message_tokens
+
+# ---
+
+# every reply is primed with <im_start>assistant
+REPLY_PRIMING_TOKENS = 3
+
+
+def format_steps(intermediate_steps):
+    """
+        Messages for the intermediate steps of a turn. Steps of the tools agent (parallel
+        calls) keep their tool call ids, steps of the functions agent become function messages.
+    """
+    if any(isinstance(action, OpenAIToolAgentAction) for action, _ in intermediate_steps):
+        return format_to_openai_tool_messages(intermediate_steps)
+    return format_to_openai_function_messages(intermediate_steps)
+
+
+class AgentMemory(AgentTokenBufferMemory):
+    """
+        `AgentTokenBufferMemory` that can store the steps of both agent types.
+
+        Token counts are kept per message together with a running total, so saving a
+        turn only counts the new messages instead of the whole buffer, and pruning drops
+        the oldest counts without measuring again. Whole turns are pruned: a tool
+        message without the message that called the tool is rejected by the API.
+    """
+
+    _token_counts: deque = PrivateAttr(default_factory=deque)
+    _token_total: int = PrivateAttr(default=0)
+    # first counted message, to notice a buffer that was replaced or pruned elsewhere
+    _head: Any = PrivateAttr(default=None)
+
+    def _count(self, message):
+        model = getattr(self.llm, "tiktoken_model_name", None) or getattr(self.llm, "model_name", None)
+        if model is None:
+            return self.llm.get_num_tokens_from_messages([message]) - REPLY_PRIMING_TOKENS
+        return message_tokens(message, model)
+
+    def _sync_token_counts(self):
+        """Count the messages added since the last call (e.g. directly to `chat_memory`)."""
+        messages = self.chat_memory.messages
+        counts = self._token_counts
+        if len(counts) > len(messages) or (counts and messages[0] is not self._head):
+            counts.clear()
+            self._token_total = 0
+
+        for message in messages[len(counts):]:
+            tokens = self._count(message)
+            counts.append(tokens)
+            self._token_total += tokens
+        self._head = messages[0] if messages else None
+
+    @property
+    def token_count(self) -> int:
+        """Tokens of the buffer as sent to the model."""
+        self._sync_token_counts()
+        return self._token_total + REPLY_PRIMING_TOKENS
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, Any]) -> None:
+        input_str, output_str = self._get_input_output(inputs, outputs)
+        self.chat_memory.add_user_message(input_str)
+        for msg in format_steps(outputs[self.intermediate_steps_key]):
+            self.chat_memory.add_message(msg)
+        self.chat_memory.add_ai_message(output_str)
+
+        # Prune buffer if it exceeds max token limit
+        self._sync_token_counts()
+        buffer = self.chat_memory.messages
+        counts = self._token_counts
+        pruned = 0
+        while counts and self._token_total + REPLY_PRIMING_TOKENS > self.max_token_limit:
+            self._token_total -= counts.popleft()
+            pruned += 1
+            # up to the start of the next turn
+            while counts and not isinstance(buffer[pruned], HumanMessage):
+                self._token_total -= counts.popleft()
+                pruned += 1
+
+        if pruned:
+            # in place, callers may hold on to the buffer
+            del buffer[:pruned]
+            self._head = buffer[0] if buffer else None
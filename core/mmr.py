@@ -0,0 +1,72 @@
+"""Maximal marginal relevance (MMR) on contiguous float32 matrices.
+
+Drop-in replacement for langchain's `maximal_marginal_relevance`. Norms
+are computed once up front and the redundancy term (the max similarity of
+each candidate to the already selected set) is updated incrementally with
+a single matrix-vector product per selection step, instead of recomputing
+the similarities against the whole selected set every time.
+"""
+
+from typing import List
+
+import numpy as np
+
+# ---
+
+
+def as_matrix(embedding_list):
+    """Contiguous float32 matrix of shape (n, dim)."""
+    return np.ascontiguousarray(np.asarray(embedding_list, dtype=np.float32))
+
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def maximal_marginal_relevance(query_embedding, embedding_list, lambda_mult=0.5, k=4) -> List[int]:
+    """Indices of the `k` candidates selected by MMR, in selection order."""
+    return maximal_marginal_relevance_batch(
+        [query_embedding], embedding_list, lambda_mult=lambda_mult, k=k
+    )[0]
+
+
+def maximal_marginal_relevance_batch(query_embeddings, embedding_list, lambda_mult=0.5, k=4) -> List[List[int]]:
+    """Run MMR for several queries against the same candidate set at once."""
+    candidates = as_matrix(embedding_list)
+    queries = as_matrix(query_embeddings)
+    if queries.ndim == 1:
+        queries = queries[None, :]
+
+    k = min(k, len(candidates))
+    if k <= 0 or len(queries) == 0:
+        return [[] for _ in range(len(queries))]
+
+    candidates = normalize_rows(candidates)
+    queries = normalize_rows(queries)
+
+    rows = np.arange(len(queries))
+
+    # (queries, candidates)
+    relevance = queries @ candidates.T
+    available = np.ones(relevance.shape, dtype=bool)
+
+    # the first pick is always the most similar candidate
+    picked = np.argmax(relevance, axis=1)
+    available[rows, picked] = False
+    redundancy = candidates[picked] @ candidates.T
+    selected = [picked]
+
+    relevance *= lambda_mult
+    while len(selected) < k:
+        scores = relevance - (1 - lambda_mult) * redundancy
+        scores[~available] = -np.inf
+
+        picked = np.argmax(scores, axis=1)
+        available[rows, picked] = False
+        selected.append(picked)
+
+        np.maximum(redundancy, candidates[picked] @ candidates.T, out=redundancy)
+
+    return np.stack(selected, axis=1).tolist()
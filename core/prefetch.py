@@ -0,0 +1,152 @@
+"""Speculative retrieval while the agent decides which tool to call.
+
+Nearly every turn starts with an LLM round-trip that only picks a tool.
+`prefetching(question, collections)` embeds the raw question and searches
+the collections of all tools in the background meanwhile. When a tool
+then searches with keywords whose embedding is close enough to the
+question's, `fetch_and_rerank` reranks the prefetched candidates instead
+of searching again.
+
+The prefetch of the running turn is held in a context variable, so it is
+visible to the tools (including the ones running in the tool pool) but
+not to other conversations.
+"""
+
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+
+from conf.constants import *
+from core.embeddings import embed
+from core.tracing import run_in_context, span
+from core.vectorstores import get_vector_store
+
+# ---
+
+# not the search pool: the prefetch itself fans out on that one
+prefetch_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="prefetch")
+
+_active_prefetch = contextvars.ContextVar("active_prefetch", default=None)
+
+
+def cosine_similarity(a, b):
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    norm = np.linalg.norm(a) * np.linalg.norm(b)
+    return float(a @ b / norm) if norm else 0.0
+
+
+class PrefetchStats:
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        # still queued when a tool needed it
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    def count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "failures": self.failures,
+            "skipped": self.skipped,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+prefetch_stats = PrefetchStats()
+
+
+class Prefetch:
+    """Embedding and search results of the question of one turn."""
+
+    def __init__(self, question, collections, fetch_k=PREFETCH_FETCH_K, similarity=PREFETCH_SIMILARITY):
+        self.question = question
+        self.collections = list(collections)
+        self.fetch_k = fetch_k
+        self.similarity = similarity
+        self.future = prefetch_pool.submit(run_in_context(self._run))
+
+    def _run(self):
+        with span("prefetch", collections=len(self.collections)):
+            embedding = embed(self.question)
+            responses = get_vector_store().search_many(
+                [(name, embedding, self.fetch_k) for name in self.collections], with_payload=False
+            )
+        return embedding, dict(zip(self.collections, responses))
+
+    def _match(self, result, embedding, collections, fetch_k):
+        if fetch_k > self.fetch_k or not set(collections) <= set(self.collections):
+            return None
+
+        prefetched_embedding, responses = result
+        if cosine_similarity(prefetched_embedding, embedding) < self.similarity:
+            prefetch_stats.count("misses")
+            return None
+
+        prefetch_stats.count("hits")
+        return [responses[name][:fetch_k] for name in collections]
+
+    def _cancel_queued(self):
+        """A prefetch that hasn't started yet is queued behind other turns, searching directly is faster."""
+        if self.future.cancel():
+            prefetch_stats.count("skipped")
+            return True
+        return False
+
+    def responses_for(self, embedding, collections, fetch_k):
+        """
+            Prefetched search responses for the collections, if the query is similar
+            enough to the question. Waits for a prefetch that is running, cancels one
+            that is still queued.
+        """
+        if self._cancel_queued():
+            return None
+        try:
+            result = self.future.result()
+        except Exception as e:
+            prefetch_stats.count("failures")
+            print("Prefetch failed: ", str(e))
+            return None
+        return self._match(result, embedding, collections, fetch_k)
+
+    async def aresponses_for(self, embedding, collections, fetch_k):
+        if self._cancel_queued():
+            return None
+        try:
+            result = await asyncio.wrap_future(self.future)
+        except Exception as e:
+            prefetch_stats.count("failures")
+            print("Prefetch failed: ", str(e))
+            return None
+        return self._match(result, embedding, collections, fetch_k)
+
+
+def current_prefetch():
+    return _active_prefetch.get()
+
+
+@contextmanager
+def prefetching(question, collections, enabled=PREFETCH_ENABLED):
+    """Start a prefetch for the question, visible to the code running in this block."""
+    if not enabled or not question or not collections:
+        yield None
+        return
+
+    prefetch = Prefetch(question, collections)
+    token = _active_prefetch.set(prefetch)
+    try:
+        yield prefetch
+    finally:
+        _active_prefetch.reset(token)
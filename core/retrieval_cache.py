@@ -0,0 +1,126 @@
+"""Cache of reranked retrieval results.
+
+Entries are keyed by (query, collections, fetch_k, k, lambda_mult) and
+remember the generation of every collection they were computed from.
+The ingester bumps a collection's generation whenever it (re-)writes it,
+which invalidates all cached results that touched that collection.
+Generations live in a small sqlite file shared by all local processes.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from conf.constants import *
+from core.embeddings import normalize_text
+from util.utils import connect_sqlite
+
+# ---
+
+
+class GenerationStore:
+
+    def __init__(self, path=GENERATIONS_PATH):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _db(self):
+        if self._conn is None:
+            self._conn = connect_sqlite(self.path)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS generations (
+                    collection TEXT PRIMARY KEY,
+                    generation INTEGER NOT NULL,
+                    updated REAL NOT NULL
+                )
+                """)
+        return self._conn
+
+    def get(self, collections):
+        """Current generation of each collection, in order."""
+        with self._lock:
+            placeholders = ",".join("?" * len(collections))
+            rows = self._db().execute(
+                f"SELECT collection, generation FROM generations WHERE collection IN ({placeholders})",
+                list(collections)
+            ).fetchall()
+        current = dict(rows)
+        return tuple(current.get(name, 0) for name in collections)
+
+    def bump(self, collection):
+        with self._lock:
+            self._db().execute(
+                """
+                INSERT INTO generations (collection, generation, updated) VALUES (?, 1, ?)
+                ON CONFLICT(collection) DO UPDATE SET generation=generation+1, updated=excluded.updated
+                """,
+                (collection, time.time())
+            )
+
+
+generations = GenerationStore()
+
+
+class RetrievalCache:
+
+    def __init__(self, max_entries=RETRIEVAL_CACHE_SIZE, ttl=RETRIEVAL_CACHE_TTL, generation_store=generations):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.generations = generation_store
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, query, collections, fetch_k, k, lambda_mult):
+        return (normalize_text(query), tuple(collections), fetch_k, k, lambda_mult)
+
+    def get(self, key):
+        """
+            Returns (documents, generation): documents is None on a miss, generation
+            is the current one of the key's collections, to be passed to `put`.
+        """
+        current = self.generations.get(key[1])
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None, current
+
+            documents, generation, created = entry
+            if generation != current or (self.ttl > 0 and now - created >= self.ttl):
+                del self._entries[key]
+                self.invalidations += 1
+                self.misses += 1
+                return None, current
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return list(documents), current
+
+    def put(self, key, documents, generation):
+        with self._lock:
+            self._entries[key] = (list(documents), generation, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+        }
+
+
+# process-wide cache shared by all retrieval tools
+retrieval_cache = RetrievalCache()
@@ -0,0 +1,206 @@
+"""Embedding based tool routing.
+
+The first LLM completion of a turn mostly just picks a retrieval tool.
+`CollectionRouter` keeps a few prototype vectors per collection (k-means
+over a sample of the stored vectors) and scores every tool by the
+similarity of the question to the prototypes of its collections. When
+the best tool wins by a clear margin, the executor calls it directly and
+the LLM is only asked once the search results are in.
+
+Prototypes are persisted to ROUTER_PATH together with the generations of
+the collections they were computed from, and recomputed in the
+background after a collection was re-ingested. Collections that are
+empty or fail to load are left out of the router; they are scanned again
+once ROUTER_RETRY_INTERVAL seconds have passed.
+"""
+
+import threading
+import time
+
+import numpy as np
+
+from conf.constants import *
+from core.mmr import as_matrix, normalize_rows
+from core.retrieval_cache import generations
+from core.vectorstores import get_vector_store
+
+# ---
+
+
+def kmeans(vectors, k, iterations=10, seed=42):
+    """Spherical k-means on normalized rows, returns k normalized centroids."""
+    if len(vectors) <= k:
+        return vectors
+
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=False)]
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        for i in range(k):
+            members = vectors[assignment == i]
+            if len(members):
+                centroids[i] = members.mean(axis=0)
+        centroids = normalize_rows(centroids)
+    return centroids
+
+
+def collection_prototypes(collection_name, k=ROUTER_PROTOTYPES, sample_size=ROUTER_SAMPLE_SIZE):
+    """Centroid plus k-means prototypes of (a sample of) the vectors of a collection."""
+    vectors = []
+    for point in get_vector_store().iter_points(collection_name, with_vectors=True, with_payload=False):
+        vectors.append(point.vector)
+        if len(vectors) >= sample_size:
+            break
+    if not vectors:
+        return None
+
+    vectors = normalize_rows(as_matrix(vectors))
+    centroid = normalize_rows(vectors.mean(axis=0, keepdims=True))
+    return np.vstack([centroid, kmeans(vectors, k)])
+
+
+class CollectionRouter:
+
+    def __init__(self, prototypes, collection_generations, unavailable=()):
+        # {collection: (n, dim) normalized matrix}
+        self.prototypes = prototypes
+        self.collection_generations = collection_generations
+        # collections that were empty or failed to load, they get no prototypes
+        self.unavailable = set(unavailable)
+
+    @classmethod
+    def build(cls, collections):
+        start = time.time()
+        current = generations.get(collections)
+        prototypes = {}
+        unavailable = set()
+        for name in collections:
+            try:
+                matrix = collection_prototypes(name)
+            except Exception as e:
+                print("Failed to build prototypes of ", name, ": ", str(e))
+                matrix = None
+            if matrix is None:
+                unavailable.add(name)
+            else:
+                prototypes[name] = matrix
+        print("Router built for ", len(prototypes), " collections in ", round(time.time() - start, 1), "s",
+              " (unavailable: " + ", ".join(sorted(unavailable)) + ")" if unavailable else "")
+        return cls(prototypes, dict(zip(collections, current)), unavailable)
+
+    @classmethod
+    def load(cls, path=ROUTER_PATH):
+        with np.load(path, allow_pickle=False) as data:
+            names = [str(name) for name in data["names"]]
+            stored = [int(generation) for generation in data["generations"]]
+            prototypes = {name: data["prototypes_" + str(i)] for i, name in enumerate(names)}
+            unavailable = [str(name) for name in data["unavailable"]] if "unavailable" in data else []
+            stored_unavailable = (
+                [int(generation) for generation in data["unavailable_generations"]] if unavailable else []
+            )
+        collection_generations = dict(zip(names, stored))
+        collection_generations.update(zip(unavailable, stored_unavailable))
+        return cls(prototypes, collection_generations, unavailable)
+
+    def save(self, path=ROUTER_PATH):
+        names = list(self.prototypes.keys())
+        unavailable = sorted(self.unavailable)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        np.savez(
+            path,
+            names=np.array(names),
+            generations=np.array([self.collection_generations.get(name, 0) for name in names]),
+            unavailable=np.array(unavailable, dtype=str),
+            unavailable_generations=np.array([self.collection_generations.get(name, 0) for name in unavailable], dtype=int),
+            **{"prototypes_" + str(i): self.prototypes[name] for i, name in enumerate(names)}
+        )
+
+    def is_current(self, collections):
+        """Built from the current generations of all collections, unavailable ones included."""
+        return (
+            set(collections) <= set(self.prototypes) | self.unavailable
+            and list(generations.get(collections)) == [self.collection_generations.get(name) for name in collections]
+        )
+
+    def scores(self, embedding, tool_collections):
+        """Score per tool: mean over its collections of the best prototype similarity."""
+        query = normalize_rows(as_matrix([embedding]))[0]
+        collection_scores = {
+            name: float(np.max(matrix @ query)) for name, matrix in self.prototypes.items()
+        }
+        return {
+            tool: float(np.mean([collection_scores.get(name, 0.0) for name in names]))
+            for tool, names in tool_collections.items()
+            if names
+        }
+
+    def route(self, embedding, tool_collections, min_score=ROUTER_MIN_SCORE, margin=ROUTER_MARGIN, max_tools=2):
+        """
+            The tools to call for the question, or None if the router is not confident.
+            Tools that tie with the best one (within margin/2) are called as well.
+        """
+        ranked = sorted(self.scores(embedding, tool_collections).items(), key=lambda item: item[1], reverse=True)
+        if not ranked or ranked[0][1] < min_score:
+            return None
+
+        best = ranked[0][1]
+        selected = [tool for tool, score in ranked if best - score <= margin / 2][:max_tools]
+        runner_up = next((score for tool, score in ranked if tool not in selected), None)
+        if runner_up is not None and best - runner_up < margin:
+            return None
+        return selected
+
+
+_router = None
+_building = False
+# the generations of the last build and when a build may be retried for them
+_attempted = None
+_retry_at = 0.0
+_router_lock = threading.Lock()
+
+
+def _build(collections, path, retry_interval):
+    global _router, _building, _retry_at
+    retry_at = time.time() + retry_interval
+    try:
+        router = CollectionRouter.build(collections)
+        router.save(path)
+        _router = router
+        if not router.unavailable:
+            retry_at = 0.0
+    except Exception as e:
+        print("Failed to build router: ", str(e))
+    finally:
+        with _router_lock:
+            _retry_at = retry_at
+            _building = False
+
+
+def get_router(collections, path=ROUTER_PATH, retry_interval=ROUTER_RETRY_INTERVAL):
+    """
+        The router for the collections if it is up to date, None otherwise. A missing or
+        stale router is (re-)built in the background, until then the LLM picks the tools.
+        A router without some collections (empty, failed) is used as is; it is rebuilt,
+        like a failed build, once retry_interval has passed.
+    """
+    global _router, _building, _attempted
+    with _router_lock:
+        if _router is None and os.path.exists(path):
+            try:
+                _router = CollectionRouter.load(path)
+            except Exception as e:
+                print("Failed to load router: ", str(e))
+
+        current = _router is not None and _router.is_current(collections)
+        if current and not _router.unavailable:
+            return _router
+
+        # a re-ingested collection is picked up right away, retries of the same state wait
+        attempt = (tuple(collections), tuple(generations.get(collections)))
+        if not _building and (attempt != _attempted or time.time() >= _retry_at):
+            _building = True
+            _attempted = attempt
+            threading.Thread(target=_build, args=(list(collections), path, retry_interval), daemon=True).start()
+        return _router if current else None
@@ -1,12 +1,16 @@
+import asyncio
 import os
-from core.agent import agent_executor, agent_llm
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from langchain.agents.openai_functions_agent.agent_token_buffer_memory import (
-    AgentTokenBufferMemory,
-)
+from conf.constants import *
+from core.agent import get_agent_executor, get_agent_llm
+from core.clients import get_event_loop
+from core.costs import CostCalcAsyncHandler, TokenCostProcess
+from core.tracing import TracingCallbackHandler
 
 from langchain.schema import messages_from_dict, messages_to_dict
-from langchain.memory.chat_message_histories.in_memory import ChatMessageHistory
 
 import datetime
 
@@ -14,7 +18,7 @@ from abc import ABC, abstractmethod
 from statemachine import State
 from statemachine import StateMachine
 
-from langchain.callbacks.base import AsyncCallbackHandler
+from langchain_core.callbacks import AsyncCallbackHandler, BaseCallbackHandler
 from langchain.schema import LLMResult
 from langchain_core.messages import BaseMessage
 from uuid import UUID
@@ -28,6 +32,10 @@ import json
 # the time in seconds, after which a conversation will be retried if inactive
 CONVERSATION_EXPIRY_TIME=120
 
+# blocking slack calls (streamed message updates, tool status, finished runs) stay off the event loop
+slack_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="slack")
+
+
 class StatusStrategy(ABC):
     @abstractmethod
     def print(self, message) -> str:
@@ -129,13 +137,20 @@ class Conversation(StateMachine):
         self.start_message = start_message
         
         # the main interface towards the LLM
-        self.agent = agent_executor
+        self.agent = get_agent_executor()
 
         # keeps track of previous messages
         self.memory = memory
 
+        # token usage of the conversation (the process totals are in core.costs.process_costs)
+        self.costs = TokenCostProcess()
+
         # interim, runtime states
         self.response_handle = None
+        self.answer_stream = None
+
+        # transitions come from the slack handlers and the slack_pool (agent done)
+        self.transition_lock = threading.RLock()
 
         super().__init__()
 
@@ -149,6 +164,14 @@ class Conversation(StateMachine):
         extracted_messages = self.memory.chat_memory.messages
         return messages_to_dict(extracted_messages)        
     
+    def ask(self, text):
+        """Start answering text, False if the previous question is still running."""
+        with self.transition_lock:
+            if not self.answered.is_active:
+                return False
+            self.inquire(text)
+            return True
+
     def is_expired(self):
         return self.last_activity < datetime.datetime.now()-datetime.timedelta(seconds=CONVERSATION_EXPIRY_TIME)
      
@@ -191,13 +214,26 @@ class Conversation(StateMachine):
         self.last_activity = datetime.datetime.now()
         self.feedback.set_tagline("Thinking ...")    
         
-        # request chat completion
-        try:
-            self.response_handle = self.agent(
+        callbacks = [self.callback_handler, CostCalcAsyncHandler(self.costs), TracingCallbackHandler("slack")]
+        self.answer_stream = None
+        if SLACK_STREAMING:
+            self.answer_stream = SlackAnswerStream(self.client, self.channel, self.thread_ts)
+            callbacks.append(self.answer_stream)
+
+        # request chat completion, on the shared event loop: the slack worker returns right away
+        future = asyncio.run_coroutine_threadsafe(
+            self.agent.ainvoke(
                 {"input": self.prompt_text, "history": self.memory.buffer},
-                callbacks=[self.callback_handler],
+                {"callbacks": callbacks},
                 include_run_info=True,
-            )
+            ),
+            get_event_loop()
+        )
+        future.add_done_callback(lambda f: slack_pool.submit(self.on_agent_done, f))
+
+    def on_agent_done(self, future):
+        try:
+            self.response_handle = future.result()
 
             self.memory.save_context({"input": self.prompt_text}, self.response_handle)
         except Exception as e:
@@ -209,9 +245,10 @@ class Conversation(StateMachine):
                 mrkdwn=True
             )    
         
-        self.resolved()
+        with self.transition_lock:
+            if self.running.is_active:
+                self.resolved()
 
-        
             
     # the assistant has resolved the question
     def on_enter_answered(self):
@@ -219,13 +256,15 @@ class Conversation(StateMachine):
         print("answered ..")
         response_content = self.response_handle["output"]
 
-        # question complete, show answer         
-        slack_response = self.client.chat_postMessage(
-            channel=self.channel, 
-            thread_ts=self.thread_ts,
-            text=f"{response_content}",
-            mrkdwn=True
-            )
+        # question complete, show answer (in place of the streamed one, if any)
+        stream, self.answer_stream = self.answer_stream, None
+        if stream is None or not stream.finish(response_content):
+            slack_response = self.client.chat_postMessage(
+                channel=self.channel, 
+                thread_ts=self.thread_ts,
+                text=f"{response_content}",
+                mrkdwn=True
+                )
                
         self.feedback.set_visible(False)
 
@@ -237,6 +276,7 @@ class Conversation(StateMachine):
         self.feedback.set_visible(True)        
 
     def on_enter_retired(self):
+        print("Conversation ", self.thread_ts, " retired. ", self.costs.get_cost_summary())
         self.feedback.set_tagline("Session expired.")  
         
 class SlackAsyncHandler(AsyncCallbackHandler):
@@ -268,7 +308,7 @@ class SlackAsyncHandler(AsyncCallbackHandler):
     ) -> None:
         """Run when tool starts running."""
         tool_name = serialized["name"]
-        self.feedback.print(tool_name + ": " + input_str)                
+        await asyncio.get_running_loop().run_in_executor(slack_pool, self.feedback.print, tool_name + ": " + input_str)
 
     async def on_tool_end(
         self,
@@ -296,6 +336,146 @@ class SlackAsyncHandler(AsyncCallbackHandler):
         print("chat model start")
         
 
+class RateLimiter:
+    """
+        Token bucket of a Slack method. The rate limits apply per method, workspace
+        and app, so one bucket is shared by all conversations of the process.
+    """
+
+    def __init__(self, per_minute, burst=3):
+        self.rate = per_minute / 60.0
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        # set after a 429, until the Retry-After has passed
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _wait(self, now):
+        """Seconds until a call may be made, takes the token when it is 0."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        self.tokens -= 1
+        return 0.0
+
+    def try_acquire(self):
+        with self._lock:
+            return self._wait(time.monotonic()) == 0.0
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                wait = self._wait(time.monotonic())
+            if wait == 0.0:
+                return
+            time.sleep(wait)
+
+    def back_off(self, seconds):
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+
+# chat.update calls of all streamed answers
+chat_update_limiter = RateLimiter(SLACK_UPDATE_RATE)
+
+
+class SlackAnswerStream(BaseCallbackHandler):
+    """
+        Streams the tokens of the answer into a single Slack message. The message is
+        posted with the first token and updated at most every SLACK_STREAM_INTERVAL
+        seconds, with one update in flight at a time. Updates are skipped while the
+        process-wide `chat_update_limiter` is exhausted, the final text always waits
+        for its turn. Completions that only call a tool have no content and don't show up.
+    """
+
+    run_inline = True
+
+    def __init__(self, slack_client, channel, thread_ts, interval=SLACK_STREAM_INTERVAL):
+        self.client = slack_client
+        self.channel = channel
+        self.thread_ts = thread_ts
+        self.interval = interval
+
+        # the message the answer is streamed into
+        self.ts = None
+        self.text = ""
+        self.run_id = None
+        self.last_update = 0.0
+        self._pending = None
+        self._lock = threading.Lock()
+
+    def _start(self, run_id):
+        # every completion replaces the text, the last one is the answer
+        with self._lock:
+            self.run_id = run_id
+            self.text = ""
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any) -> None:
+        self._start(run_id)
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[BaseMessage]], *, run_id: UUID, **kwargs: Any) -> None:
+        self._start(run_id)
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> None:
+        if not token:
+            return
+
+        with self._lock:
+            if run_id != self.run_id:
+                return
+            self.text += token
+
+            now = time.time()
+            if now - self.last_update < self.interval:
+                return
+            if self._pending is not None and not self._pending.done():
+                return
+            # the first send posts the message, only the updates count against chat.update
+            if self.ts is not None and not chat_update_limiter.try_acquire():
+                return
+            self.last_update = now
+            self._pending = slack_pool.submit(self._send, self.text)
+
+    def _send(self, text):
+        try:
+            if self.ts is None:
+                slack_response = self.client.chat_postMessage(
+                    channel=self.channel,
+                    thread_ts=self.thread_ts,
+                    text=text,
+                    mrkdwn=True
+                )
+                self.ts = slack_response["ts"]
+            else:
+                self.client.chat_update(channel=self.channel, ts=self.ts, text=text)
+        except Exception as e:
+            response = getattr(e, "response", None)
+            if response is not None and response.status_code == 429:
+                chat_update_limiter.back_off(float(response.headers.get("Retry-After", 1)))
+            print("Failed to stream answer: ", str(e))
+
+    def finish(self, text):
+        """Show the final text in the streamed message. False if nothing was streamed."""
+        with self._lock:
+            # late tokens are ignored from here on
+            self.run_id = None
+            pending = self._pending
+
+        if pending is not None:
+            pending.result()
+        if self.ts is None:
+            return False
+
+        chat_update_limiter.acquire()
+        self._send(text)
+        return True
+
+
 def save_session(conversation):
         
     json_export = json.dumps(conversation.export_memory())          
@@ -342,14 +522,15 @@ def restore_session(client, channel, thread_ts, owner):
         )   
         
         row = cur.fetchone()        
-        data = row[1]        
         cur.close()      
 
         if row is not None:            
-            message_import = messages_from_dict(data)
+            from langchain.memory.chat_message_histories.in_memory import ChatMessageHistory
+            from core.memory import AgentMemory
+
+            message_import = messages_from_dict(row[1])
             message_history = ChatMessageHistory(messages=message_import)
-            
-            restored_memory = AgentTokenBufferMemory(llm=agent_llm, chat_memory=message_history)
+            restored_memory = AgentMemory(llm=get_agent_llm(), chat_memory=message_history)
 
             conversation = Conversation(
                 owner=owner,
@@ -0,0 +1,223 @@
+"""Per-turn latency tracing.
+
+`TracingCallbackHandler` opens a trace when an agent run starts and records
+one span per LLM call and per tool call. Code running inside a traced turn
+(i.e. `fetch_and_rerank`) adds sub-spans through `span(...)`, which is a
+no-op outside of a trace. The root span of a turn carries the cache and
+prefetch stats of the process at the end of the turn.
+
+Spans are appended as Chrome trace events ("ph": "X") to TRACE_DIR/spans.jsonl,
+one JSON object per line. With TRACE_CHROME enabled each turn is also
+written as TRACE_DIR/trace-<id>.json, loadable in chrome://tracing or
+https://ui.perfetto.dev.
+"""
+
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import LLMResult
+
+from conf.constants import *
+
+# ---
+
+_active_trace = contextvars.ContextVar("active_trace", default=None)
+_active_span = contextvars.ContextVar("active_span", default=None)
+
+_write_lock = threading.Lock()
+
+
+def _new_id():
+    return uuid.uuid4().hex[:16]
+
+
+class Trace:
+
+    def __init__(self, name, attrs=None):
+        self.trace_id = _new_id()
+        self.name = name
+        self.attrs = attrs or {}
+        # process-wide cache stats at the end of the turn (see core/executor.py)
+        self.stats = {}
+        self.events = []
+        self._lock = threading.Lock()
+
+    def add(self, name, start, duration, span_id, parent_id, category, attrs):
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": int(start * 1e6),
+            "dur": int(duration * 1e6),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": {
+                "trace_id": self.trace_id,
+                "span_id": span_id,
+                "parent_id": parent_id,
+                **attrs,
+            },
+        }
+        with self._lock:
+            self.events.append(event)
+
+    def write(self, trace_dir=TRACE_DIR):
+        os.makedirs(trace_dir, exist_ok=True)
+        with self._lock:
+            events = sorted(self.events, key=lambda event: event["ts"])
+
+        with _write_lock:
+            with open(os.path.join(trace_dir, "spans.jsonl"), "a") as f:
+                for event in events:
+                    f.write(json.dumps(event, default=str) + "\n")
+
+        if TRACE_CHROME:
+            path = os.path.join(trace_dir, f"trace-{self.trace_id}.json")
+            with open(path, "w") as f:
+                json.dump({"traceEvents": events, "otherData": self.attrs}, f, default=str)
+
+
+def current_trace():
+    """The trace of the running turn, None outside of a trace."""
+    return _active_trace.get()
+
+
+@contextmanager
+def span(name, category="retrieval", **attrs):
+    """
+        Record a span inside the active trace. Yields a dict that can be used
+        to add attributes once they are known (i.e. result counts).
+    """
+    trace = _active_trace.get()
+    if trace is None:
+        yield attrs
+        return
+
+    span_id = _new_id()
+    parent_id = _active_span.get()
+    token = _active_span.set(span_id)
+    start_wall = time.time()
+    start = time.perf_counter()
+    try:
+        yield attrs
+    finally:
+        _active_span.reset(token)
+        trace.add(name, start_wall, time.perf_counter() - start, span_id, parent_id, category, attrs)
+
+
+def run_in_context(fn):
+    """Wrap `fn` so that it runs with the caller's trace context (i.e. in a thread pool)."""
+    context = contextvars.copy_context()
+    # a context can only be entered by one thread at a time, so every call gets its own copy
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """Records LLM and tool spans of an agent turn and writes the trace on completion."""
+
+    # callbacks must run in the caller's context so that tools see the trace
+    run_inline = True
+
+    def __init__(self, entry_point="agent", trace_dir=TRACE_DIR, enabled=TRACING_ENABLED):
+        self.enabled = enabled
+        self.entry_point = entry_point
+        self.trace_dir = trace_dir
+        self.trace = None
+        self._root_run_id = None
+        self._root_span_id = None
+        self._root_start = None
+        self._spans = {}
+
+    # -- bookkeeping
+
+    def _begin(self, run_id, name, category, attrs):
+        if self.trace is None:
+            return
+        span_id = _new_id()
+        self._spans[run_id] = (span_id, name, category, attrs, time.time(), time.perf_counter(), _active_span.get())
+        if category == "tool":
+            # retrieval spans recorded by the tool become children of the tool span
+            _active_span.set(span_id)
+
+    def _end(self, run_id, **attrs):
+        entry = self._spans.pop(run_id, None)
+        if entry is None:
+            return
+        span_id, name, category, start_attrs, start_wall, start, parent_id = entry
+        self.trace.add(name, start_wall, time.perf_counter() - start, span_id, parent_id, category, {**start_attrs, **attrs})
+        if category == "tool":
+            _active_span.set(parent_id)
+
+    # -- chain (the agent turn)
+
+    def on_chain_start(
+        self, serialized: Dict[str, Any], inputs: Dict[str, Any], *, run_id: UUID,
+        parent_run_id: Optional[UUID] = None, **kwargs: Any
+    ) -> Any:
+        if not self.enabled or parent_run_id is not None or self._root_run_id is not None:
+            return
+
+        self.trace = Trace(self.entry_point, {"input": str(inputs.get("input", ""))[:200]})
+        self._root_run_id = run_id
+        self._root_span_id = _new_id()
+        self._root_start = (time.time(), time.perf_counter())
+        _active_trace.set(self.trace)
+        _active_span.set(self._root_span_id)
+
+    def _finish_root(self, run_id, **attrs):
+        if run_id != self._root_run_id:
+            return
+        start_wall, start = self._root_start
+        self.trace.add(self.entry_point, start_wall, time.perf_counter() - start, self._root_span_id, None, "turn", {**attrs, **self.trace.stats})
+        try:
+            self.trace.write(self.trace_dir)
+        except Exception as e:
+            print("Failed to write trace: ", str(e))
+        _active_trace.set(None)
+        _active_span.set(None)
+        self._root_run_id = None
+
+    def on_chain_end(self, outputs: Dict[str, Any], *, run_id: UUID, **kwargs: Any) -> Any:
+        self._finish_root(run_id)
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> Any:
+        self._finish_root(run_id, error=repr(error))
+
+    # -- llm calls
+
+    def on_chat_model_start(
+        self, serialized: Dict[str, Any], messages: List[List[BaseMessage]], *, run_id: UUID, **kwargs: Any
+    ) -> Any:
+        model = (kwargs.get("invocation_params") or {}).get("model", "")
+        self._begin(run_id, "llm", "llm", {"model": model, "messages": sum(len(m) for m in messages)})
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any) -> Any:
+        self._begin(run_id, "llm", "llm", {})
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> Any:
+        self._end(run_id)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> Any:
+        self._end(run_id, error=repr(error))
+
+    # -- tool calls
+
+    def on_tool_start(
+        self, serialized: Dict[str, Any], input_str: str, *, run_id: UUID, **kwargs: Any
+    ) -> Any:
+        self._begin(run_id, serialized.get("name", "tool"), "tool", {"input": input_str})
+
+    def on_tool_end(self, output: str, *, run_id: UUID, **kwargs: Any) -> Any:
+        self._end(run_id, output_chars=len(str(output)))
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> Any:
+        self._end(run_id, error=repr(error))
@@ -0,0 +1,537 @@
+"""Vector store backends used by retrieval and ingestion.
+
+`QdrantBackend` talks to the (remote) Qdrant cluster, `LanceDBBackend`
+serves the same collections in-process from memory-mapped Lance files,
+which removes the network hop on single-node deployments. The backend is
+selected through VECTOR_BACKEND (qdrant|lancedb).
+
+Search results are `SearchHit`-like objects exposing `id`, `score`,
+`vector` and `payload` (qdrant's `ScoredPoint` already does).
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from conf.constants import *
+from core.clients import get_async_qdrant_client, get_qdrant_client
+from core.tracing import run_in_context, span
+
+# ---
+
+# bounded pool used to fan out the per-collection searches of a tool call
+search_pool = ThreadPoolExecutor(max_workers=SEARCH_CONCURRENCY, thread_name_prefix="search")
+
+
+class SearchHit(NamedTuple):
+    id: str
+    score: float
+    vector: Optional[List[float]]
+    payload: Optional[Dict[str, Any]]
+
+
+class VectorStoreBackend(ABC):
+
+    @abstractmethod
+    def search_many(self, queries, with_payload=True):
+        """
+            Run (collection, embedding, top_k) queries in as few requests as possible.
+            Returns one list of hits (with vectors) per query, in order.
+        """
+
+    async def asearch_many(self, queries, with_payload=True):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, run_in_context(lambda: self.search_many(queries, with_payload=with_payload)))
+
+    @abstractmethod
+    def retrieve_payloads(self, requests):
+        """
+            Fetch the payloads of (collection, ids) requests.
+            Returns one {id: payload} dict per request, in order.
+        """
+
+    async def aretrieve_payloads(self, requests):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, run_in_context(self.retrieve_payloads), requests)
+
+    @abstractmethod
+    def has_collection(self, collection_name):
+        pass
+
+    @abstractmethod
+    def recreate_collection(self, collection_name, vector_size=1536):
+        pass
+
+    @abstractmethod
+    def upsert(self, collection_name, points, wait=True):
+        """
+            Insert or replace points given as {"id", "vector", "payload"} dicts. With
+            wait=False the call may return before the points are searchable.
+        """
+
+    @abstractmethod
+    def delete(self, collection_name, ids):
+        """Remove the points with the given ids, applied before this returns."""
+
+    @abstractmethod
+    def count(self, collection_name):
+        """Exact number of points in a collection."""
+
+    @abstractmethod
+    def iter_points(self, collection_name, with_vectors=True, with_payload=True, batch_size=256):
+        """
+            Iterate over all points of a collection as `SearchHit`s (score 0).
+            `with_payload` may be a list of dotted payload keys
+            (e.g. "metadata.page_ref") to fetch only those fields.
+        """
+
+    def close(self):
+        pass
+
+
+class QdrantBackend(VectorStoreBackend):
+
+    def __init__(self):
+        # flipped once the server rejects the batch endpoint
+        self.batch_search_supported = True
+
+    def _search(self, collection_name, embedding, top_k, with_payload):
+        return get_qdrant_client().search(
+            collection_name=collection_name,
+            query_vector=(embedding),
+            with_payload=with_payload,
+            with_vectors=True,
+            limit=top_k,
+        )
+
+    async def _asearch(self, collection_name, embedding, top_k, with_payload):
+        return await get_async_qdrant_client().search(
+            collection_name=collection_name,
+            query_vector=(embedding),
+            with_payload=with_payload,
+            with_vectors=True,
+            limit=top_k,
+        )
+
+    def _search_requests(self, queries, with_payload):
+        from qdrant_client.http import models
+
+        return [
+            models.SearchRequest(vector=embedding, limit=top_k, with_payload=with_payload, with_vector=True)
+            for _, embedding, top_k in queries
+        ]
+
+    def _plan_searches(self, queries):
+        """
+            Group the queries into tasks: all queries against the same collection
+            share one search_batch request, everything else becomes a single search.
+        """
+        groups = {}
+        for i, query in enumerate(queries):
+            groups.setdefault(query[0], []).append(i)
+
+        tasks = []
+        for name, indices in groups.items():
+            if self.batch_search_supported and len(indices) > 1:
+                tasks.append((name, indices))
+            else:
+                tasks.extend((name, [i]) for i in indices)
+        return tasks
+
+    def _batch_not_supported(self, error):
+        from qdrant_client.http.exceptions import UnexpectedResponse
+
+        if isinstance(error, UnexpectedResponse) and error.status_code in (404, 405):
+            print("search_batch is not supported by the server, falling back to single searches")
+            self.batch_search_supported = False
+            return True
+        return False
+
+    def search_many(self, queries, with_payload=True):
+        results = [None] * len(queries)
+
+        def run(task):
+            name, indices = task
+            with span("search", collection=name, queries=len(indices)):
+                if len(indices) == 1:
+                    return [self._search(name, *queries[indices[0]][1:], with_payload)]
+                return get_qdrant_client().search_batch(
+                    collection_name=name,
+                    requests=self._search_requests([queries[i] for i in indices], with_payload),
+                )
+
+        tasks = self._plan_searches(queries)
+        retry = []
+        for task, future in [(task, search_pool.submit(run_in_context(run), task)) for task in tasks]:
+            try:
+                responses = future.result()
+            except Exception as e:
+                if not self._batch_not_supported(e):
+                    raise
+                retry.extend((task[0], [i]) for i in task[1])
+                continue
+            for i, response in zip(task[1], responses):
+                results[i] = response
+
+        # fallback: parallel single searches
+        retry_futures = [search_pool.submit(run_in_context(run), task) for task in retry]
+        for task, future in zip(retry, retry_futures):
+            results[task[1][0]] = future.result()[0]
+
+        return results
+
+    async def asearch_many(self, queries, with_payload=True):
+        results = [None] * len(queries)
+
+        async def run(task):
+            name, indices = task
+            with span("search", collection=name, queries=len(indices)):
+                if len(indices) == 1:
+                    return [await self._asearch(name, *queries[indices[0]][1:], with_payload)]
+                return await get_async_qdrant_client().search_batch(
+                    collection_name=name,
+                    requests=self._search_requests([queries[i] for i in indices], with_payload),
+                )
+
+        tasks = self._plan_searches(queries)
+        retry = []
+        responses = await asyncio.gather(*[run(task) for task in tasks], return_exceptions=True)
+        for task, response in zip(tasks, responses):
+            if isinstance(response, BaseException):
+                if not self._batch_not_supported(response):
+                    raise response
+                retry.extend((task[0], [i]) for i in task[1])
+                continue
+            for i, scored_points in zip(task[1], response):
+                results[i] = scored_points
+
+        # fallback: parallel single searches
+        for task, response in zip(retry, await asyncio.gather(*[run(task) for task in retry])):
+            results[task[1][0]] = response[0]
+
+        return results
+
+    def retrieve_payloads(self, requests):
+
+        def run(request):
+            name, ids = request
+            with span("retrieve", collection=name, ids=len(ids)):
+                records = get_qdrant_client().retrieve(
+                    collection_name=name, ids=ids, with_payload=True, with_vectors=False
+                )
+            return {str(record.id): record.payload for record in records}
+
+        if len(requests) == 1:
+            return [run(requests[0])]
+        futures = [search_pool.submit(run_in_context(run), request) for request in requests]
+        return [future.result() for future in futures]
+
+    async def aretrieve_payloads(self, requests):
+
+        async def run(request):
+            name, ids = request
+            with span("retrieve", collection=name, ids=len(ids)):
+                records = await get_async_qdrant_client().retrieve(
+                    collection_name=name, ids=ids, with_payload=True, with_vectors=False
+                )
+            return {str(record.id): record.payload for record in records}
+
+        return list(await asyncio.gather(*[run(request) for request in requests]))
+
+    def has_collection(self, collection_name):
+        collections = get_qdrant_client().get_collections().collections
+        return any(collection.name == collection_name for collection in collections)
+
+    def recreate_collection(self, collection_name, vector_size=1536):
+        from qdrant_client.http import models
+
+        get_qdrant_client().recreate_collection(
+            collection_name=collection_name,
+            vectors_config=models.VectorParams(
+                size=vector_size,  # Vector size is defined by OpenAI model
+                distance=models.Distance.COSINE,
+            ),
+        )
+
+    def upsert(self, collection_name, points, wait=True):
+        from qdrant_client.http import models
+
+        return get_qdrant_client().upsert(
+            collection_name=collection_name,
+            points=[
+                models.PointStruct(id=point["id"], vector=point["vector"], payload=point["payload"])
+                for point in points
+            ],
+            wait=wait,
+        )
+
+    def delete(self, collection_name, ids):
+        from qdrant_client.http import models
+
+        return get_qdrant_client().delete(
+            collection_name=collection_name,
+            points_selector=models.PointIdsList(points=list(ids)),
+            wait=True,
+        )
+
+    def count(self, collection_name):
+        return get_qdrant_client().count(collection_name=collection_name, exact=True).count
+
+    def iter_points(self, collection_name, with_vectors=True, with_payload=True, batch_size=256):
+        offset = None
+        while True:
+            records, offset = get_qdrant_client().scroll(
+                collection_name=collection_name,
+                limit=batch_size,
+                offset=offset,
+                with_payload=with_payload,
+                with_vectors=with_vectors,
+            )
+            for record in records:
+                yield SearchHit(id=str(record.id), score=0.0, vector=record.vector, payload=record.payload)
+            if offset is None:
+                break
+
+
+def select_payload(payload, keys):
+    """Keep only the dotted `keys` of a payload, like a qdrant include selector."""
+    selected = {}
+    for key in keys:
+        source, target = payload, selected
+        *parents, leaf = key.split(".")
+        for parent in parents:
+            source = source.get(parent) if isinstance(source, dict) else None
+            target = target.setdefault(parent, {})
+        if isinstance(source, dict) and leaf in source:
+            target[leaf] = source[leaf]
+    return selected
+
+
+class LanceDBBackend(VectorStoreBackend):
+    """
+        Embedded backend: one Lance table per collection with the columns
+        `id`, `vector` and `payload` (the qdrant payload as JSON).
+    """
+
+    def __init__(self, uri=LANCEDB_URI):
+        import lancedb
+
+        self.db = lancedb.connect(uri)
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def _table(self, collection_name):
+        with self._lock:
+            table = self._tables.get(collection_name)
+            if table is None:
+                table = self.db.open_table(collection_name)
+                self._tables[collection_name] = table
+            return table
+
+    def _hit(self, row, with_vectors=True, with_payload=True):
+        return SearchHit(
+            id=row["id"],
+            score=1.0 - row["_distance"] if "_distance" in row else 0.0,
+            vector=list(row["vector"]) if with_vectors else None,
+            payload=json.loads(row["payload"]) if with_payload else None,
+        )
+
+    def _id_filter(self, ids):
+        quoted = ",".join("'" + str(point_id).replace("'", "''") + "'" for point_id in ids)
+        return f"id IN ({quoted})"
+
+    def _search(self, collection_name, embedding, top_k, with_payload):
+        columns = ["id", "vector", "payload"] if with_payload else ["id", "vector"]
+        with span("search", collection=collection_name, queries=1):
+            rows = (
+                self._table(collection_name)
+                .search(embedding)
+                .metric("cosine")
+                .select(columns)
+                .limit(top_k)
+                .to_list()
+            )
+        return [self._hit(row, with_payload=with_payload) for row in rows]
+
+    def search_many(self, queries, with_payload=True):
+        if len(queries) == 1:
+            return [self._search(*queries[0], with_payload)]
+        search = run_in_context(lambda query: self._search(*query, with_payload))
+        futures = [search_pool.submit(search, query) for query in queries]
+        return [future.result() for future in futures]
+
+    def retrieve_payloads(self, requests):
+        responses = []
+        for name, ids in requests:
+            with span("retrieve", collection=name, ids=len(ids)):
+                rows = (
+                    self._table(name)
+                    .search()
+                    .where(self._id_filter(ids))
+                    .select(["id", "payload"])
+                    .limit(len(ids))
+                    .to_list()
+                )
+            responses.append({row["id"]: json.loads(row["payload"]) for row in rows})
+        return responses
+
+    def has_collection(self, collection_name):
+        return collection_name in self.db.table_names()
+
+    def recreate_collection(self, collection_name, vector_size=1536):
+        import pyarrow as pa
+
+        schema = pa.schema([
+            pa.field("id", pa.string()),
+            pa.field("vector", pa.list_(pa.float32(), vector_size)),
+            pa.field("payload", pa.string()),
+        ])
+        with self._lock:
+            self._tables[collection_name] = self.db.create_table(collection_name, schema=schema, mode="overwrite")
+
+    def upsert(self, collection_name, points, wait=True):
+        # embedded: the write is applied before this returns
+        rows = [
+            {"id": str(point["id"]), "vector": point["vector"], "payload": json.dumps(point["payload"])}
+            for point in points
+        ]
+        (
+            self._table(collection_name)
+            .merge_insert("id")
+            .when_matched_update_all()
+            .when_not_matched_insert_all()
+            .execute(rows)
+        )
+
+    def delete(self, collection_name, ids, batch_size=500):
+        ids = list(ids)
+        table = self._table(collection_name)
+        # keeps the filter expressions short
+        for i in range(0, len(ids), batch_size):
+            table.delete(self._id_filter(ids[i:i + batch_size]))
+
+    def count(self, collection_name):
+        return self._table(collection_name).count_rows()
+
+    def iter_points(self, collection_name, with_vectors=True, with_payload=True, batch_size=256):
+        columns = ["id"]
+        if with_vectors:
+            columns.append("vector")
+        if with_payload:
+            columns.append("payload")
+        batches = self._table(collection_name).search().select(columns).limit(None).to_batches(batch_size)
+        for batch in batches:
+            for row in batch.to_pylist():
+                hit = self._hit(row, with_vectors=with_vectors, with_payload=bool(with_payload))
+                if with_payload and with_payload is not True:
+                    hit = hit._replace(payload=select_payload(hit.payload, with_payload))
+                yield hit
+
+
+def create_vector_store(backend=VECTOR_BACKEND):
+    if backend == "qdrant":
+        return QdrantBackend()
+    if backend == "lancedb":
+        return LanceDBBackend()
+    raise ValueError("Unknown vector store backend: " + str(backend))
+
+
+_store = None
+_store_pid = None
+_store_lock = threading.Lock()
+
+
+def get_vector_store():
+    """The process-wide backend selected by VECTOR_BACKEND."""
+    global _store, _store_pid
+    with _store_lock:
+        # an embedded store must not be shared with forked workers
+        if _store is None or _store_pid != os.getpid():
+            _store = create_vector_store()
+            _store_pid = os.getpid()
+        return _store
+
+
+def copy_collection(source, target, collection_name, vector_size=1536, batch_size=256):
+    """Copy all points of a collection between backends (i.e. qdrant -> lancedb)."""
+    target.recreate_collection(collection_name, vector_size=vector_size)
+
+    count = 0
+    batch = []
+    for point in source.iter_points(collection_name, batch_size=batch_size):
+        batch.append({"id": point.id, "vector": point.vector, "payload": point.payload})
+        if len(batch) >= batch_size:
+            target.upsert(collection_name, batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        target.upsert(collection_name, batch)
+        count += len(batch)
+    return count
+
+
+class PointWriter:
+    """
+        Upserts the points of an ingestion run in batches. Batches are sent without
+        waiting for them to be applied unless asked to; as updates are applied in
+        order, everything written before a waiting batch is applied with it. The
+        caller batches the points (by size or by max_delay, see `core/ingest.py`).
+    """
+
+    def __init__(self, collection_name, store=None, batch_size=UPSERT_BATCH_SIZE, max_delay=UPSERT_MAX_DELAY):
+        self.collection_name = collection_name
+        self.store = store or get_vector_store()
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+
+        self.pending = []
+        self.failed_points = []
+
+        self.batches = 0
+        self.failed_batches = 0
+        self.points = 0
+        self.seconds = 0.0
+
+    def write(self, points, wait=False):
+        """Send the points (and any pending ones) as a batch now."""
+        self.pending.extend(points)
+        self.flush(wait=wait)
+
+    def flush(self, wait=False):
+        points, self.pending = self.pending, []
+        if not points:
+            return
+
+        start = time.time()
+        try:
+            self.store.upsert(self.collection_name, points, wait=wait)
+        except Exception as e:
+            print("Failed to upsert batch of ", len(points), " points: ", str(e))
+            self.failed_batches += 1
+            self.failed_points.extend(points)
+            return
+        finally:
+            self.seconds += time.time() - start
+
+        self.batches += 1
+        self.points += len(points)
+
+    def close(self):
+        """Flush the remaining points, waiting until they are applied. Returns the stats."""
+        self.flush(wait=True)
+        return self.stats()
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "failed_batches": self.failed_batches,
+            "points": self.points,
+            "failed_points": len(self.failed_points),
+            "seconds": round(self.seconds, 2),
+            "points_per_second": round(self.points / self.seconds, 1) if self.seconds else 0.0,
+        }
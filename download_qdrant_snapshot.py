@@ -2,8 +2,7 @@ import argparse
 import sys
 import requests
 import os
-from conf.constants import QDRANT_URL, QDRANT_KEY
-from qdrant_client import QdrantClient
+from conf.constants import QDRANT_URL, QDRANT_KEY, require
 
 """
 Helper class to interact with Qdrant collections
@@ -12,6 +11,8 @@ Helper class to interact with Qdrant collections
 
 class QdrantCollectionsAgent:
     def __init__(self, url, key):
+        from qdrant_client import QdrantClient
+
         self.key = key
         self.qdrant_client = QdrantClient(url, api_key=key)
 
@@ -68,6 +69,8 @@ if __name__ == "__main__":
         parser.error(
             "the following arguments are required: -c/--collection when -d/--download is used")
 
+    require('QDRANT_URL', 'QDRANT_KEY')
+
     # Create a QdrantCollectionsAgent and fetch the collection names
     qdrant_collections_agent = QdrantCollectionsAgent(QDRANT_URL, QDRANT_KEY)
     collection_names = qdrant_collections_agent.get_collection_names()
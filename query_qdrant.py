@@ -1,7 +1,7 @@
-from openai import OpenAI
 from conf.constants import *
+from core.clients import get_openai_client, get_qdrant_client
+from core.embeddings import embed
 
-from qdrant_client import QdrantClient
 import argparse
 
 # ---
@@ -9,9 +9,7 @@ import argparse
 
 # create an embedding using openai
 def get_embedding(openai_client, text, model="text-embedding-ada-002"):
-   text = text.replace("\n", " ")
-   resp = openai_client.embeddings.create(input = [text], model=model)
-   return resp.data[0].embedding
+   return embed(text, model=model, openai_client=openai_client)
 
 # query the vector store
 def query_qdrant(openai_client, qdrant_client, query, collection_name, top_k=5):
@@ -28,21 +26,20 @@ def query_qdrant(openai_client, qdrant_client, query, collection_name, top_k=5):
 
 # ---
 
-# OpenAI Client
-openai_client = OpenAI()
-
-# Vector DB
-qdrant_client = QdrantClient(
-    QDRANT_URL,
-    api_key=QDRANT_KEY,
-)
-
 # arguments
 parser = argparse.ArgumentParser(description='Extract PDF pages')
 parser.add_argument('-c', '--collection', help='The target collection name', required=True)
 parser.add_argument('-k', '--topk', help='Num top k', required=False, default=5)
 args = parser.parse_args()
 
+require('QDRANT_URL', 'QDRANT_KEY')
+
+# OpenAI Client
+openai_client = get_openai_client()
+
+# Vector DB
+qdrant_client = get_qdrant_client()
+
 # exceute query
 query_results = query_qdrant(
     openai_client=openai_client, 
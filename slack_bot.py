@@ -11,12 +11,11 @@ from slack_bolt.adapter.socket_mode import SocketModeHandler
 from slack_sdk import WebClient
 from slack_bolt import App, Ack, Respond
 
-from core.agent import agent_executor, agent_llm
-from core.slack import Conversation, save_session, restore_session
+from conf.constants import require, VECTOR_STORE_SETTINGS
+require('SLACK_BOT_TOKEN', 'SLACK_APP_TOKEN', 'PG_URL', *VECTOR_STORE_SETTINGS)
 
-from langchain.agents.openai_functions_agent.agent_token_buffer_memory import (
-    AgentTokenBufferMemory,
-)
+from core.agent import get_agent_executor, get_agent_llm
+from core.slack import Conversation, save_session, restore_session
 
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from multiprocessing import Process
@@ -64,7 +63,8 @@ def handle_retirement(conversation):
     # persist session
     save_session(conversation)
     # noity client
-    conversation.retire()                    
+    with conversation.transition_lock:
+        conversation.retire()                    
     
 
 # This gets activated when the bot is tagged in a channel    
@@ -133,13 +133,15 @@ def handle_message_events(body, logger):
         channel = body["event"]["channel"]
         thread = body["event"]["event_ts"]
         
+        from core.memory import AgentMemory
+
         # register new conversation        
         conversation = Conversation(
             owner=message_sender,
             slack_client=client, 
             channel=channel, 
             thread_ts=thread,
-            memory=AgentTokenBufferMemory(llm=agent_llm)
+            memory=AgentMemory(llm=get_agent_llm())
             )
         
         with conversation_lock:
@@ -187,10 +189,7 @@ def handle_message_events(event):
             if(conversation.owner != message_sender):
                 print("Ignore message from sender who not owner") 
                 return               
-            elif(conversation.current_state == conversation.answered):
-                text = event.get('text')                
-                conversation.inquire(text)
-            else:
+            elif(not conversation.ask(event.get('text'))):
 
                 business = [
                     "Give me a minute ...",                    
@@ -246,6 +245,9 @@ def graceful_shutdown(signum, frame):
 
     # retire all active conversations
     [handle_retirement(ref["conversation"]) for ref in active_conversations]    
+
+    from core.costs import process_costs
+    print(process_costs.get_cost_summary())
     time.sleep(3)
 
     # stop the scheduler
@@ -271,6 +273,9 @@ if __name__ == "__main__":
 
     # start healthecheck listener    
     healthcheck_process.start()
+
+    # build the agent up front, the first conversation should not wait for it
+    get_agent_executor()
     
     # start listening for messages
     socket.start()
@@ -0,0 +1,64 @@
+import unittest
+
+from langchain_core.documents import Document
+
+from core.context_packer import MIN_PARTIAL_TOKENS, merge_chunks, pack_documents, page_content, split_page_number
+
+
+class WordEncoding:
+    """A token per word, no tokenizer needed."""
+
+    def encode(self, text):
+        return text.split()
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+
+def document(page_number, text):
+    return Document(page_content='"' + text + '"', metadata={"page_number": page_number, "entities": "a, b"})
+
+
+def words(prefix, n):
+    return " ".join(f"{prefix}{i}" for i in range(n))
+
+
+class ContextPackerTest(unittest.TestCase):
+
+    def pack(self, documents, token_budget):
+        return pack_documents(documents, token_budget=token_budget, encoding=WordEncoding())
+
+    def test_split_page_number(self):
+        self.assertEqual(split_page_number("guide.txt_3"), ("guide.txt", 3))
+        self.assertEqual(split_page_number("guide.txt"), ("guide.txt", None))
+
+    def test_page_content_without_quotes(self):
+        self.assertEqual(page_content(document("a", "some text")), "some text")
+
+    def test_merges_chunks_without_overlap(self):
+        self.assertEqual(merge_chunks([(1, "two three four"), (0, "one two three")]), "one two three\nfour")
+
+    def test_renders_pages_in_retrieval_order(self):
+        packed = self.pack([document("b.txt", "page b"), document("a.txt_1", "a1"), document("a.txt_0", "a0")], 100)
+        self.assertEqual(packed, "[b.txt]\npage b\n\n[a.txt]\na0\na1")
+
+    def test_cuts_the_last_document(self):
+        first, second = words("x", 100), words("y", 200)
+        packed = self.pack([document("a.txt", first), document("b.txt", second)], 200)
+
+        sections = packed.split("\n\n")
+        self.assertEqual(sections[0], "[a.txt]\n" + first)
+        self.assertTrue(sections[1].startswith("[b.txt] y0"))
+        self.assertEqual(len(WordEncoding().encode(packed)), 200 - 1)
+
+    def test_drops_a_cut_too_short_to_help(self):
+        first = words("x", 200 - MIN_PARTIAL_TOKENS)
+        packed = self.pack([document("a.txt", first), document("b.txt", words("y", 100))], 200)
+        self.assertEqual(packed, "[a.txt]\n" + first)
+
+    def test_empty(self):
+        self.assertEqual(self.pack([], 100), "")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+from unittest import mock
+
+from core.embeddings import token_batches
+
+
+class WordEncoding:
+    """A token per word, no tokenizer needed."""
+
+    def encode(self, text):
+        return text.split()
+
+
+def batches(texts, max_texts, max_tokens):
+    with mock.patch("core.embeddings.get_encoding", return_value=WordEncoding()):
+        return list(token_batches(texts, max_texts=max_texts, max_tokens=max_tokens))
+
+
+class TokenBatchesTest(unittest.TestCase):
+
+    def test_limits_texts(self):
+        self.assertEqual(batches(["a"] * 5, max_texts=2, max_tokens=100), [[0, 1], [2, 3], [4]])
+
+    def test_limits_tokens(self):
+        texts = ["a b c", "d e", "f g h", "i"]
+        self.assertEqual(batches(texts, max_texts=10, max_tokens=5), [[0, 1], [2, 3]])
+
+    def test_oversized_text_gets_its_own_batch(self):
+        texts = ["a", "b " * 20, "c"]
+        self.assertEqual(batches(texts, max_texts=10, max_tokens=5), [[0], [1], [2]])
+
+    def test_oversized_first_text(self):
+        self.assertEqual(batches(["b " * 20, "c"], max_texts=10, max_tokens=5), [[0], [1]])
+
+    def test_empty(self):
+        self.assertEqual(batches([], max_texts=10, max_tokens=5), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import asyncio
+import hashlib
+import inspect
+import json
+import unittest
+
+from langchain.agents import AgentExecutor
+from langchain_community.chat_models.fake import FakeMessagesListChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.tools import Tool
+
+from core.executor import AssistantAgentExecutor, create_tools_agent
+
+# sha256 of the upstream methods that AssistantAgentExecutor copies (langchain 0.0.354):
+# when one of them changes, the copies in core/executor.py need the same change
+UPSTREAM_SOURCES = {
+    "_acall": "9e9637e728d239cd9cecea5a1831ea92ca9a1192652b8a1863b03e3b58c3570e",
+    "_iter_next_step": "8ded8d26911dfaf0567354be536f72476fb35767a968c65b61d78475a10b7cb1",
+    "_aiter_next_step": "647ffd32018e86255d43d79424b8eba6a08dede49a10442676b298e410a6b34c",
+}
+
+PROMPT = ChatPromptTemplate.from_messages([("human", "{input}"), MessagesPlaceholder("agent_scratchpad")])
+
+
+def tool_calls(*calls):
+    return AIMessage(content="", additional_kwargs={"tool_calls": [
+        {"id": f"call_{i}", "type": "function", "function": {"name": name, "arguments": arguments}}
+        for i, (name, arguments) in enumerate(calls)
+    ]})
+
+
+def search(query):
+    return "found " + query
+
+
+def executor(cls, responses, **kwargs):
+    tools = [Tool(name="search", func=search, description="Search the docs")]
+    agent = create_tools_agent(FakeMessagesListChatModel(responses=responses), tools, PROMPT)
+    if cls is AssistantAgentExecutor:
+        kwargs.update(use_answer_cache=False, use_router=False)
+    return cls(agent=agent, tools=tools, return_intermediate_steps=True, **kwargs)
+
+
+def summary(outputs):
+    return outputs["output"], [(action.tool, action.tool_input, observation) for action, observation in outputs["intermediate_steps"]]
+
+
+class AssistantAgentExecutorTest(unittest.TestCase):
+    """The executor behaves like the stock AgentExecutor it copies parts of."""
+
+    def assertSameAsUpstream(self, responses, **kwargs):
+        inputs = {"input": "question"}
+        expected = summary(executor(AgentExecutor, responses, **kwargs).invoke(inputs))
+        self.assertEqual(summary(executor(AssistantAgentExecutor, responses, **kwargs).invoke(inputs)), expected)
+        outputs = asyncio.run(executor(AssistantAgentExecutor, responses, **kwargs).ainvoke(inputs))
+        self.assertEqual(summary(outputs), expected)
+        return expected
+
+    def test_parallel_tool_calls(self):
+        responses = [
+            tool_calls(("search", json.dumps({"__arg1": "a"})), ("search", json.dumps({"__arg1": "b"}))),
+            AIMessage(content="answer"),
+        ]
+        output, steps = self.assertSameAsUpstream(responses)
+        self.assertEqual(output, "answer")
+        self.assertEqual([observation for _, _, observation in steps], ["found a", "found b"])
+
+    def test_unknown_tool(self):
+        responses = [tool_calls(("lookup", json.dumps({"__arg1": "a"}))), AIMessage(content="answer")]
+        self.assertSameAsUpstream(responses)
+
+    def test_parsing_error(self):
+        responses = [tool_calls(("search", "{not json")), AIMessage(content="answer")]
+        output, steps = self.assertSameAsUpstream(responses, handle_parsing_errors=True)
+        self.assertEqual(steps[0][0], "_Exception")
+
+    def test_parsing_error_raises(self):
+        responses = [tool_calls(("search", "{not json"))]
+        with self.assertRaises(ValueError):
+            executor(AssistantAgentExecutor, responses).invoke({"input": "question"})
+        with self.assertRaises(ValueError):
+            asyncio.run(executor(AssistantAgentExecutor, responses).ainvoke({"input": "question"}))
+
+    def test_iteration_limit(self):
+        responses = [tool_calls(("search", json.dumps({"__arg1": "a"})))]
+        output, steps = self.assertSameAsUpstream(responses, max_iterations=2, early_stopping_method="force")
+        self.assertEqual(len(steps), 2)
+
+    def test_upstream_unchanged(self):
+        for name, digest in UPSTREAM_SOURCES.items():
+            source = inspect.getsource(getattr(AgentExecutor, name))
+            self.assertEqual(hashlib.sha256(source.encode("utf-8")).hexdigest(), digest, f"AgentExecutor.{name} changed")
+
+
+if __name__ == '__main__':
+    unittest.main()
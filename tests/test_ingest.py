@@ -0,0 +1,122 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from core.ingest import IngestPipeline, content_hash, point_id, stored_points
+from core.vectorstores import SearchHit
+
+
+class FakeStore:
+    """In-memory backend, keeps the points by id."""
+
+    def __init__(self):
+        self.points = {}
+        self.deleted = []
+
+    def upsert(self, collection_name, points, wait=False):
+        for point in points:
+            self.points[point["id"]] = point
+
+    def delete(self, collection_name, ids):
+        self.deleted.extend(ids)
+        for point_id in ids:
+            self.points.pop(point_id, None)
+
+    def count(self, collection_name):
+        return len(self.points)
+
+    def iter_points(self, collection_name, with_vectors=True, with_payload=True, batch_size=256):
+        for point in self.points.values():
+            yield SearchHit(id=point["id"], score=0.0, vector=None, payload=point["payload"])
+
+
+async def fake_extract(document, chunk_hash, **kwargs):
+    return "entities"
+
+
+async def fake_embed(texts, **kwargs):
+    return [[1.0, 0.0] for _ in texts]
+
+
+class PointIdTest(unittest.TestCase):
+
+    def test_deterministic(self):
+        self.assertEqual(point_id("docs", "page.txt", 0), point_id("docs", "page.txt", 0))
+
+    def test_distinct(self):
+        ids = {point_id(collection, page_ref, chunk)
+               for collection in ("docs", "other") for page_ref in ("a.txt", "b.txt") for chunk in range(3)}
+        self.assertEqual(len(ids), 12)
+
+
+class IngestRefreshTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.store = FakeStore()
+        for patch in (mock.patch("core.ingest.aextract_entities", side_effect=fake_extract),
+                      mock.patch("core.ingest.aembed_batched", side_effect=fake_embed)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def write(self, name, text):
+        with open(os.path.join(self.directory.name, name), "w") as f:
+            f.write(text)
+
+    def files(self):
+        return sorted(os.path.join(self.directory.name, name) for name in os.listdir(self.directory.name))
+
+    def ingest(self, files=None, prune=True):
+        pipeline = IngestPipeline(
+            "docs", self.files() if files is None else files, os.path.basename,
+            known=stored_points(self.store, "docs"), prune=prune, report_interval=3600, store=self.store,
+        )
+        asyncio.run(pipeline.run())
+        return pipeline
+
+    def test_stores_page_ref_and_hash(self):
+        self.write("a.txt", "page a")
+        self.ingest()
+        stored = stored_points(self.store, "docs")
+        self.assertEqual(stored, {point_id("docs", "a.txt", 0): ("a.txt", content_hash("page a"))})
+
+    def test_unchanged_chunks_are_skipped(self):
+        self.write("a.txt", "page a")
+        self.write("b.txt", "page b")
+        self.ingest()
+        self.write("b.txt", "page b changed")
+        pipeline = self.ingest()
+
+        self.assertEqual(pipeline.stats.counts["unchanged"], 1)
+        self.assertEqual(pipeline.stats.counts["changed"], 1)
+        self.assertEqual(pipeline.written, {point_id("docs", "b.txt", 0)})
+        self.assertEqual(stored_points(self.store, "docs")[point_id("docs", "b.txt", 0)][1], content_hash("page b changed"))
+
+    def test_full_run_prunes_missing_pages(self):
+        self.write("a.txt", "page a")
+        self.write("b.txt", "page b")
+        self.ingest()
+        os.remove(os.path.join(self.directory.name, "b.txt"))
+        pipeline = self.ingest()
+
+        self.assertEqual(pipeline.stale_ids(), [point_id("docs", "b.txt", 0)])
+        self.assertEqual(self.store.deleted, [point_id("docs", "b.txt", 0)])
+        self.assertEqual(pipeline.expected_count(), 1)
+        self.assertEqual(self.store.count("docs"), pipeline.expected_count())
+
+    def test_partial_run_keeps_other_pages(self):
+        self.write("a.txt", "page a")
+        self.write("b.txt", "page b")
+        self.ingest()
+        pipeline = self.ingest(files=[os.path.join(self.directory.name, "a.txt")], prune=False)
+
+        self.assertEqual(pipeline.stale_ids(), [])
+        self.assertEqual(pipeline.expected_count(), 2)
+        self.assertEqual(self.store.count("docs"), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
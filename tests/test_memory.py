@@ -0,0 +1,60 @@
+import unittest
+
+from langchain.agents.output_parsers.openai_tools import OpenAIToolAgentAction
+from langchain_community.chat_models.fake import FakeMessagesListChatModel
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+from core.memory import AgentMemory
+
+
+class WordCountModel(FakeMessagesListChatModel):
+    """Counts a token per word, no tokenizer needed."""
+
+    def get_num_tokens_from_messages(self, messages):
+        return sum(len(str(message.content).split()) + 1 for message in messages) + 3
+
+
+def tool_step(call_id, observation):
+    call = {"id": call_id, "type": "function", "function": {"name": "search", "arguments": "{}"}}
+    action = OpenAIToolAgentAction(
+        tool="search",
+        tool_input={},
+        log="",
+        message_log=[AIMessage(content="", additional_kwargs={"tool_calls": [call]})],
+        tool_call_id=call_id,
+    )
+    return action, observation
+
+
+class AgentMemoryPruneTest(unittest.TestCase):
+
+    def memory(self, max_token_limit):
+        return AgentMemory(llm=WordCountModel(responses=[]), max_token_limit=max_token_limit)
+
+    def test_prunes_whole_turns(self):
+        memory = self.memory(max_token_limit=60)
+        for turn in range(4):
+            steps = [tool_step(f"call_{turn}_{i}", "word " * 10) for i in range(2)]
+            memory.save_context({"input": f"question {turn}"}, {"output": f"answer {turn}", "intermediate_steps": steps})
+
+            messages = memory.chat_memory.messages
+            self.assertIsInstance(messages[0], HumanMessage)
+            self.assertLessEqual(memory.token_count, 60)
+            # every tool message follows the message that called it
+            called = set()
+            for message in messages:
+                for call in message.additional_kwargs.get("tool_calls", []):
+                    called.add(call["id"])
+                if isinstance(message, ToolMessage):
+                    self.assertIn(message.tool_call_id, called)
+
+    def test_token_count_matches_buffer(self):
+        memory = self.memory(max_token_limit=60)
+        for turn in range(3):
+            memory.save_context({"input": f"question {turn}"}, {"output": "answer", "intermediate_steps": [tool_step(f"c{turn}", "x y z")]})
+        expected = memory.llm.get_num_tokens_from_messages(memory.chat_memory.messages)
+        self.assertEqual(memory.token_count, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
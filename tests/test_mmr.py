@@ -0,0 +1,61 @@
+import unittest
+
+import numpy as np
+from langchain_community.vectorstores.utils import maximal_marginal_relevance as upstream_mmr
+
+from core.CustomTools import rerank
+from core.mmr import maximal_marginal_relevance, maximal_marginal_relevance_batch
+from core.vectorstores import SearchHit
+
+
+def vectors(seed, n, dim=32):
+    return np.random.default_rng(seed).normal(size=(n, dim)).astype(np.float32)
+
+
+class MaximalMarginalRelevanceTest(unittest.TestCase):
+    """Same selection as langchain's implementation."""
+
+    def test_matches_langchain(self):
+        for seed in range(20):
+            query, candidates = vectors(seed, 1)[0], vectors(seed + 100, 15)
+            for lambda_mult in (0.0, 0.5, 0.85, 1.0):
+                for k in (1, 5, 15):
+                    self.assertEqual(
+                        maximal_marginal_relevance(query, candidates, lambda_mult=lambda_mult, k=k),
+                        upstream_mmr(query, candidates, lambda_mult=lambda_mult, k=k),
+                        f"seed {seed}, lambda_mult {lambda_mult}, k {k}",
+                    )
+
+    def test_fewer_candidates_than_k(self):
+        query, candidates = vectors(1, 1)[0], vectors(2, 3)
+        selected = maximal_marginal_relevance(query, candidates, k=5)
+        self.assertEqual(selected, upstream_mmr(query, candidates, k=5))
+        self.assertEqual(sorted(selected), [0, 1, 2])
+
+    def test_no_candidates(self):
+        query = vectors(1, 1)[0]
+        self.assertEqual(maximal_marginal_relevance(query, [], k=5), [])
+        self.assertEqual(maximal_marginal_relevance(query, np.zeros((0, 32), dtype=np.float32), k=5), [])
+
+    def test_batch_matches_single_queries(self):
+        queries, candidates = vectors(3, 4), vectors(4, 15)
+        self.assertEqual(
+            maximal_marginal_relevance_batch(queries, candidates, lambda_mult=0.85, k=5),
+            [maximal_marginal_relevance(query, candidates, lambda_mult=0.85, k=5) for query in queries],
+        )
+
+
+class RerankTest(unittest.TestCase):
+
+    def test_no_candidates(self):
+        self.assertEqual(rerank(vectors(1, 1)[0], [], k=5), [])
+
+    def test_selects_hits(self):
+        query, embeddings = vectors(5, 1)[0], vectors(6, 8)
+        candidates = [("docs", SearchHit(id=str(i), score=0.0, vector=list(v), payload=None)) for i, v in enumerate(embeddings)]
+        selected = rerank(query, candidates, k=3, lambda_mult=0.85)
+        self.assertEqual([hit.id for _, hit in selected], [str(i) for i in upstream_mmr(query, embeddings, lambda_mult=0.85, k=3)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import threading
+import unittest
+from unittest import mock
+
+from core.slack import RateLimiter
+
+
+class Clock:
+    """time.monotonic and time.sleep of a clock that only moves when slept on."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        for patch in (mock.patch("core.slack.time.monotonic", self.clock.monotonic),
+                      mock.patch("core.slack.time.sleep", self.clock.sleep)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_burst_then_rate(self):
+        limiter = RateLimiter(per_minute=60, burst=3)
+        self.assertEqual([limiter.try_acquire() for _ in range(4)], [True, True, True, False])
+        self.clock.now += 1.0
+        self.assertTrue(limiter.try_acquire())
+        self.assertFalse(limiter.try_acquire())
+
+    def test_tokens_do_not_exceed_burst(self):
+        limiter = RateLimiter(per_minute=60, burst=2)
+        self.clock.now += 600
+        self.assertEqual([limiter.try_acquire() for _ in range(3)], [True, True, False])
+
+    def test_acquire_waits_for_a_token(self):
+        limiter = RateLimiter(per_minute=30, burst=1)
+        limiter.acquire()
+        limiter.acquire()
+        self.assertAlmostEqual(sum(self.clock.sleeps), 2.0)
+
+    def test_back_off(self):
+        limiter = RateLimiter(per_minute=60, burst=3)
+        limiter.back_off(10)
+        self.clock.now += 5
+        self.assertFalse(limiter.try_acquire())
+        limiter.acquire()
+        self.assertAlmostEqual(self.clock.now, 1010.0)
+
+    def test_shared_by_threads(self):
+        limiter = RateLimiter(per_minute=60, burst=5)
+        acquired = []
+        threads = [threading.Thread(target=lambda: acquired.append(limiter.try_acquire())) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(acquired.count(True), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
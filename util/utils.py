@@ -1,4 +1,7 @@
+import functools
 import json
+import os
+import sqlite3
 
 def show_json(obj):
     json_object = json.loads(obj.model_dump_json())
@@ -8,4 +11,59 @@ def show_json(obj):
 def as_json(obj):
     json_object = json.loads(obj.model_dump_json())
     return json_object
-    
\ No newline at end of file
+
+def connect_sqlite(path):
+    """Open a sqlite database that can be shared by threads and processes."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    """Cached tiktoken encoding of a model (loading the BPE ranks is expensive)."""
+    import tiktoken
+
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+# langchain message type -> OpenAI chat role
+MESSAGE_ROLES = {"human": "user", "ai": "assistant", "system": "system", "function": "function", "tool": "tool"}
+
+def message_fields(message):
+    """The role, content, name and function/tool calls of a message as sent to the chat API."""
+    fields = {
+        "role": getattr(message, "role", None) or MESSAGE_ROLES.get(message.type, message.type),
+        "content": message.content,
+    }
+    name = getattr(message, "name", None) or message.additional_kwargs.get("name")
+    if name:
+        fields["name"] = name
+    for key in ("function_call", "tool_calls"):
+        if message.additional_kwargs.get(key):
+            fields[key] = message.additional_kwargs[key]
+    return fields
+
+def message_tokens(message, model):
+    """
+        Tokens of a single chat message as counted by `ChatOpenAI.get_num_tokens_from_messages`,
+        without the 3 tokens that prime the reply (those are counted once per request).
+    """
+    if model.startswith("gpt-3.5-turbo-0301"):
+        tokens_per_message, tokens_per_name = 4, -1
+    else:
+        tokens_per_message, tokens_per_name = 3, 1
+
+    encoding = get_encoding(model)
+    num_tokens = tokens_per_message
+    for key, value in message_fields(message).items():
+        num_tokens += len(encoding.encode(str(value)))
+        if key == "name":
+            num_tokens += tokens_per_name
+    return num_tokens